@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Generate synthetic directory trees, for benchmarking CapiDup.
+
+Public functions:
+
+    generate_tree -- create a tree of files with duplicates
+    parse_sizes -- parse a file size distribution
+    main -- command line entry point
+
+The same arguments always give the same tree: all choices and contents
+come from a random generator seeded with `seed`. A manifest describing
+the tree is returned, and written by the command line tool as JSON.
+
+Every file is one of these kinds:
+
+``unique``
+    Contents differ from all other files from the first bytes.
+``duplicate``
+    Same contents as an earlier unique file (``dup_ratio``).
+``hardlink``
+    Another hard link to an earlier file (``hardlink_ratio``).
+``prefix``
+    Made in pairs of the same size, with the same contents up to their
+    last 16 bytes (``prefix_ratio``). These survive the partial stage, and
+    are only told apart by the full stage.
+``suffix``
+    Made in pairs of the same size, with the same contents except for
+    their first 16 bytes (``suffix_ratio``). The partial stage tells these
+    apart at once.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import struct
+import sys
+
+
+__all__ = [ "generate_tree", "parse_sizes", "main" ]
+
+
+FILLER_SIZE = 256 * 1024
+"""Size in bytes of the pseudo-random block that file contents repeat."""
+
+TOKEN_SIZE = 16
+"""Size in bytes of the token that makes each file's contents unique."""
+
+
+def parse_sizes(spec):
+    """Parse a file size distribution.
+
+    spec is one of ``fixed:N``, ``uniform:MIN:MAX`` or
+    ``lognormal:MU:SIGMA`` (sizes in bytes; the natural log of the size has
+    mean MU and standard deviation SIGMA).
+
+    Returns a function that takes a random.Random instance, and returns a
+    size. Raises ValueError if spec is invalid.
+
+    """
+    parts = spec.split(":")
+    try:
+        if parts[0] == "fixed" and len(parts) == 2:
+            size = int(parts[1])
+            return lambda rng: size
+        if parts[0] == "uniform" and len(parts) == 3:
+            low, high = int(parts[1]), int(parts[2])
+            return lambda rng: rng.randint(low, high)
+        if parts[0] == "lognormal" and len(parts) == 3:
+            mu, sigma = float(parts[1]), float(parts[2])
+            return lambda rng: int(rng.lognormvariate(mu, sigma))
+    except ValueError:
+        pass
+
+    raise ValueError("invalid size distribution: %r" % (spec,))
+
+
+def make_dirs(root, depth, fanout):
+    """Create a tree of directories, fanout per level, depth levels deep.
+
+    Returns the list of all directories, including root.
+
+    """
+    dirs = [root]
+    level = [root]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                path = os.path.join(parent, "d%d" % i)
+                os.mkdir(path)
+                next_level.append(path)
+        dirs += next_level
+        level = next_level
+
+    return dirs
+
+
+def write_file(path, size, filler, token, token_offset):
+    """Write a file of filler bytes, with token written at token_offset."""
+
+    with open(path, "wb") as f:
+        pos = 0
+        while pos < size:
+            piece = bytearray(filler[:min(len(filler), size - pos)])
+
+            # patch in the part of the token that falls in this piece
+            start = max(token_offset, pos)
+            end = min(token_offset + len(token), pos + len(piece))
+            if start < end:
+                piece[start - pos:end - pos] = \
+                        token[start - token_offset:end - token_offset]
+
+            f.write(piece)
+            pos += len(piece)
+
+
+def generate_tree(root, files=1000, depth=2, fanout=4,
+        sizes="lognormal:10:2", max_size=64 * 1024 * 1024, dup_ratio=0.2,
+        prefix_ratio=0.0, suffix_ratio=0.0, hardlink_ratio=0.0, seed=0):
+    """Create a synthetic tree of files under root.
+
+    root must be an empty or non-existing directory. files is the total
+    number of files, spread at random over a tree of directories depth
+    levels deep, with fanout subdirectories each. sizes is a size
+    distribution for parse_sizes(), capped at max_size. The ratios are the
+    probabilities of each kind of file, as described in the module
+    documentation; the rest are unique files.
+
+    Returns a manifest: a dictionary with the arguments, and the number of
+    files and bytes of each kind.
+
+    """
+    rng = random.Random(seed)
+    size_func = parse_sizes(sizes)
+    filler = bytes(bytearray(rng.getrandbits(8) for _ in range(FILLER_SIZE)))
+
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    dirs = make_dirs(root, depth, fanout)
+
+    counts = dict((kind, 0) for kind in
+                  ("unique", "duplicate", "hardlink", "prefix", "suffix"))
+    total_bytes = dict(counts)
+
+    # (path, size, token, token_offset) of files that can be copied
+    originals = []
+    # size of the first file of a pair still waiting for the second
+    pending_pair = {}
+
+    for i in range(files):
+        path = os.path.join(rng.choice(dirs), "f%07d" % i)
+        token = struct.pack(">QQ", seed, i)
+        size = max(min(size_func(rng), max_size), TOKEN_SIZE)
+
+        roll = rng.random()
+        if roll < hardlink_ratio and originals:
+            kind = "hardlink"
+            source = rng.choice(originals)
+            os.link(source[0], path)
+            size = source[1]
+        elif roll < hardlink_ratio + dup_ratio and originals:
+            kind = "duplicate"
+            _, size, token, token_offset = rng.choice(originals)
+            write_file(path, size, filler, token, token_offset)
+        else:
+            roll -= hardlink_ratio + dup_ratio
+            if roll < prefix_ratio:
+                kind = "prefix"
+            elif roll < prefix_ratio + suffix_ratio:
+                kind = "suffix"
+            else:
+                kind = "unique"
+
+            # pair up prefix and suffix files by size, so they are compared
+            if kind != "unique":
+                if kind in pending_pair:
+                    size = pending_pair.pop(kind)
+                else:
+                    pending_pair[kind] = size
+
+            token_offset = size - TOKEN_SIZE if kind == "prefix" else 0
+            write_file(path, size, filler, token, token_offset)
+            originals.append((path, size, token, token_offset))
+
+        counts[kind] += 1
+        total_bytes[kind] += size
+
+    return {
+        "root": root,
+        "seed": seed,
+        "files": files,
+        "depth": depth,
+        "fanout": fanout,
+        "sizes": sizes,
+        "max_size": max_size,
+        "dup_ratio": dup_ratio,
+        "prefix_ratio": prefix_ratio,
+        "suffix_ratio": suffix_ratio,
+        "hardlink_ratio": hardlink_ratio,
+        "directories": len(dirs),
+        "counts": counts,
+        "bytes": total_bytes,
+    }
+
+
+def add_tree_arguments(parser):
+    """Add the tree generation options to an argparse parser."""
+
+    parser.add_argument("--files", type=int, default=1000,
+                        help="number of files (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=2,
+                        help="directory levels (default: %(default)s)")
+    parser.add_argument("--fanout", type=int, default=4,
+                        help="subdirectories per directory "
+                             "(default: %(default)s)")
+    parser.add_argument("--sizes", default="lognormal:10:2",
+                        help="file size distribution: fixed:N, "
+                             "uniform:MIN:MAX or lognormal:MU:SIGMA "
+                             "(default: %(default)s)")
+    parser.add_argument("--max-size", type=int, default=64 * 1024 * 1024,
+                        help="maximum file size (default: %(default)s)")
+    parser.add_argument("--dup-ratio", type=float, default=0.2,
+                        help="fraction of duplicate files "
+                             "(default: %(default)s)")
+    parser.add_argument("--prefix-ratio", type=float, default=0.0,
+                        help="fraction of files sharing all but the end "
+                             "(default: %(default)s)")
+    parser.add_argument("--suffix-ratio", type=float, default=0.0,
+                        help="fraction of files sharing all but the start "
+                             "(default: %(default)s)")
+    parser.add_argument("--hardlink-ratio", type=float, default=0.0,
+                        help="fraction of hard links (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed (default: %(default)s)")
+
+
+def tree_arguments(args):
+    """Get the keyword arguments for generate_tree(), from parsed args."""
+
+    return dict(files=args.files, depth=args.depth, fanout=args.fanout,
+                sizes=args.sizes, max_size=args.max_size,
+                dup_ratio=args.dup_ratio, prefix_ratio=args.prefix_ratio,
+                suffix_ratio=args.suffix_ratio,
+                hardlink_ratio=args.hardlink_ratio, seed=args.seed)
+
+
+def main(argv=None):
+    """Generate a tree from the command line, printing its manifest."""
+
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic tree for benchmarking CapiDup.")
+    parser.add_argument("root", help="directory to create the tree in")
+    add_tree_arguments(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        parse_sizes(args.sizes)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if os.path.exists(args.root) and os.listdir(args.root):
+        parser.error("directory not empty: %s" % args.root)
+
+    manifest = generate_tree(args.root, **tree_arguments(args))
+    json.dump(manifest, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Time the stages of a CapiDup scan.
+
+Public functions:
+
+    run_scan -- scan a tree once, timing each stage
+    main -- command line entry point
+
+Each scan is a plain capidup.finddups.find_duplicates_in_dirs(), with a
+capidup.scanstats.ScanStats to time its stages:
+
+``crawl``
+    Listing the directories and indexing the files by size.
+``partial``
+    Hashing the initial portion of files large enough to have one, in
+    groups of files of the same size.
+``sample``
+    Hashing blocks from all over large files, with ``--sample-blocks``.
+``full``
+    Hashing entire files, for the groups that survived the partial stage
+    and the groups of small files.
+
+Each stage is reported with the number of files it went through, the
+bytes it actually read, and its rate in files/s and MB/s. The crawl reads
+no file contents, so its bytes are always 0.
+
+Results are printed as a table, or as JSON with ``--json``, for comparing
+releases or settings. The ``PARTIAL_MD5_*`` and ``MD5_CHUNK_SIZE``
+constants can be overridden from the command line, to find the best ones
+for a given system.
+
+The tree to scan is either an existing directory, or generated with the
+options of gentree.py.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+import gentree
+
+from capidup import finddups
+from capidup import readers
+from capidup import scanstats
+from capidup.version import __version__
+from capidup.hashers import DEFAULT_PARTIAL_HASH, DEFAULT_FULL_HASH
+
+
+__all__ = [ "run_scan", "main" ]
+
+
+TUNABLES = ("MD5_CHUNK_SIZE", "PARTIAL_MD5_READ_MULT", "PARTIAL_MD5_THRESHOLD",
+            "PARTIAL_MD5_MAX_READ", "PARTIAL_MD5_READ_RATIO")
+"""Names of the capidup.finddups constants that can be overridden."""
+
+STAGES = ("crawl",) + scanstats.STAGES
+"""Names of the stages reported, in the order of a scan."""
+
+
+def drop_caches():
+    """Drop the OS page cache, so files are read from disk.
+
+    Only possible on Linux, as root. Returns True on success.
+
+    """
+    try:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+    except (AttributeError, EnvironmentError):
+        return False
+
+    return True
+
+
+def stage_result(seconds, files, nbytes):
+    """Make the result dictionary of a stage."""
+
+    return {
+        "seconds": seconds,
+        "files": files,
+        "bytes": nbytes,
+        "files_per_s": files / seconds if seconds else None,
+        "mb_per_s": nbytes / seconds / 1e6 if seconds else None,
+    }
+
+
+def run_scan(root, partial_hash=DEFAULT_PARTIAL_HASH,
+        full_hash=DEFAULT_FULL_HASH, workers=None, sample_blocks=0,
+        read_backend="auto"):
+    """Scan a tree once, timing each stage.
+
+    The arguments are as in capidup.finddups.find_duplicates_in_dirs().
+
+    Returns a dictionary with a result for each stage (see stage_result),
+    the number of duplicate groups found and the number of errors.
+
+    """
+    stats = scanstats.ScanStats()
+    duplicates, errors = finddups.find_duplicates_in_dirs(
+        [root], workers=workers, partial_hash=partial_hash,
+        full_hash=full_hash, sample_blocks=sample_blocks,
+        read_backend=read_backend, stats=stats)
+
+    result = {
+        "crawl": stage_result(stats.crawl_seconds, stats.files, 0),
+        "duplicate_groups": len(duplicates),
+        "errors": len(errors),
+    }
+    for name, stage in stats.stages.items():
+        result[name] = stage_result(stage.seconds, stage.files_in,
+                                    stage.bytes_read)
+
+    return result
+
+
+def format_table(report):
+    """Format the runs of a report as a human readable table."""
+
+    lines = ["%-4s %-8s %10s %10s %14s %12s %10s"
+             % ("run", "stage", "seconds", "files", "bytes", "files/s",
+                "MB/s")]
+
+    for i, run in enumerate(report["runs"]):
+        for stage in STAGES:
+            r = run[stage]
+            lines.append("%-4d %-8s %10.3f %10d %14d %12s %10s"
+                         % (i + 1, stage, r["seconds"], r["files"],
+                            r["bytes"],
+                            "%.0f" % r["files_per_s"]
+                            if r["files_per_s"] is not None else "-",
+                            "%.1f" % r["mb_per_s"]
+                            if r["mb_per_s"] is not None else "-"))
+
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line."""
+
+    parser = argparse.ArgumentParser(
+        description="Time the stages of a CapiDup scan.")
+    parser.add_argument("--root",
+                        help="existing tree to scan; by default, one is "
+                             "generated in a temporary directory")
+    parser.add_argument("--keep", action="store_true",
+                        help="don't delete the generated tree")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of scans (default: %(default)s)")
+    parser.add_argument("--drop-caches", action="store_true",
+                        help="drop the page cache before each scan (Linux, "
+                             "as root)")
+    parser.add_argument("--workers", type=int,
+                        help="number of threads for crawling and hashing")
+    parser.add_argument("--partial-hash", default=DEFAULT_PARTIAL_HASH,
+                        help="partial hash algorithm (default: %(default)s)")
+    parser.add_argument("--full-hash", default=DEFAULT_FULL_HASH,
+                        help="full hash algorithm (default: %(default)s)")
+    parser.add_argument("--sample-blocks", type=int, default=0,
+                        help="blocks to sample from large files "
+                             "(default: %(default)s)")
+    parser.add_argument("--read-backend", default="auto",
+                        help="read backend: auto, %s (default: "
+                             "%%(default)s)"
+                             % ", ".join(sorted(
+                                 readers.available_backends())))
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="override a constant of capidup.finddups: %s"
+                             % ", ".join(TUNABLES))
+    parser.add_argument("--json", action="store_true",
+                        help="print the report as JSON")
+    gentree.add_tree_arguments(parser)
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    for setting in args.set:
+        name, _, value = setting.partition("=")
+        if name not in TUNABLES:
+            parser.error("unknown constant: %s" % name)
+        try:
+            overrides[name] = int(value)
+        except ValueError:
+            parser.error("invalid value for %s: %r" % (name, value))
+
+    try:
+        readers.ReadOptions(args.read_backend)
+    except ValueError as e:
+        parser.error(str(e))
+
+    for name, value in overrides.items():
+        setattr(finddups, name, value)
+
+    generated = None
+    if args.root is None:
+        generated = tempfile.mkdtemp(prefix="capidup-bench-")
+        root = os.path.join(generated, "tree")
+        tree = gentree.generate_tree(root, **gentree.tree_arguments(args))
+    else:
+        root = args.root
+        tree = {"root": root}
+
+    try:
+        runs = []
+        for _ in range(args.repeat):
+            if args.drop_caches and not drop_caches():
+                parser.error("unable to drop the page cache")
+            runs.append(run_scan(root, args.partial_hash, args.full_hash,
+                                 args.workers, args.sample_blocks,
+                                 args.read_backend))
+    finally:
+        if generated is not None and not args.keep:
+            shutil.rmtree(generated)
+
+    report = {
+        "capidup_version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "workers": args.workers,
+            "partial_hash": args.partial_hash,
+            "full_hash": args.full_hash,
+            "sample_blocks": args.sample_blocks,
+            "read_backend": args.read_backend,
+            "drop_caches": args.drop_caches,
+            "constants": dict((name, getattr(finddups, name))
+                              for name in TUNABLES),
+        },
+        "tree": tree,
+        "runs": runs,
+    }
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print(format_table(report))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
@@ -0,0 +1,319 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""asyncio interface, for finding duplicates from within an event loop.
+
+Public functions:
+
+    index_dirs -- coroutine to index the files of directories by size
+    find_duplicates_in_dirs -- coroutine to find duplicates in directories
+    iter_duplicates_in_dirs -- async iterator over groups of duplicates
+
+Public data attributes:
+
+    MAX_IN_FLIGHT -- default limit of blocking calls running at once
+
+These are counterparts of the functions of the same names in
+capidup.finddups, that don't block the event loop. They share its crawl
+bookkeeping (capidup.finddups.TreeCrawl) and comparison stages
+(capidup.finddups.compare_stages), which run in the event loop. Only the
+blocking calls (listing directories, stat'ing and hashing files) are run
+in an executor, one directory or file per call, with up to max_in_flight
+calls running at once. By default, the event loop's default executor is
+used.
+
+Cancelling the task that awaits any of these stops the scan between
+directories or files: calls that haven't started yet are never run, and
+those running in the executor are left to finish on their own.
+
+Only the commonly used options of capidup.finddups are supported.
+
+This module needs Python 3.5 or later.
+
+"""
+
+import asyncio
+import collections
+
+from capidup import hashers
+from capidup import finddups
+from capidup.matcher import compile_excludes
+from capidup.hashers import DEFAULT_PARTIAL_HASH, DEFAULT_FULL_HASH
+
+
+__all__ = [ "index_dirs", "find_duplicates_in_dirs",
+        "iter_duplicates_in_dirs", "MAX_IN_FLIGHT" ]
+
+
+MAX_IN_FLIGHT = 64
+"""Default maximum number of blocking calls running in the executor."""
+
+
+async def _index_root(loop, executor, root, files_by_size, exclude_dirs,
+        exclude_files, follow_dirlinks, errors, hardlinks, min_size,
+        max_size, max_in_flight):
+    """Index the files under one root directory, by size.
+
+    Like capidup.finddups.index_files_by_size(), with each directory
+    listed in the executor. The bookkeeping is done here, by a
+    capidup.finddups.TreeCrawl, in the order the directories are found,
+    whatever order their listings finish in.
+
+    """
+    crawl = finddups.TreeCrawl(root, files_by_size, exclude_dirs,
+                               exclude_files, follow_dirlinks, errors,
+                               hardlinks, min_size, max_size)
+
+    try:
+        file_info = await loop.run_in_executor(executor, crawl.stat_root)
+    except OSError as e:
+        crawl.error(e)
+        return
+    crawl.start(file_info)
+
+    pending = collections.deque()
+
+    try:
+        while crawl.to_scan or pending:
+            while crawl.to_scan and len(pending) < max_in_flight:
+                curr_dir, args = crawl.next_scan()
+                pending.append((curr_dir, loop.run_in_executor(
+                    executor, crawl.scan_func, *args)))
+
+            curr_dir, future = pending.popleft()
+            crawl.add_listing(curr_dir, await future)
+    finally:
+        # on cancellation, don't leave listings behind that nobody awaits
+        for _, future in pending:
+            future.cancel()
+
+
+async def index_dirs(directories, exclude_dirs=None, exclude_files=None,
+        follow_dirlinks=False, errors=None, hardlinks=None, min_size=0,
+        max_size=None, executor=None, max_in_flight=MAX_IN_FLIGHT):
+    """Index the files of a list of directories by size.
+
+    The arguments are as in capidup.finddups.index_files_by_size(), and
+    errors (if not None) as in iter_duplicates_in_dirs(). Up to
+    max_in_flight directories are listed at once, in executor.
+
+    Returns the files_by_size index: a dictionary of lists of filenames,
+    indexed by file size.
+
+    """
+    if errors is None:
+        errors = []
+
+    loop = asyncio.get_event_loop()
+    exclude_dirs = compile_excludes(exclude_dirs)
+    exclude_files = compile_excludes(exclude_files)
+
+    files_by_size = {}
+    for directory in directories:
+        await _index_root(loop, executor, directory, files_by_size,
+                          exclude_dirs, exclude_files, follow_dirlinks,
+                          errors, hardlinks, min_size, max_size,
+                          max_in_flight)
+
+    return files_by_size
+
+
+async def _run_jobs(loop, executor, func, jobs, max_in_flight):
+    """Call func on the arguments of each job, in the executor.
+
+    jobs is a list of argument tuples. Up to max_in_flight calls are
+    running at once; the next one is only submitted when the oldest
+    finishes.
+
+    Returns the list of results, in the same order as jobs.
+
+    """
+    results = []
+    pending = collections.deque()
+
+    try:
+        for args in jobs:
+            pending.append(loop.run_in_executor(executor, func, *args))
+
+            if len(pending) >= max_in_flight:
+                results.append(await pending.popleft())
+
+        while pending:
+            results.append(await pending.popleft())
+    finally:
+        # on cancellation, don't leave calls behind that nobody awaits
+        for future in pending:
+            future.cancel()
+
+    return results
+
+
+async def _find_duplicates_in_groups(loop, executor, groups, partial_hash,
+        full_hash, digest_cache, errors, links, max_in_flight):
+    """Find duplicates within groups of files of the same size.
+
+    Like capidup.finddups.find_duplicates_in_groups(), with a single
+    partial stage and a full stage. The stages are those of
+    capidup.finddups.compare_stages(); only their hashing jobs are run
+    in the executor.
+
+    """
+    stages = finddups.compare_stages(groups, partial_hash, full_hash, False,
+                                     None, errors, links=links)
+
+    kind, jobs = next(stages)
+    while kind != "done":
+        results = await _run_jobs(
+            loop, executor, finddups.digest_or_error,
+            [job + (digest_cache,) for job in jobs], max_in_flight)
+        kind, jobs = stages.send(results)
+
+    stages.close()
+
+    return jobs
+
+
+class _DuplicateGroups(object):
+    """Async iterator over the groups of duplicates in directories.
+
+    See iter_duplicates_in_dirs().
+
+    """
+
+    def __init__(self, directories, exclude_dirs, exclude_files,
+            follow_dirlinks, errors, digest_cache, partial_hash, full_hash,
+            hardlinks, min_size, max_size, executor, max_in_flight):
+        self._index_args = (directories, exclude_dirs, exclude_files,
+                            follow_dirlinks, errors)
+        self._index_kwargs = dict(min_size=min_size, max_size=max_size,
+                                  executor=executor,
+                                  max_in_flight=max_in_flight)
+        self._errors = errors
+        self._digest_cache = digest_cache
+        self._partial_hash = partial_hash
+        self._full_hash = full_hash
+        self._hardlinks = hardlinks
+        self._executor = executor
+        self._max_in_flight = max_in_flight
+
+        self._batches = None
+        self._links = None
+        self._ready = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_event_loop()
+
+        if self._batches is None:
+            inodes = {}
+            files_by_size = await index_dirs(
+                *self._index_args, hardlinks=inodes, **self._index_kwargs)
+            if self._hardlinks == "include":
+                self._links = finddups.hardlink_links(inodes)
+            else:
+                self._links = {}
+            self._batches = finddups.iter_group_batches(
+                finddups.iter_size_groups(files_by_size, self._links),
+                finddups.MAX_PENDING_JOBS)
+
+        while not self._ready:
+            groups = next(self._batches, None)
+            if groups is None:
+                if self._digest_cache is not None:
+                    self._digest_cache.commit()
+                raise StopAsyncIteration
+
+            self._ready.extend(await _find_duplicates_in_groups(
+                loop, self._executor, groups, self._partial_hash,
+                self._full_hash, self._digest_cache, self._errors,
+                self._links, self._max_in_flight))
+
+        return self._ready.popleft()
+
+
+def iter_duplicates_in_dirs(directories, exclude_dirs=None,
+        exclude_files=None, follow_dirlinks=False, digest_cache=None,
+        partial_hash=DEFAULT_PARTIAL_HASH, full_hash=DEFAULT_FULL_HASH,
+        hardlinks="include", min_size=0, max_size=None, executor=None,
+        max_in_flight=MAX_IN_FLIGHT, errors=None):
+    """Recursively scan a list of directories, for use with ``async for``.
+
+    The arguments are as in capidup.finddups.iter_duplicates_in_dirs(),
+    and in the same order as in find_duplicates_in_dirs(). executor is
+    where the blocking calls are run (by default, the event loop's default
+    executor), with up to max_in_flight at once.
+
+    Returns an async iterator over the groups of duplicates (lists of
+    filenames). All directories are crawled before the first group is
+    found; after that, size groups are compared a batch at a time. For
+    example::
+
+        async for group in iter_duplicates_in_dirs(["/srv/data"]):
+            print(group)
+
+    """
+    if errors is None:
+        errors = []
+
+    hashers.check_algorithm(partial_hash)
+    hashers.check_algorithm(full_hash)
+    finddups.check_hardlinks_mode(hardlinks)
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be positive: %r"
+                         % (max_in_flight,))
+
+    return _DuplicateGroups(directories, exclude_dirs, exclude_files,
+                            follow_dirlinks, errors, digest_cache,
+                            partial_hash, full_hash, hardlinks, min_size,
+                            max_size, executor, max_in_flight)
+
+
+async def find_duplicates_in_dirs(directories, exclude_dirs=None,
+        exclude_files=None, follow_dirlinks=False, digest_cache=None,
+        partial_hash=DEFAULT_PARTIAL_HASH, full_hash=DEFAULT_FULL_HASH,
+        hardlinks="include", min_size=0, max_size=None, executor=None,
+        max_in_flight=MAX_IN_FLIGHT):
+    """Recursively scan a list of directories, looking for duplicate files.
+
+    The arguments are as in iter_duplicates_in_dirs().
+
+    Returns a 2-tuple ``(duplicate_groups, errors)``, like
+    capidup.finddups.find_duplicates_in_dirs().
+
+    """
+    errors = []
+    duplicates = []
+
+    async for group in iter_duplicates_in_dirs(
+            directories, exclude_dirs, exclude_files, follow_dirlinks,
+            digest_cache=digest_cache, partial_hash=partial_hash,
+            full_hash=full_hash, hardlinks=hardlinks, min_size=min_size,
+            max_size=max_size, executor=executor,
+            max_in_flight=max_in_flight, errors=errors):
+        duplicates.append(group)
+
+    return duplicates, errors
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
@@ -0,0 +1,185 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Scheduling of file reads with a separate queue for each device.
+
+Public classes:
+
+    DeviceScheduler -- run jobs on a thread pool per device
+
+When files on several devices are hashed from a single queue, the slowest
+device sets the pace for all of them: results are consumed in order, so
+jobs for a fast device can only get so far ahead of a slow one. With a
+queue per device, each device is kept busy on its own, with its own
+number of concurrent reads suited to it.
+
+The queues live as long as the scheduler. Jobs submitted with submit()
+join the queue of their device and run as soon as it has a free worker,
+whatever the caller is waiting for; the caller gets a future for each
+job, and can move on with the jobs that are done (see
+capidup.finddups.iter_stages_scheduled).
+
+"""
+
+import os
+import threading
+import time
+
+
+__all__ = [ "DeviceScheduler" ]
+
+
+class DeviceScheduler(object):
+    """Runs jobs on a separate thread pool for each device.
+
+    workers is the number of threads for each device. Use 1 for spinning
+    disks, where concurrent reads only add seeks, and more for SSDs and
+    network filesystems.
+
+    stats, if provided, should be a dictionary. Statistics of the jobs run
+    on each device are accumulated in it *in-place*, keyed by st_dev, as
+    dictionaries with the keys ``"files"`` (number of jobs), ``"bytes"``
+    (bytes read) and ``"seconds"`` (time spent with jobs in flight). Jobs
+    for files that can't be stat'ed are keyed by None.
+
+    result_bytes, if provided, is a function that gets the number of bytes
+    a job read from its result, for the ``"bytes"`` statistics. Without
+    it, bytes are not counted.
+
+    The scheduler must be shut down when no longer needed.
+
+    """
+
+    def __init__(self, workers, stats=None, result_bytes=None):
+        if workers < 1:
+            raise ValueError("workers must be at least 1: %r" % (workers,))
+
+        self.workers = workers
+        self.stats = stats if stats is not None else {}
+        self._result_bytes = result_bytes
+        self._executors = {}
+
+        # jobs submitted and not yet done, and since when, by device
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._busy_since = {}
+
+    def _executor(self, device):
+        """Get the thread pool of a device, creating it if needed."""
+
+        executor = self._executors.get(device)
+        if executor is None:
+            # import here: concurrent.futures needs the "futures" backport
+            # on Python 2, and is only required when using workers
+            from concurrent.futures import ThreadPoolExecutor
+
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._executors[device] = executor
+
+        return executor
+
+    @staticmethod
+    def device_of(filename):
+        """Get the device of a file, or None if it can't be stat'ed."""
+
+        try:
+            return os.stat(filename).st_dev
+        except OSError:
+            return None
+
+    def submit(self, device, func, *args):
+        """Queue a call of func(*args) on the thread pool of a device.
+
+        Returns a concurrent.futures.Future for the call.
+
+        """
+        with self._lock:
+            dev_stats = self.stats.setdefault(
+                device, {"files": 0, "bytes": 0, "seconds": 0.0})
+            dev_stats["files"] += 1
+
+            if not self._pending.get(device):
+                self._busy_since[device] = time.time()
+            self._pending[device] = self._pending.get(device, 0) + 1
+
+        future = self._executor(device).submit(func, *args)
+        future.add_done_callback(lambda f: self._job_done(device, f))
+
+        return future
+
+    def _job_done(self, device, future):
+        """Account for a finished job of a device."""
+
+        with self._lock:
+            dev_stats = self.stats[device]
+
+            if (self._result_bytes is not None and not future.cancelled()
+                    and future.exception() is None):
+                dev_stats["bytes"] += self._result_bytes(future.result())
+
+            self._pending[device] -= 1
+            if not self._pending[device]:
+                # this device is idle
+                dev_stats["seconds"] += (time.time()
+                                         - self._busy_since[device])
+
+    def has_room(self, max_pending):
+        """Check whether more jobs should be submitted.
+
+        True unless some device has max_pending or more jobs not yet done.
+        The devices of the next jobs are not known in advance, so jobs are
+        taken until the queue of the slowest device is full: that bounds
+        the memory held by the queues, while the faster devices go ahead.
+
+        """
+        with self._lock:
+            return all(n < max_pending for n in self._pending.values())
+
+    def map(self, func, devices, *iterables):
+        """Map a function over lists of arguments, a queue per device.
+
+        devices is a list with the device of each job. iterables are lists
+        with the arguments of func, as for map(). All jobs are submitted at
+        once, with submit().
+
+        Returns a list of the results, in the same order as the arguments.
+        Exceptions raised by func are propagated.
+
+        """
+        futures = [self.submit(device, func, *args)
+                   for device, args in zip(devices, zip(*iterables))]
+
+        try:
+            return [future.result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def shutdown(self):
+        """Shut down the thread pools of all devices."""
+
+        for executor in self._executors.values():
+            executor.shutdown()
+        self._executors = {}
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
@@ -0,0 +1,313 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Persistent on-disk cache of file digests.
+
+Public classes:
+
+    DigestCache -- SQLite-backed cache of partial and full file digests
+
+A cache entry is identified by the file's device and inode numbers, by
+the region of the file that was hashed (offset and length) and by the
+hash algorithm. It is only considered valid while the file's size,
+modification time and change time are the same as when the digest was
+stored. Any write to the file (or a chmod, rename, etc.) updates the
+change time, so a stale digest is never returned. Digests of files
+modified too recently are not stored at all; see RACY_INTERVAL.
+
+"""
+
+import sqlite3
+import threading
+import time
+
+
+__all__ = [ "DigestCache" ]
+
+
+CACHE_SCHEMA_VERSION = 3
+"""Version of the on-disk cache format.
+
+A cache file with a different version is discarded and recreated. The
+cache only holds derived data, so nothing is lost by doing so.
+"""
+
+RACY_INTERVAL = 2.0
+"""Files modified less than this many seconds ago are not cached.
+
+A file written right after being hashed might keep the same timestamps,
+on filesystems with coarse timestamps. Its cache entry would look valid,
+while holding the digest of the old contents.
+"""
+
+COMMIT_INTERVAL = 1000
+"""Number of cache writes between implicit commits."""
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    st_dev INTEGER NOT NULL,
+    st_ino INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    digest BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (st_dev, st_ino, offset, length, algorithm)
+)
+"""
+
+_WHERE_KEY = (" WHERE st_dev = ? AND st_ino = ? AND offset = ? AND length = ?"
+              " AND algorithm = ?")
+
+
+def _to_sqlite_int(n):
+    """Map an unsigned 64-bit integer to SQLite's signed INTEGER range."""
+
+    if n >= 1 << 63:
+        n -= 1 << 64
+    return n
+
+
+def _time_ns(file_info, name):
+    """Get a timestamp from a stat result, in integer nanoseconds.
+
+    name is either 'mtime' or 'ctime'. Python versions before 3.3 don't
+    have st_mtime_ns and st_ctime_ns; fall back to the float timestamps.
+
+    """
+    value = getattr(file_info, "st_%s_ns" % name, None)
+    if value is None:   # pragma: no cover
+        value = int(getattr(file_info, "st_%s" % name) * 1000000000)
+    return value
+
+
+def stat_key(file_info):
+    """Get the identifying tuple of a file, from its stat result.
+
+    Returns a tuple (st_dev, st_ino, size, mtime_ns, ctime_ns).
+
+    """
+    return (file_info.st_dev, file_info.st_ino, file_info.st_size,
+            _time_ns(file_info, "mtime"), _time_ns(file_info, "ctime"))
+
+
+class DigestCache(object):
+    """Persistent cache of file digests.
+
+    path is the filename of the SQLite database. It is created if it does
+    not exist. The special name ``":memory:"`` gives a non-persistent
+    cache, mostly useful for testing.
+
+    The cache keeps count of lookups in its `hits` and `misses`
+    attributes. Entries are evicted automatically when they are found to
+    be stale (the file was modified since it was hashed); entries for
+    files that no longer exist can be removed with `evict_unused`.
+
+    A DigestCache may be shared between threads. It may be used as a
+    context manager, in which case it is closed on exit.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        # mark of the current session; every entry used or stored from now
+        # on will have last_used >= this value
+        self._session_start = time.time()
+        self._pending_writes = 0
+        # keys of entries hit since the last flush, whose last_used is
+        # still from a previous session
+        self._used = set()
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._setup_schema()
+
+    def _setup_schema(self):
+        """Create the cache table, discarding any incompatible one."""
+
+        cur = self._conn.cursor()
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        if version != CACHE_SCHEMA_VERSION:
+            cur.execute("DROP TABLE IF EXISTS digests")
+            cur.execute("PRAGMA user_version = %d" % CACHE_SCHEMA_VERSION)
+        cur.execute(_SCHEMA)
+        self._conn.commit()
+
+    def _flush_used(self):
+        """Mark the entries hit since the last flush as used.
+
+        Must be called with the lock held.
+
+        """
+        if self._used:
+            now = time.time()
+            self._conn.executemany(
+                "UPDATE digests SET last_used = ?" + _WHERE_KEY,
+                [(now,) + key for key in self._used])
+            self._used.clear()
+
+    def _commit(self):
+        """Flush pending updates and commit.
+
+        Must be called with the lock held.
+
+        """
+        self._flush_used()
+        self._conn.commit()
+        self._pending_writes = 0
+
+    def _wrote(self):
+        """Account for a write, committing every COMMIT_INTERVAL writes.
+
+        Must be called with the lock held.
+
+        """
+        self._pending_writes += 1
+        if self._pending_writes >= COMMIT_INTERVAL:
+            self._commit()
+
+    def get(self, file_info, length, algorithm="md5", offset=0):
+        """Look up the digest of length bytes of a file, from offset.
+
+        file_info is the file's current stat result. algorithm is the name
+        of the hash algorithm.
+
+        Returns the stored digest, or None if there is no valid entry. An
+        entry for the same inode whose size or timestamps don't match
+        file_info is stale, and is evicted.
+
+        """
+        dev, ino, size, mtime_ns, ctime_ns = stat_key(file_info)
+        key = (_to_sqlite_int(dev), _to_sqlite_int(ino), offset, length,
+               algorithm)
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, ctime_ns, digest, last_used"
+                " FROM digests"
+                + _WHERE_KEY, key).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            if tuple(row[:3]) != (size, mtime_ns, ctime_ns):
+                # file changed since it was hashed
+                self._conn.execute(
+                    "DELETE FROM digests" + _WHERE_KEY, key)
+                self._wrote()
+                self.evicted += 1
+                self.misses += 1
+                return None
+
+            if row[4] < self._session_start:
+                # batch the update, instead of a write on every hit
+                self._used.add(key)
+                if len(self._used) >= COMMIT_INTERVAL:
+                    self._flush_used()
+            self.hits += 1
+
+            return bytes(row[3])
+
+    def put(self, file_info, length, digest, algorithm="md5", offset=0):
+        """Store the digest of length bytes of a file, from offset.
+
+        file_info should be the stat result of the file from *before* it
+        was read, so that a concurrent modification is caught on the next
+        lookup instead of being cached. Files modified too recently are
+        not stored; see RACY_INTERVAL.
+
+        """
+        dev, ino, size, mtime_ns, ctime_ns = stat_key(file_info)
+        if mtime_ns / 1e9 > time.time() - RACY_INTERVAL:
+            return
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO digests"
+                " (st_dev, st_ino, offset, length, algorithm, size, mtime_ns,"
+                "  ctime_ns, digest, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (_to_sqlite_int(dev), _to_sqlite_int(ino), offset, length,
+                 algorithm, size, mtime_ns, ctime_ns, sqlite3.Binary(digest),
+                 time.time()))
+            self._wrote()
+
+    def evict_unused(self):
+        """Remove all entries not used or stored since the cache was opened.
+
+        Call this after a complete scan of the same trees, to get rid of
+        entries for files that were deleted or are no longer included.
+
+        Returns the number of evicted entries.
+
+        """
+        return self.evict_older_than(self._session_start)
+
+    def evict_older_than(self, timestamp):
+        """Remove all entries last used before the given Unix timestamp.
+
+        Returns the number of evicted entries.
+
+        """
+        with self._lock:
+            self._flush_used()
+            cur = self._conn.execute(
+                "DELETE FROM digests WHERE last_used < ?", (timestamp,))
+            self._commit()
+
+        self.evicted += cur.rowcount
+        return cur.rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM digests").fetchone()[0]
+
+    def commit(self):
+        """Write any pending changes to disk."""
+
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        """Commit pending changes and close the cache."""
+
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
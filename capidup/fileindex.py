@@ -0,0 +1,268 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Compact index of files by size, for very large scans.
+
+Public classes:
+
+    CompactFileIndex -- memory-efficient replacement for files_by_size
+
+The usual files_by_size index is a dictionary of lists of full paths.
+Each path is a separate string, repeating the name of its directory,
+which takes a lot of memory when indexing hundreds of millions of files.
+
+CompactFileIndex stores each directory name once, in a table, and each
+file as an entry in array-typed columns: its directory, the end of its
+base name in a single buffer of encoded names, its size, its inode and
+the previous entry of the same size. Full paths are only built when the
+files of a size group are requested; sizes with a single file can be
+counted and removed without ever building its path.
+
+"""
+
+import array
+import os
+import sys
+
+
+__all__ = [ "CompactFileIndex" ]
+
+
+def _array_type(*typecodes):
+    """Get the first typecode supported by the array module."""
+
+    for typecode in typecodes:
+        try:
+            array.array(typecode)
+            return typecode
+        except ValueError:  # pragma: no cover
+            pass
+
+    raise ValueError("no supported typecode in %r" % (typecodes,))
+
+
+# 64-bit where possible; "q" and "Q" are Python 3.3+
+_SIGNED = _array_type("q", "l")
+_UNSIGNED = _array_type("Q", "L")
+_DIR_ID = _array_type("I", "L")
+
+if sys.version_info >= (3,):
+    _NAME_ERRORS = "surrogateescape"
+else:                   # pragma: no cover
+    _NAME_ERRORS = "strict"
+
+
+class CompactFileIndex(object):
+    """Memory-efficient index of files by size.
+
+    This can be used instead of a files_by_size dictionary, with
+    capidup.finddups.index_files_by_size(). It supports the read-only
+    dictionary operations (getting the list of paths of a size, iterating
+    over sizes or items, len() and so on), del, pop() and popitem().
+    Lists of paths are built when requested, and not kept.
+
+    Sizes are iterated in the order they were first added. Removing a size
+    with del, pop() or popitem() doesn't free the memory used by its entries.
+
+    """
+
+    def __init__(self):
+        self._dirs = []
+        self._dir_ids = {}
+
+        self._entry_dir = array.array(_DIR_ID)
+        self._name_end = array.array(_UNSIGNED)
+        self._names = bytearray()
+        self._sizes = array.array(_SIGNED)
+        self._inodes = array.array(_UNSIGNED)
+        self._prev_same_size = array.array(_SIGNED)
+
+        # last entry of each size, in the order sizes were first added
+        self._last_by_size = {}
+        self._size_order = []
+
+    def add_file(self, size, dirpath, name, inode=0):
+        """Add a file to the index.
+
+        dirpath is the path of its directory, and name its base name; the
+        full path is os.path.join(dirpath, name). Returns the id of the
+        new entry.
+
+        """
+        dir_id = self._dir_ids.get(dirpath)
+        if dir_id is None:
+            dir_id = len(self._dirs)
+            self._dirs.append(dirpath)
+            self._dir_ids[dirpath] = dir_id
+
+        if not isinstance(name, bytes):
+            name = name.encode("utf-8", _NAME_ERRORS)
+
+        entry = len(self._sizes)
+
+        self._entry_dir.append(dir_id)
+        self._names += name
+        self._name_end.append(len(self._names))
+        self._sizes.append(size)
+        self._inodes.append(inode)
+
+        prev = self._last_by_size.get(size)
+        if prev is None:
+            prev = -1
+            self._size_order.append(size)
+        self._prev_same_size.append(prev)
+        self._last_by_size[size] = entry
+
+        return entry
+
+    def path(self, entry):
+        """Get the full path of an entry."""
+
+        start = self._name_end[entry - 1] if entry else 0
+        name = bytes(self._names[start:self._name_end[entry]])
+
+        dirpath = self._dirs[self._entry_dir[entry]]
+        if not isinstance(dirpath, bytes):
+            name = name.decode("utf-8", _NAME_ERRORS)
+
+        return os.path.join(dirpath, name)
+
+    def inode(self, entry):
+        """Get the inode number of an entry, or 0 if unknown."""
+
+        return self._inodes[entry]
+
+    def entries(self, size):
+        """Get the ids of the entries of a size, in the order added.
+
+        Raises KeyError if there are none.
+
+        """
+        entries = []
+
+        entry = self._last_by_size[size]
+        while entry >= 0:
+            entries.append(entry)
+            entry = self._prev_same_size[entry]
+
+        entries.reverse()
+        return entries
+
+    def count(self, size):
+        """Get the number of files of a size, without building their paths.
+
+        Raises KeyError if there are none.
+
+        """
+        count = 0
+
+        entry = self._last_by_size[size]
+        while entry >= 0:
+            count += 1
+            entry = self._prev_same_size[entry]
+
+        return count
+
+    def num_files(self):
+        """Get the number of files added to the index."""
+
+        return len(self._sizes)
+
+    def __getitem__(self, size):
+        return [self.path(entry) for entry in self.entries(size)]
+
+    def get(self, size, default=None):
+        """Get the list of paths of a size, or default if there are none."""
+
+        if size not in self._last_by_size:
+            return default
+        return self[size]
+
+    def __contains__(self, size):
+        return size in self._last_by_size
+
+    def __len__(self):
+        return len(self._last_by_size)
+
+    def __bool__(self):
+        return bool(self._last_by_size)
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        """Get an iterator over the sizes in the index."""
+
+        for size in self._size_order:
+            if size in self._last_by_size:
+                yield size
+
+    def iteritems(self):
+        """Get an iterator over ``(size, paths)`` items.
+
+        The list of paths of each size is only built when it is reached.
+
+        """
+        for size in self.iterkeys():
+            yield size, self[size]
+
+    def itervalues(self):
+        """Get an iterator over the lists of paths of each size."""
+
+        for _, paths in self.iteritems():
+            yield paths
+
+    keys = iterkeys
+    items = iteritems
+    values = itervalues
+
+    def __delitem__(self, size):
+        del self._last_by_size[size]
+
+    def pop(self, size):
+        """Remove a size from the index, and return its list of paths.
+
+        Raises KeyError if there are no files of that size.
+
+        """
+        paths = self[size]
+        del self._last_by_size[size]
+
+        return paths
+
+    def popitem(self):
+        """Remove a size from the index, and return ``(size, paths)``.
+
+        Raises KeyError if the index is empty.
+
+        """
+        while self._size_order:
+            size = self._size_order.pop()
+            if size in self._last_by_size:
+                return size, self.pop(size)
+
+        raise KeyError("popitem(): index is empty")
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
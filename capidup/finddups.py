@@ -26,6 +26,8 @@ Public functions:
 
     find_duplicates -- find duplicates in a list of files
     find_duplicates_in_dirs -- find duplicates in a list of directories
+    iter_duplicates -- generator version of find_duplicates
+    iter_duplicates_in_dirs -- generator version of find_duplicates_in_dirs
 
 Public data attributes:
 
@@ -34,22 +36,39 @@ Public data attributes:
     PARTIAL_MD5_READ_MULT -- partial read size must be a multiple of this
     PARTIAL_MD5_READ_RATIO -- how much (1/n) of a file to read in partial read
     PARTIAL_MD5_THRESHOLD -- file size above which a partial read is done
+    PROGRESSIVE_PARTIAL_SCHEDULE -- suggested schedule of partial reads
+    SAMPLE_BLOCK_SIZE -- size of each block read by the sampling stage
+    PROCESS_BATCH_BYTES -- bytes to compare per batch, in worker processes
 
 """
 
 import sys
 import os
-import stat
-import hashlib
 import fnmatch
 import errno
+import collections
+import time
 
 from capidup import py3compat
-
-
-__all__ = [ "find_duplicates", "find_duplicates_in_dirs", "MD5_CHUNK_SIZE",
+from capidup import hashers
+from capidup import readers
+from capidup import ioorder
+from capidup.devsched import DeviceScheduler
+from capidup.matcher import compile_excludes
+from capidup.fileindex import CompactFileIndex
+from capidup.spillindex import SpillingFileIndex
+from capidup.snapshot import dir_stamp
+from capidup.scanstats import ScanStats
+from capidup.lockstep import split_group_lockstep, LOCKSTEP_MAX_OPEN_FILES
+from capidup.hashers import DEFAULT_PARTIAL_HASH, DEFAULT_FULL_HASH
+
+
+__all__ = [ "find_duplicates", "find_duplicates_in_dirs", "iter_duplicates",
+        "iter_duplicates_in_dirs", "MD5_CHUNK_SIZE",
         "PARTIAL_MD5_READ_MULT", "PARTIAL_MD5_THRESHOLD",
-        "PARTIAL_MD5_MAX_READ", "PARTIAL_MD5_READ_RATIO" ]
+        "PARTIAL_MD5_MAX_READ", "PARTIAL_MD5_READ_RATIO",
+        "PROGRESSIVE_PARTIAL_SCHEDULE", "SAMPLE_BLOCK_SIZE",
+        "PROCESS_BATCH_BYTES" ]
 
 
 MD5_CHUNK_SIZE = 512 * 1024
@@ -74,6 +93,26 @@ PARTIAL_MD5_MAX_READ = 16 * PARTIAL_MD5_READ_MULT
 PARTIAL_MD5_READ_RATIO = 4
 """Partial reads of 1/n of the file size (below `PARTIAL_MD5_MAX_READ`)."""
 
+PROGRESSIVE_PARTIAL_SCHEDULE = (4 * 1024, 64 * 1024, 1024 * 1024,
+                                16 * 1024 * 1024)
+"""Suggested partial read schedule for large files, in bytes.
+
+Can be passed as `partial_schedule` to :func:`find_duplicates_in_dirs`.
+"""
+
+SAMPLE_BLOCK_SIZE = 4 * PARTIAL_MD5_READ_MULT
+"""Size in bytes of each block read by the sampling stage."""
+
+MAX_PENDING_JOBS = 1024
+"""Maximum number of hashing jobs queued on an executor at any time."""
+
+PROCESS_BATCH_BYTES = 256 * 1024 * 1024
+"""Estimated bytes to compare in each batch sent to a worker process.
+
+The estimate is the total size of the files in the batch. A batch is also
+closed at MAX_PENDING_JOBS files, and always holds whole size groups.
+"""
+
 
 
 def round_up_to_mult(n, mult):
@@ -95,202 +134,995 @@ def should_be_excluded(name, exclude_patterns):
     return False
 
 
-def prune_names(names, exclude_patterns):
-    """Prune subdirs or files from an index crawl.
+def add_to_index(files_by_size, size, full_path):
+    """Add a file to a dictionary of lists of filenames, indexed by size."""
+
+    if size in files_by_size:
+        # append to the list of files with the same size
+        files_by_size[size].append(full_path)
+    else:
+        # start a new list for this file size
+        files_by_size[size] = [full_path]
+
 
-    This is used to control the search performed by os.walk() in
-    index_files_by_size().
+def relative_dir(root, path):
+    """Get the path of a directory under root, relative to root.
 
-    names is the list of file or subdir names, to be pruned as per the
-    exclude_patterns list.
+    path must have been made by joining components to root. The result
+    is text, even for bytes paths, as it is only used to match patterns.
+    It uses "/" as the separator, and is "" for root itself.
 
-    Returns a new (possibly pruned) names list.
+    """
+    rel_dir = py3compat.fsdecode(path[len(root):]).lstrip(os.sep)
+    if os.sep != "/":   # pragma: no cover
+        rel_dir = rel_dir.replace(os.sep, "/")
+
+    return rel_dir
+
+
+def scan_dir(curr_dir, exclude_dirs, exclude_files, follow_dirlinks,
+        rel_dir="", min_size=0, max_size=None, file_filter=None):
+    """List the contents of one directory, for index_files_by_size().
+
+    exclude_dirs and exclude_files are capidup.matcher.ExcludeMatcher
+    instances. rel_dir is the path of curr_dir relative to the root of the
+    scan, for matching path patterns.
+
+    Files smaller than min_size, larger than max_size (if not None) or
+    rejected by file_filter (if not None) are left out. file_filter is
+    called as ``file_filter(path, stat_result)``, and should return True
+    to keep the file.
+
+    This does all the system calls needed for a directory, so that it can
+    run in a worker thread. It has no side effects.
+
+    The directory is listed with scandir(), and the file type of each entry
+    is taken from the listing itself where the OS provides it. Excluded
+    names are pruned before anything else, so they cost no system calls.
+    Every other subdirectory or regular file is stat'ed exactly once:
+    that gives the size of files, and the (st_dev, st_ino) of subdirs for
+    loop detection and of files with several hard links. Where scandir()
+    gives no inode numbers (e.g. on Windows), subdirectories are stat'ed
+    again by path to get them.
+
+    Symbolic links to subdirectories are only included if follow_dirlinks
+    is True; other symbolic links and special files are never included.
+
+    Returns a tuple ``(subdirs, files, errors, pruned)``. subdirs is a
+    list of ``(name, (st_dev, st_ino))`` tuples. files is a list of
+    ``(name, size, inode, dev_inode)`` tuples, where dev_inode is
+    ``(st_dev, st_ino)`` if the file has more than one hard link, or None
+    otherwise. errors is a list of OSError instances. pruned is a tuple
+    ``(excluded_dirs, excluded_files, filtered_files)``, with the number
+    of subdirectories and files left out by the exclude patterns, and of
+    files left out by size or by file_filter.
 
     """
-    return [x for x in names if not should_be_excluded(x, exclude_patterns)]
+    subdirs = []
+    files = []
+    errors = []
+    excluded_dirs = excluded_files = filtered_files = 0
+
+    try:
+        entries = list(py3compat.scandir(curr_dir))
+    except OSError as e:
+        errors.append(e)
+        return subdirs, files, errors, (0, 0, 0)
 
+    for entry in entries:
+        # avoid race condition: file can be deleted between scandir()
+        # seeing it and us calling stat()
+        try:
+            if entry.is_dir(follow_symlinks=follow_dirlinks):
+                if exclude_dirs.match(entry.name, rel_dir):
+                    excluded_dirs += 1
+                    continue
+
+                file_info = entry.stat(follow_symlinks=follow_dirlinks)
+                if not file_info.st_ino:
+                    # no inode from scandir(); every subdir would look
+                    # like the first one, and be taken for a loop
+                    if follow_dirlinks:
+                        file_info = os.stat(entry.path)
+                    else:
+                        file_info = os.lstat(entry.path)
+                subdirs.append((entry.name,
+                                (file_info.st_dev, file_info.st_ino)))
 
-def filter_visited(curr_dir, subdirs, already_visited, follow_dirlinks, on_error):
-    """Filter subdirs that have already been visited.
+            # only want regular files, not symlinks
+            elif entry.is_file(follow_symlinks=False):
+                if exclude_files.match(entry.name, rel_dir):
+                    excluded_files += 1
+                    continue
 
-    This is used to avoid loops in the search performed by os.walk() in
-    index_files_by_size.
+                file_info = entry.stat(follow_symlinks=False)
 
-    curr_dir is the path of the current directory, as returned by os.walk().
+                size = file_info.st_size
+                if size < min_size or (max_size is not None
+                                       and size > max_size):
+                    filtered_files += 1
+                    continue
+
+                if (file_filter is not None
+                        and not file_filter(entry.path, file_info)):
+                    filtered_files += 1
+                    continue
+
+                # some platforms don't give inode numbers from scandir()
+                if file_info.st_nlink > 1 and file_info.st_ino:
+                    dev_inode = (file_info.st_dev, file_info.st_ino)
+                else:
+                    dev_inode = None
 
-    subdirs is the list of subdirectories for the current directory, as
-    returned by os.walk().
+                files.append((entry.name, size, file_info.st_ino,
+                              dev_inode))
 
-    already_visited is a set of tuples (st_dev, st_ino) of already
-    visited directories. This set will not be modified.
+        except OSError as e:
+            errors.append(e)
 
-    on error is a function f(OSError) -> None, to be called in case of
-    error.
+    pruned = (excluded_dirs, excluded_files, filtered_files)
 
-    Returns a tuple: the new (possibly filtered) subdirs list, and a new
-    set of already visited directories, now including the subdirs.
+    return subdirs, files, errors, pruned
 
-    """
-    filtered = []
-    to_visit = set()
-    _already_visited = already_visited.copy()
 
+def scan_dir_cached(snapshot, curr_dir, exclude_dirs, exclude_files,
+        follow_dirlinks, rel_dir="", min_size=0, max_size=None):
+    """List the contents of one directory, through a snapshot.
+
+    snapshot is a capidup.snapshot.DirSnapshot. The directory is stat'ed,
+    and its stored listing used if it is still valid. Otherwise, it is
+    listed with scan_dir(), which see for the other arguments and the
+    return value; and the listing is stored, unless there were errors.
+
+    Like scan_dir(), this can run in a worker thread.
+
+    """
     try:
-        # mark the current directory as visited, so we catch symlinks to it
-        # immediately instead of after one iteration of the directory loop
-        file_info = os.stat(curr_dir) if follow_dirlinks else os.lstat(curr_dir)
-        _already_visited.add((file_info.st_dev, file_info.st_ino))
-    except OSError as e:
-        on_error(e)
+        if follow_dirlinks:
+            file_info = os.stat(curr_dir)
+        else:
+            file_info = os.lstat(curr_dir)
+    except OSError:
+        # let scan_dir() report the error
+        file_info = None
 
-    for subdir in subdirs:
-        full_path = os.path.join(curr_dir, subdir)
-        try:
-            file_info = os.stat(full_path) if follow_dirlinks else os.lstat(full_path)
-        except OSError as e:
-            on_error(e)
-            continue
+    if file_info is not None:
+        stamp = dir_stamp(file_info, rel_dir)
+        listing = snapshot.get(curr_dir, stamp)
+        if listing is not None:
+            subdirs, files, pruned = listing
+            return subdirs, files, [], pruned
 
-        if not follow_dirlinks and stat.S_ISLNK(file_info.st_mode):
-            # following links to dirs is disabled, ignore this one
-            continue
+    subdirs, files, errors, pruned = scan_dir(curr_dir, exclude_dirs,
+                                              exclude_files, follow_dirlinks,
+                                              rel_dir, min_size, max_size)
+
+    if file_info is not None and not errors:
+        snapshot.put(curr_dir, stamp, subdirs, files, pruned)
+
+    return subdirs, files, errors, pruned
+
+
+def check_snapshot_options(snapshot, file_filter):
+    """Validate the use of a directory snapshot.
+
+    Raises ValueError if both a snapshot and a file_filter are given: the
+    filter may depend on anything, so its results can't be stored.
+
+    """
+    if snapshot is not None and file_filter is not None:
+        raise ValueError("snapshot and file_filter are mutually exclusive")
+
+
+class TreeCrawl(object):
+    """State of a breadth-first crawl of one root directory.
+
+    This does the bookkeeping of index_files_by_size(), without any I/O:
+    the caller does the system calls (stat_root() and the listings from
+    next_scan()), in whatever threads it likes, and hands the listings
+    back with add_listing(), in the order the directories were found.
+    capidup.aio drives it from an event loop.
 
-        dev_inode = (file_info.st_dev, file_info.st_ino)
-        if dev_inode not in _already_visited:
-            filtered.append(subdir)
-            to_visit.add(dev_inode)
+    The arguments are as in index_files_by_size(). Error messages are
+    printed to stderr and appended *in-place* to the errors list. The
+    directories waiting to be listed are in `to_scan`.
+
+    """
+
+    def __init__(self, root, files_by_size, exclude_dirs, exclude_files,
+            follow_dirlinks, errors, hardlinks=None, min_size=0,
+            max_size=None, file_filter=None, snapshot=None, stats=None):
+        self.root = root
+        self.files_by_size = files_by_size
+        self.errors = errors
+        self.to_scan = collections.deque()
+
+        # XXX: The actual root may be matched by the exclude pattern.
+        # Should we prune it as well?
+
+        # compile once, rather than matching each pattern against each name
+        self._exclude_dirs = compile_excludes(exclude_dirs)
+        self._exclude_files = compile_excludes(exclude_files)
+        self._path_rules = (self._exclude_dirs.has_path_rules
+                            or self._exclude_files.has_path_rules)
+        self._follow_dirlinks = follow_dirlinks
+        self._hardlinks = hardlinks
+        self._min_size = min_size
+        self._max_size = max_size
+        self._file_filter = file_filter
+        self._stats = stats
+        self._already_visited = set()
+
+        if snapshot is not None:
+            # stored listings depend on all of these
+            snapshot.use_settings([self._exclude_dirs.patterns,
+                                   self._exclude_files.patterns,
+                                   follow_dirlinks, min_size, max_size])
+            self.scan_func = lambda *args: scan_dir_cached(snapshot, *args)
         else:
-            on_error(OSError(errno.ELOOP, "directory loop detected", full_path))
+            self.scan_func = scan_dir
+
+        # CompactFileIndex and SpillingFileIndex take the directory and
+        # base name separately
+        self._by_parts = hasattr(files_by_size, "add_file")
+
+    def error(self, error):
+        """Print a listing error to stderr, and record it.
+
+        error should be an os.OSError instance.
+
+        """
+        msg = "error listing '%s': %s" % (error.filename, error.strerror)
+        sys.stderr.write("%s\n" % msg)
+        self.errors.append(msg)
+
+    def stat_root(self):
+        """Get the stat result of the root. Raises OSError on failure."""
+
+        if self._follow_dirlinks:
+            return os.stat(self.root)
+
+        return os.lstat(self.root)
+
+    def start(self, file_info):
+        """Start the crawl, given the stat result of the root."""
+
+        # mark the root as visited, so we catch symlinks to it immediately
+        # instead of after one iteration of the directory loop; subdirs
+        # are marked as they are found, from their scandir() stat
+        self._already_visited.add((file_info.st_dev, file_info.st_ino))
+        self.to_scan.append(self.root)
+
+    def next_scan(self):
+        """Take the next directory to list.
+
+        Returns a 2-tuple ``(curr_dir, args)``: the listing is got by
+        calling ``scan_func(*args)``.
+
+        """
+        curr_dir = self.to_scan.popleft()
+        rel_dir = relative_dir(self.root, curr_dir) if self._path_rules else ""
 
-    return filtered, _already_visited.union(to_visit)
+        # scan_dir_cached() doesn't take a file_filter, which is always
+        # None with a snapshot
+        args = (curr_dir, self._exclude_dirs, self._exclude_files,
+                self._follow_dirlinks, rel_dir, self._min_size,
+                self._max_size)
+        if self._file_filter is not None:
+            args += (self._file_filter,)
+
+        return curr_dir, args
+
+    def add_listing(self, curr_dir, listing):
+        """Index the listing of a directory, from scan_func.
+
+        Its subdirectories are added to to_scan.
+
+        """
+        subdirs, files, scan_errors, pruned = listing
+
+        for e in scan_errors:
+            self.error(e)
+
+        if self._stats is not None:
+            self._stats.add_dir(len(files), pruned)
+
+        # skip subdirs that have already been visited; loops can happen
+        # if there's a symlink loop and follow_dirlinks==True, or if
+        # there's a hardlink loop (which is usually a corrupted
+        # filesystem)
+        for subdir, dev_inode in subdirs:
+            full_path = os.path.join(curr_dir, subdir)
+
+            if dev_inode not in self._already_visited:
+                self._already_visited.add(dev_inode)
+                self.to_scan.append(full_path)
+            else:
+                self.error(OSError(errno.ELOOP, "directory loop detected",
+                                   full_path))
+
+        hardlinks = self._hardlinks
+        for base_filename, size, inode, dev_inode in files:
+            if hardlinks is not None and dev_inode is not None:
+                full_path = os.path.join(curr_dir, base_filename)
+
+                if dev_inode in hardlinks:
+                    # another link to a file we already indexed
+                    hardlinks[dev_inode].append(full_path)
+                    continue
+                hardlinks[dev_inode] = [full_path]
+
+            if self._by_parts:
+                # don't build the full path here; a CompactFileIndex
+                # stores the directory only once
+                self.files_by_size.add_file(size, curr_dir, base_filename,
+                                            inode)
+            else:
+                add_to_index(self.files_by_size, size,
+                             os.path.join(curr_dir, base_filename))
 
 
 def index_files_by_size(root, files_by_size, exclude_dirs, exclude_files,
-        follow_dirlinks):
+        follow_dirlinks, workers=None, executor=None, hardlinks=None,
+        min_size=0, max_size=None, file_filter=None, snapshot=None,
+        stats=None):
     """Recursively index files under a root directory.
 
     Each regular file is added *in-place* to the files_by_size dictionary,
     according to the file size. This is a (possibly empty) dictionary of
-    lists of filenames, indexed by file size.
+    lists of filenames, indexed by file size, or a
+    capidup.fileindex.CompactFileIndex or
+    capidup.spillindex.SpillingFileIndex.
 
     exclude_dirs is a list of glob patterns to exclude directories.
-    exclude_files is a list of glob patterns to exclude files.
+    exclude_files is a list of glob patterns to exclude files. Patterns
+    with a slash are matched against the path relative to root, like in
+    gitignore; see capidup.matcher. Either may also be an already compiled
+    capidup.matcher.ExcludeMatcher.
 
     follow_dirlinks controls whether to follow symbolic links to
     subdirectories while crawling.
 
-    Returns True if there were any I/O errors while listing directories.
+    workers, if greater than 1, is the number of threads used to list
+    directories concurrently. Alternatively, an existing
+    concurrent.futures.Executor may be passed as executor. This helps on
+    network filesystems, where each directory listing is a round trip.
+    The same files are indexed, in the same order, either way.
+
+    hardlinks, if provided, should be a dictionary. Each file with more
+    than one hard link is then indexed only once, under the first path it
+    is found at. All of its paths are recorded *in-place* in hardlinks, as
+    ``hardlinks[(st_dev, st_ino)] = [first_path, other_path, ...]``. The
+    same dictionary should be passed when indexing several roots.
+
+    Files smaller than min_size bytes, or larger than max_size bytes (if
+    not None), are not indexed. Neither are files for which file_filter
+    (if not None) returns False; it is called with the path of each file
+    and its stat result, possibly from several worker threads at once.
+    Rejected files are never opened.
+
+    snapshot, if provided, should be a capidup.snapshot.DirSnapshot.
+    Directories that haven't changed since they were stored in it are not
+    listed again; see scan_dir_cached(). It can't be combined with
+    file_filter. The sizes of files in unchanged directories are as
+    stored, and may be out of date.
+
+    stats, if provided, should be a capidup.scanstats.ScanStats. The
+    directories listed, and the files indexed or left out, are counted in
+    it *in-place*.
 
     Returns a list of error messages that occurred. If empty, there were no
     errors.
 
     """
-    # encapsulate the value in a list, so we can modify it by reference
-    # inside the auxiliary function
+    check_snapshot_options(snapshot, file_filter)
+
     errors = []
-    already_visited = set()
+    crawl = TreeCrawl(root, files_by_size, exclude_dirs, exclude_files,
+                      follow_dirlinks, errors, hardlinks, min_size, max_size,
+                      file_filter, snapshot, stats)
 
-    def _print_error(error):
-        """Print a listing error to stderr.
+    try:
+        file_info = crawl.stat_root()
+    except OSError as e:
+        crawl.error(e)
+        return errors
+    crawl.start(file_info)
 
-        error should be an os.OSError instance.
+    executor, owned = make_executor(workers, executor)
 
-        """
-        # modify the outside errors value; must be encapsulated in a list,
-        # because if we assign to a variable here we just create an
-        # independent local copy
-        msg = "error listing '%s': %s" % (error.filename, error.strerror)
-        sys.stderr.write("%s\n" % msg)
-        errors.append(msg)
+    # Directories are crawled breadth-first. With an executor, they are
+    # scanned by the workers, while loop detection and indexing are done
+    # here, in the order the directories were found; so the results don't
+    # depend on the timing of the workers.
+    pending = collections.deque()
 
+    try:
+        while crawl.to_scan or pending:
+            # keep the workers busy, without queueing the whole tree at once
+            while crawl.to_scan and len(pending) < MAX_PENDING_JOBS:
+                curr_dir, args = crawl.next_scan()
 
-    # XXX: The actual root may be matched by the exclude pattern. Should we
-    # prune it as well?
+                if executor is None:
+                    result = crawl.scan_func(*args)
+                else:
+                    result = executor.submit(crawl.scan_func, *args)
+                pending.append((curr_dir, result))
 
-    for curr_dir, subdirs, filenames in os.walk(root, topdown=True,
-            onerror=_print_error, followlinks=follow_dirlinks):
+                if executor is None:
+                    break
 
-        # modify subdirs in-place to influence os.walk
-        subdirs[:] = prune_names(subdirs, exclude_dirs)
-        filenames = prune_names(filenames, exclude_files)
+            curr_dir, result = pending.popleft()
+            if executor is not None:
+                result = result.result()
+            crawl.add_listing(curr_dir, result)
+    finally:
+        if owned:
+            executor.shutdown()
 
-        # remove subdirs that have already been visited; loops can happen
-        # if there's a symlink loop and follow_dirlinks==True, or if
-        # there's a hardlink loop (which is usually a corrupted filesystem)
-        subdirs[:], already_visited = filter_visited(curr_dir, subdirs,
-                already_visited, follow_dirlinks, _print_error)
+    return errors
 
-        for base_filename in filenames:
-            full_path = os.path.join(curr_dir, base_filename)
 
-            # avoid race condition: file can be deleted between os.walk()
-            # seeing it and us calling os.lstat()
-            try:
-                file_info = os.lstat(full_path)
-            except OSError as e:
-                _print_error(e)
-                continue
+def hash_region(f, offset, length, algorithm,
+        read_options=readers.DEFAULT_READ_OPTIONS):
+    """Hash a region of an open file.
 
-            # only want regular files, not symlinks
-            if stat.S_ISREG(file_info.st_mode):
-                size = file_info.st_size
+    f is a file object opened in binary mode. The length bytes starting at
+    offset are hashed. The file is read as given by read_options, a
+    capidup.readers.ReadOptions.
 
-                if size in files_by_size:
-                    # append to the list of files with the same size
-                    files_by_size[size].append(full_path)
-                else:
-                    # start a new list for this file size
-                    files_by_size[size] = [full_path]
+    Returns a 2-tuple ``(digest, bytes_read)``: the hash in its binary
+    form, and the number of bytes actually hashed, which is less than
+    length if the file is shorter. Raises IOError or OSError in case of
+    error.
 
-    return errors
+    """
+    summer, bytes_read = readers.hash_region(
+            f, offset, length, lambda: hashers.new_hasher(algorithm),
+            MD5_CHUNK_SIZE, read_options)
 
+    return summer.digest(), bytes_read
 
 
-def calculate_md5(filename, length):
-    """Calculate the MD5 hash of a file, up to length bytes.
+def calculate_digest(filename, length, algorithm=DEFAULT_FULL_HASH, offset=0,
+        read_options=readers.DEFAULT_READ_OPTIONS, read_counts=None):
+    """Calculate the hash of a file, up to length bytes.
 
-    Returns the MD5 in its binary form, as an 8-byte string. Raises IOError
-    or OSError in case of error.
+    algorithm is the name of the hash algorithm, as accepted by
+    capidup.hashers.new_hasher().
+
+    offset is the position in the file where hashing starts. Only the
+    bytes from offset to offset + length are hashed.
+
+    read_options is a capidup.readers.ReadOptions, giving how the file is
+    read.
+
+    read_counts, if not None, is a list to which the number of bytes
+    actually read is appended *in-place*.
+
+    Returns the hash in its binary form. Raises IOError or OSError in case
+    of error.
 
     """
     assert length >= 0
 
-    # shortcut: MD5 of an empty string is 'd41d8cd98f00b204e9800998ecf8427e',
-    # represented here in binary
+    # shortcut: no need to open the file to hash an empty string
     if length == 0:
-        return '\xd4\x1d\x8c\xd9\x8f\x00\xb2\x04\xe9\x80\t\x98\xec\xf8\x42\x7e'
-
-    md5_summer = hashlib.md5()
+        return hashers.new_hasher(algorithm).digest()
 
-    f = open(filename, 'rb')
+    f = readers.open_file(filename, read_options.cache_friendly)
 
     try:
-        bytes_read = 0
+        digest, bytes_read = hash_region(f, offset, length, algorithm,
+                                         read_options)
+    finally:
+        f.close()
 
-        while bytes_read < length:
-            chunk_size = min(MD5_CHUNK_SIZE, length - bytes_read)
+    if read_counts is not None:
+        read_counts.append(bytes_read)
 
-            chunk = f.read(chunk_size)
+    return digest
 
-            if not chunk:
-                # found EOF: means length was larger than the file size, or
-                # file was truncated while reading -- print warning?
-                break
 
-            md5_summer.update(chunk)
+def calculate_digests(filename, regions, algorithm=DEFAULT_FULL_HASH,
+        read_options=readers.DEFAULT_READ_OPTIONS, read_counts=None):
+    """Calculate the hashes of several regions of a file.
+
+    regions is a list of ``(offset, length)`` tuples. The file is opened
+    only once, and the regions are hashed in the given order. read_options
+    and read_counts are as in calculate_digest().
 
-            bytes_read += len(chunk)
+    Returns a list of hashes in binary form, one for each region. Raises
+    IOError or OSError in case of error.
+
+    """
+    f = readers.open_file(filename, read_options.cache_friendly)
 
+    try:
+        hashed = [hash_region(f, offset, length, algorithm, read_options)
+                  for offset, length in regions]
     finally:
         f.close()
 
-    md5 = md5_summer.digest()
+    if read_counts is not None:
+        read_counts += [bytes_read for _, bytes_read in hashed]
+
+    return [digest for digest, _ in hashed]
+
+
+def calculate_md5(filename, length):
+    """Calculate the MD5 hash of a file, up to length bytes.
+
+    Returns the MD5 in its binary form, as a 16-byte string. Raises IOError
+    or OSError in case of error.
+
+    """
+    return calculate_digest(filename, length, "md5")
+
+
+def cached_digest(filename, length, algorithm, digest_cache, offset=0,
+        read_options=readers.DEFAULT_READ_OPTIONS, read_counts=None):
+    """Calculate the hash of a file, consulting a digest cache.
+
+    digest_cache is a capidup.digestcache.DigestCache, or None to always
+    calculate the hash. On a cache miss, the newly calculated hash is
+    stored in the cache.
+
+    offset, read_options and read_counts are as in calculate_digest().
+    Nothing is appended to read_counts on a cache hit.
+
+    Returns the hash in its binary form. Raises IOError or OSError in case
+    of error.
+
+    """
+    if digest_cache is None or length == 0:
+        return calculate_digest(filename, length, algorithm, offset,
+                                read_options, read_counts)
+
+    # stat before reading: if the file is modified while we hash it, its
+    # timestamps will no longer match and the entry won't be reused
+    file_info = os.stat(filename)
+
+    digest = digest_cache.get(file_info, length, algorithm, offset)
+    if digest is None:
+        digest = calculate_digest(filename, length, algorithm, offset,
+                                  read_options, read_counts)
+        digest_cache.put(file_info, length, digest, algorithm, offset)
 
-    return md5
+    return digest
 
 
+def cached_digests(filename, regions, algorithm, digest_cache,
+        read_options=readers.DEFAULT_READ_OPTIONS, read_counts=None):
+    """Calculate the hashes of several regions of a file, with a cache.
 
-def find_duplicates(filenames, max_size):
+    This is like cached_digest(), but for a list of ``(offset, length)``
+    regions. Each region is cached on its own. The file is only opened if
+    some region is missing from the cache.
+
+    Returns a list of hashes in binary form, one for each region.
+
+    """
+    if digest_cache is None:
+        return calculate_digests(filename, regions, algorithm, read_options,
+                                 read_counts)
+
+    file_info = os.stat(filename)
+
+    digests = [digest_cache.get(file_info, length, algorithm, offset)
+               for offset, length in regions]
+
+    missing = [i for i, digest in enumerate(digests) if digest is None]
+    if missing:
+        new_digests = calculate_digests(filename,
+                                        [regions[i] for i in missing],
+                                        algorithm, read_options,
+                                        read_counts)
+
+        for i, digest in zip(missing, new_digests):
+            offset, length = regions[i]
+            digest_cache.put(file_info, length, digest, algorithm, offset)
+            digests[i] = digest
+
+    return digests
+
+
+def digest_or_error(filename, regions, algorithm, digest_cache=None,
+        read_options=readers.DEFAULT_READ_OPTIONS):
+    """Calculate the hash of regions of a file, catching any errors.
+
+    This is a wrapper around cached_digest() and cached_digests(),
+    suitable for running in worker threads: errors are returned instead of
+    being raised or printed.
+
+    regions is a list of ``(offset, length)`` tuples. read_options is as
+    in calculate_digest().
+
+    Returns a 3-tuple ``(digest, error, bytes_read)``. One of the first two
+    is None: `digest` is the binary hash (or a tuple of hashes, if there
+    are several regions), `error` is an error message naming the algorithm
+    (e.g. "unable to calculate MD5 for ..."). bytes_read is the number of
+    bytes actually read from the file: 0 if the digests came from the
+    cache, less than the regions if the file is shorter.
+
+    """
+    read_counts = []
+    try:
+        if len(regions) == 1:
+            offset, length = regions[0]
+            digest = cached_digest(filename, length, algorithm, digest_cache,
+                                   offset, read_options, read_counts)
+        else:
+            digest = tuple(cached_digests(filename, regions, algorithm,
+                                          digest_cache, read_options,
+                                          read_counts))
+
+        return digest, None, sum(read_counts)
+    except EnvironmentError as e:
+        msg = "unable to calculate %s for '%s': %s" % (algorithm.upper(),
+                                                      filename, e.strerror)
+        return None, msg, sum(read_counts)
+
+
+def ordered_map(executor, func, *iterables):
+    """Map a function over iterables, possibly running on an executor.
+
+    executor is a concurrent.futures.Executor (or anything with a
+    compatible submit() method), or None to call func directly in the
+    current thread.
+
+    Unlike Executor.map(), this doesn't submit everything at once: at most
+    MAX_PENDING_JOBS calls are in flight at any time, so it can be used
+    over very long iterables.
+
+    Returns an iterator over the results, in the same order as the
+    arguments.
+
+    """
+    args_iter = py3compat.izip(*iterables)
+
+    if executor is None:
+        for args in args_iter:
+            yield func(*args)
+        return
+
+    pending = collections.deque()
+    for args in args_iter:
+        pending.append(executor.submit(func, *args))
+
+        if len(pending) >= MAX_PENDING_JOBS:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def digest_jobs(groups, region_func, algorithm):
+    """Get the hashing jobs of a stage, for the files of some groups.
+
+    groups is a list of 2-tuples ``(size, filenames)``.
+
+    region_func is a function f(size) -> regions, which gives which bytes
+    to hash for the files in a group of a given size, as a list of
+    ``(offset, length)`` tuples.
+
+    algorithm is the name of the hash algorithm to use.
+
+    Returns a list of ``(filename, regions, algorithm)`` tuples, the first
+    arguments of digest_or_error(): one for each file, in order.
+
+    """
+    jobs = []
+    for size, filenames in groups:
+        regions = region_func(size)
+        jobs += [(filename, regions, algorithm) for filename in filenames]
+
+    return jobs
+
+
+def run_digest_jobs(jobs, digest_cache, executor, io_order=None,
+        scheduler=None, read_options=readers.DEFAULT_READ_OPTIONS):
+    """Run hashing jobs from digest_jobs(), possibly concurrently.
+
+    digest_cache and executor are as in find_duplicates().
+
+    io_order, if not None, is a mode of capidup.ioorder: the files are
+    then hashed in the order given by capidup.ioorder.read_order(). This
+    only changes the order of the reads, not the results.
+
+    scheduler, if not None, is a capidup.devsched.DeviceScheduler. Files
+    are then hashed on a queue for their device, instead of on executor.
+
+    read_options is a capidup.readers.ReadOptions, giving how files are
+    read.
+
+    Returns a list of the results of digest_or_error() for each job, in
+    the same order as jobs.
+
+    """
+    num_jobs = len(jobs)
+
+    if io_order is None:
+        order = None
+    else:
+        order = ioorder.read_order([filename for filename, _, _ in jobs],
+                                   [regions[0][0] for _, regions, _ in jobs],
+                                   io_order)
+        jobs = [jobs[i] for i in order]
+
+    filenames = [filename for filename, _, _ in jobs]
+    all_regions = [regions for _, regions, _ in jobs]
+    algorithms = [algorithm for _, _, algorithm in jobs]
+
+    if scheduler is None:
+        results = ordered_map(executor, digest_or_error, filenames,
+                              all_regions, algorithms,
+                              [digest_cache] * num_jobs,
+                              [read_options] * num_jobs)
+    else:
+        results = scheduler.map(
+            digest_or_error,
+            [scheduler.device_of(filename) for filename in filenames],
+            filenames, all_regions, algorithms, [digest_cache] * num_jobs,
+            [read_options] * num_jobs)
+
+    if order is None:
+        return list(results)
+
+    # put the results back in the original order
+    unsorted = [None] * num_jobs
+    for i, result in py3compat.izip(order, results):
+        unsorted[i] = result
+
+    return unsorted
+
+
+def group_by_digest(groups, results, errors):
+    """Split groups of possible duplicates, by the results of hashing.
+
+    groups is a list of 2-tuples ``(size, filenames)``. results holds the
+    ``(digest, error, bytes_read)`` of each file of the groups, in order,
+    as from run_digest_jobs(). Files in different groups are never
+    compared to each other.
+
+    Error messages are printed to stderr and appended *in-place* to the
+    errors list.
+
+    Returns a new list of 2-tuples ``(size, filenames)``, containing only
+    the subgroups with at least two files.
+
+    """
+    results = iter(results)
+
+    new_groups = []
+    for size, filenames in groups:
+        files_by_digest = {}
+
+        for filename in filenames:
+            digest, error, _ = next(results)
+
+            if error is not None:
+                sys.stderr.write("%s\n" % error)
+                errors.append(error)
+                continue
+
+            if digest not in files_by_digest:
+                # unique beginning so far; index it on its own
+                files_by_digest[digest] = [filename]
+            else:
+                # found a potential duplicate (same beginning)
+                files_by_digest[digest].append(filename)
+
+        # Filter out the unique files (lists of files with the same hash
+        # that only contain 1 file), and keep the lists of duplicates.
+        # Don't use values() because on Python 2 this creates a list of all
+        # values (file lists), and that may be very large.
+        new_groups += [(size, l)
+                       for l in py3compat.itervalues(files_by_digest)
+                       if len(l) >= 2]
+
+    return new_groups
+
+
+def split_groups_by_digest(groups, region_func, algorithm, digest_cache,
+        executor, errors, io_order=None, scheduler=None,
+        read_options=readers.DEFAULT_READ_OPTIONS):
+    """Split groups of possible duplicates, by the hash of their contents.
+
+    groups is a list of 2-tuples ``(size, filenames)``. Files in different
+    groups are never compared to each other.
+
+    region_func and algorithm are as in digest_jobs(). digest_cache,
+    executor, io_order, scheduler and read_options are as in
+    run_digest_jobs(). The files of all groups are hashed together, so that
+    they can be spread among workers even if each group is small.
+
+    Error messages are printed to stderr and appended *in-place* to the
+    errors list.
+
+    Returns a new list of 2-tuples ``(size, filenames)``, containing only
+    the subgroups with at least two files. The order of the groups, and of
+    the files within them, does not depend on the executor.
+
+    """
+    results = run_digest_jobs(digest_jobs(groups, region_func, algorithm),
+                              digest_cache, executor, io_order, scheduler,
+                              read_options)
+
+    return group_by_digest(groups, results, errors)
+
+
+def lockstep_jobs(groups):
+    """Get the lockstep comparison jobs, for some groups of files.
+
+    Returns a list of ``(filenames, size)`` tuples, the first arguments of
+    capidup.lockstep.split_group_lockstep(): one for each group.
+
+    """
+    return [(filenames, size) for size, filenames in groups]
+
+
+def run_lockstep_jobs(jobs, max_open_files, executor,
+        read_options=readers.DEFAULT_READ_OPTIONS):
+    """Run lockstep comparison jobs from lockstep_jobs().
+
+    Each group is compared in a single worker; several groups are compared
+    at the same time. max_open_files is the maximum number of open files
+    for each group. Only the cache-friendly mode of read_options applies:
+    files are compared chunk by chunk, without any read backend.
+
+    Returns a list of the results of split_group_lockstep() for each job,
+    in the same order as jobs.
+
+    """
+    num_jobs = len(jobs)
+
+    return list(ordered_map(executor, split_group_lockstep,
+                            [filenames for filenames, _ in jobs],
+                            [size for _, size in jobs],
+                            [MD5_CHUNK_SIZE] * num_jobs,
+                            [max_open_files] * num_jobs,
+                            [read_options.cache_friendly] * num_jobs))
+
+
+def group_lockstep(groups, results, errors):
+    """Split groups of possible duplicates, by their lockstep comparisons.
+
+    results holds the result of split_group_lockstep() for each group, in
+    order, as from run_lockstep_jobs(). Error messages are printed to
+    stderr and appended *in-place* to the errors list.
+
+    Returns a new list of 2-tuples ``(size, filenames)``, containing only
+    the subgroups with at least two files.
+
+    """
+    new_groups = []
+    for (size, _), (duplicates, sub_errors, _) in py3compat.izip(groups,
+                                                                 results):
+        for error in sub_errors:
+            sys.stderr.write("%s\n" % error)
+        errors += sub_errors
+
+        new_groups += [(size, filenames) for filenames in duplicates]
+
+    return new_groups
+
+
+def split_groups_lockstep(groups, max_open_files, executor, errors,
+        read_options=readers.DEFAULT_READ_OPTIONS):
+    """Split groups of possible duplicates, comparing their exact contents.
+
+    This is like split_groups_by_digest(), but files are compared by
+    reading each group in lockstep (see capidup.lockstep) instead of by
+    hashing. max_open_files, executor and read_options are as in
+    run_lockstep_jobs().
+
+    Returns a new list of 2-tuples ``(size, filenames)``, containing only
+    the subgroups with at least two files.
+
+    """
+    results = run_lockstep_jobs(lockstep_jobs(groups), max_open_files,
+                                executor, read_options)
+
+    return group_lockstep(groups, results, errors)
+
+
+def make_executor(workers, executor):
+    """Get the executor to use for hashing.
+
+    If executor is not None, it is returned. Otherwise, if workers is
+    greater than 1, a new thread pool with that many threads is created.
+
+    Returns a 2-tuple ``(executor, owned)``. executor may be None, meaning
+    work should be done in the current thread. owned is True if the
+    executor was created here, and must be shut down by the caller.
+
+    """
+    if executor is not None:
+        return executor, False
+
+    if workers is not None and workers > 1:
+        # import here: concurrent.futures needs the "futures" backport on
+        # Python 2, and is only required when using workers
+        from concurrent.futures import ThreadPoolExecutor
+
+        return ThreadPoolExecutor(max_workers=workers), True
+
+    return None, False
+
+
+
+def make_scheduler(device_workers, device_stats):
+    """Get the per-device scheduler to use for hashing.
+
+    Returns a new DeviceScheduler with device_workers threads per device,
+    accumulating statistics in device_stats, or None if device_workers is
+    None. The caller must shut it down. It is meant for digest_or_error()
+    jobs: the bytes they actually read are counted.
+
+    """
+    if device_workers is None:
+        return None
+
+    return DeviceScheduler(device_workers, device_stats,
+                           lambda result: result[2])
+
+
+def iter_duplicates(filenames, max_size, digest_cache=None, workers=None,
+        executor=None, hash_algorithm=DEFAULT_FULL_HASH, lockstep=False,
+        max_open_files=LOCKSTEP_MAX_OPEN_FILES, read_backend="auto",
+        cache_friendly=False, errors=None):
+    """Find duplicates in a list of files, comparing up to `max_size` bytes.
+
+    This is a generator version of :func:`find_duplicates`, which see. It
+    takes the same arguments, in the same order, and yields each group of
+    duplicates (a list of filenames), instead of returning a list of them.
+
+    `errors`, if provided, should be a list. Error messages are appended to
+    it *in-place* as they occur, so they can be checked between groups.
+    They are also printed to stderr, as always. It should be passed by
+    keyword.
+
+    """
+    if errors is None:
+        errors = []
+
+    hashers.check_algorithm(hash_algorithm)
+    read_options = readers.ReadOptions(read_backend, cache_friendly)
+
+    # shortcut: can't have duplicates if there aren't at least 2 files
+    if len(filenames) < 2:
+        return
+
+    # shortcut: if comparing 0 bytes, they're all the same
+    if max_size == 0:
+        yield filenames
+        return
+
+    executor, owned = make_executor(workers, executor)
+    try:
+        if lockstep:
+            groups = split_groups_lockstep([(max_size, filenames)],
+                                           max_open_files, executor, errors,
+                                           read_options)
+        else:
+            groups = split_groups_by_digest([(max_size, filenames)],
+                                            lambda size: [(0, size)],
+                                            hash_algorithm, digest_cache,
+                                            executor, errors,
+                                            read_options=read_options)
+    finally:
+        if owned:
+            executor.shutdown()
+
+    for _, duplicates in groups:
+        yield duplicates
+
+
+def find_duplicates(filenames, max_size, digest_cache=None, workers=None,
+        executor=None, hash_algorithm=DEFAULT_FULL_HASH, lockstep=False,
+        max_open_files=LOCKSTEP_MAX_OPEN_FILES, read_backend="auto",
+        cache_friendly=False):
     """Find duplicates in a list of files, comparing up to `max_size` bytes.
 
     Returns a 2-tuple of two values: ``(duplicate_groups, errors)``.
@@ -312,48 +1144,1167 @@ def find_duplicates(filenames, max_size):
 
     Note that ``b`` is not included in the results, as it has no duplicates.
 
+    `digest_cache`, if provided, should be a
+    :class:`capidup.digestcache.DigestCache`. Files whose hash is found in
+    the cache are not read.
+
+    `workers`, if greater than 1, is the number of threads used to hash
+    files concurrently. Alternatively, an existing
+    :class:`concurrent.futures.Executor` may be passed as `executor`. The
+    results are the same, and in the same order, regardless of how many
+    workers are used.
+
+    `hash_algorithm` is the name of the hash algorithm used to compare
+    files. See :mod:`capidup.hashers` for the supported algorithms. The
+    default is MD5.
+
+    If `lockstep` is True, files are compared directly instead of by
+    their hashes: they are all read together, chunk by chunk, and each
+    file is only read for as long as it matches some other file. This
+    avoids reading files to the end when they differ early on, and has no
+    risk of hash collisions. At most `max_open_files` are kept open; any
+    others are reopened for every chunk.
+
+    `read_backend` is the name of the backend used to read files for
+    hashing, or ``"auto"`` to choose one automatically; see
+    :mod:`capidup.readers`. If `cache_friendly` is True, files are read
+    without touching their access times, and each chunk is dropped from
+    the page cache once it has been read, so that the scan doesn't evict
+    the working set of other processes.
+
+    Only `filenames` and `max_size` should be passed by position; any
+    other arguments should be passed by keyword.
+
     """
     errors = []
 
-    # shortcut: can't have duplicates if there aren't at least 2 files
-    if len(filenames) < 2:
-        return [], errors
+    duplicates = list(iter_duplicates(filenames, max_size, digest_cache,
+                                      workers, executor, hash_algorithm,
+                                      lockstep, max_open_files,
+                                      read_backend, cache_friendly,
+                                      errors=errors))
 
-    # shortcut: if comparing 0 bytes, they're all the same
-    if max_size == 0:
-        return [filenames], errors
+    return duplicates, errors
 
-    files_by_md5 = {}
 
-    for filename in filenames:
-        try:
-            md5 = calculate_md5(filename, max_size)
-        except EnvironmentError as e:
-            msg = "unable to calculate MD5 for '%s': %s" % (filename, e.strerror)
-            sys.stderr.write("%s\n" % msg)
-            errors.append(msg)
+def partial_md5_size(size):
+    """Get the size of the partial read, for a file of a given size."""
+
+    return min(round_up_to_mult(size // PARTIAL_MD5_READ_RATIO,
+                                PARTIAL_MD5_READ_MULT),
+               PARTIAL_MD5_MAX_READ)
+
+
+def check_partial_schedule(partial_schedule):
+    """Validate a schedule of partial read sizes.
+
+    Raises ValueError unless partial_schedule is a non-empty sequence of
+    positive, strictly increasing integers.
+
+    Returns the schedule as a tuple.
+
+    """
+    schedule = tuple(partial_schedule)
+
+    if not schedule:
+        raise ValueError("partial schedule must not be empty")
+
+    for prev, read_size in zip((0,) + schedule, schedule):
+        if read_size <= prev:
+            raise ValueError("partial schedule must be strictly increasing "
+                             "positive sizes: %r" % (schedule,))
+
+    return schedule
+
+
+def schedule_done_offset(partial_schedule, size):
+    """Get how much of a file is covered by a partial read schedule.
+
+    A group of files goes through every step of the schedule that is
+    smaller than its size. Returns the largest such step, or 0.
+
+    """
+    done = 0
+    for read_size in partial_schedule:
+        if read_size >= size:
+            break
+        done = read_size
+
+    return done
+
+
+def check_sample_blocks(sample_blocks):
+    """Validate a number of sample blocks.
+
+    Raises ValueError unless sample_blocks is 0 (no sampling) or at least
+    2 (the head and the tail).
+
+    """
+    if sample_blocks < 0 or sample_blocks == 1:
+        raise ValueError("sample_blocks must be 0, or at least 2: %r"
+                         % (sample_blocks,))
+
+
+def sample_regions(size, sample_blocks, done=0):
+    """Get the regions read by the sampling stage, for a given file size.
+
+    sample_blocks blocks of SAMPLE_BLOCK_SIZE bytes are spread evenly over
+    the file, from the head to the tail. Other than the tail block, their
+    offsets are aligned to PARTIAL_MD5_READ_MULT. Since they depend only on
+    the size, they are the same for every file in a size group.
+
+    Blocks entirely within the first done bytes, which were already
+    compared by an earlier stage, are left out.
+
+    Returns a list of ``(offset, length)`` tuples, in increasing order.
+
+    """
+    last = size - SAMPLE_BLOCK_SIZE
+    offsets = [last * i // (sample_blocks - 1) for i in range(sample_blocks)]
+    offsets = [offset - offset % PARTIAL_MD5_READ_MULT
+               for offset in offsets[:-1]] + [last]
+
+    regions = []
+    for offset in offsets:
+        if offset + SAMPLE_BLOCK_SIZE <= done:
+            continue
+        if regions and offset < regions[-1][0] + SAMPLE_BLOCK_SIZE:
+            # overlaps the previous block
             continue
+        regions.append((offset, SAMPLE_BLOCK_SIZE))
+
+    return regions
+
+
+def restat_groups(groups, errors):
+    """Regroup files by their current size.
+
+    groups is a list of 2-tuples ``(size, filenames)``, whose sizes may be
+    out of date (e.g. taken from a capidup.snapshot.DirSnapshot). Each
+    file is stat'ed again, and the files of all groups are regrouped by
+    their current size. Files that can't be stat'ed are left out, and an
+    error message is printed to stderr and appended *in-place* to the
+    errors list.
+
+    Returns a list of 2-tuples ``(size, filenames)``, possibly with groups
+    of a single file.
+
+    """
+    # keep the sizes in the order they were first seen
+    files_by_size = {}
+    sizes = []
+
+    for _, filenames in groups:
+        for filename in filenames:
+            try:
+                size = os.lstat(filename).st_size
+            except OSError as e:
+                msg = "unable to stat '%s': %s" % (filename, e.strerror)
+                sys.stderr.write("%s\n" % msg)
+                errors.append(msg)
+                continue
+
+            if size not in files_by_size:
+                files_by_size[size] = []
+                sizes.append(size)
+            files_by_size[size].append(filename)
+
+    return [(size, files_by_size[size]) for size in sizes]
 
-        if md5 not in files_by_md5:
-            # unique beginning so far; index it on its own
-            files_by_md5[md5] = [filename]
+
+def record_stage(stats, name, groups_in, groups_out, region_func, results,
+        start):
+    """Count a run of a comparison stage, if stats is not None.
+
+    stats is a capidup.scanstats.ScanStats, and name the name of the
+    stage. groups_in and groups_out are the groups the stage started and
+    ended with, and region_func the function that gave the regions it
+    planned to compare. results are the results of its jobs, each ending
+    with the number of bytes actually read. start is the time the stage
+    started at.
+
+    """
+    if stats is None:
+        return
+
+    files_in = 0
+    bytes_planned = 0
+    for size, filenames in groups_in:
+        files_in += len(filenames)
+        bytes_planned += len(filenames) * sum(length for _, length
+                                              in region_func(size))
+    files_out = sum(len(filenames) for _, filenames in groups_out)
+    bytes_read = sum(result[-1] for result in results)
+
+    stats.add_stage(name, files_in, files_out, bytes_read,
+                    time.time() - start, bytes_planned, start)
+
+
+def compare_stages(groups, partial_hash, full_hash, lockstep,
+        partial_schedule, errors, sample_blocks=0, links=None, stats=None):
+    """Compare groups of files through all the stages, without doing I/O.
+
+    This is the logic of find_duplicates_in_groups(), as a generator that
+    yields the jobs each stage needs to have run, and is sent back their
+    results. The same stages can then be run in threads (run_stages) or
+    from an event loop (capidup.aio).
+
+    It yields 2-tuples ``(kind, jobs)``, and must be sent the results of
+    the jobs, in the same order:
+
+    ``("digest", jobs)``
+        jobs is from digest_jobs(); the results are from
+        run_digest_jobs(), or from calling digest_or_error() on each job.
+    ``("lockstep", jobs)``
+        jobs is from lockstep_jobs(); the results are from
+        run_lockstep_jobs(), or from calling split_group_lockstep() on
+        each job.
+
+    Lastly, it yields ``("done", duplicate_groups)``, where
+    duplicate_groups is as returned by find_duplicates_in_groups().
+
+    groups is a list of 2-tuples ``(size, filenames)``. Groups with less
+    than two files are ignored, unless the file has other hard links. The
+    other arguments are as in find_duplicates_in_groups().
+
+    """
+    if links is None:
+        links = {}
+
+    # Files with a unique size can't have duplicates, other than their own
+    # hard links. Empty files are all duplicates of each other, without
+    # needing to be read. Go through groups only once: it may be an
+    # iterator that builds each group on the fly, and there is no need to
+    # keep the unique files.
+    linked_groups = []
+    empty_groups = []
+    candidate_groups = []
+    for size, filenames in groups:
+        if len(filenames) < 2:
+            if filenames[0] in links:
+                linked_groups.append((size, filenames))
+        elif size == 0:
+            empty_groups.append((size, filenames))
+        else:
+            candidate_groups.append((size, filenames))
+    groups = candidate_groups
+
+    if partial_schedule is None:
+        # for large file sizes, divide them further into groups by matching
+        # initial portion; how much of the file is used to match depends
+        # on the file size
+        large_groups = [(size, filenames) for size, filenames in groups
+                        if size >= PARTIAL_MD5_THRESHOLD]
+        small_groups = [(size, filenames) for size, filenames in groups
+                        if size < PARTIAL_MD5_THRESHOLD]
+
+        partial_region = lambda size: [(0, partial_md5_size(size))]
+        start = time.time()
+        results = yield "digest", digest_jobs(large_groups, partial_region,
+                                              partial_hash)
+        partial_groups = group_by_digest(large_groups, results, errors)
+        record_stage(stats, "partial", large_groups, partial_groups,
+                     partial_region, results, start)
+
+        possible_duplicates = small_groups + partial_groups
+
+        def prefix_done(size):
+            """Get how much of a file the partial stage compared."""
+            if size < PARTIAL_MD5_THRESHOLD:
+                return 0
+            return partial_md5_size(size)
+
+        # the full stage hashes the entire file
+        full_region = lambda size: [(0, size)]
+
+    else:
+        # Go up the schedule, one partial stage per read size. Groups that
+        # survive a stage are identical up to its read size, so the next
+        # stage only needs to hash the bytes after that. Groups that are
+        # no larger than the next read size leave the schedule, and go
+        # straight to the full stage.
+        possible_duplicates = []
+        prev = 0
+        for read_size in partial_schedule:
+            possible_duplicates += [(size, filenames)
+                                    for size, filenames in groups
+                                    if size <= read_size]
+            groups = [(size, filenames) for size, filenames in groups
+                      if size > read_size]
+
+            partial_region = lambda size, begin=prev, end=read_size: \
+                    [(begin, end - begin)]
+            start = time.time()
+            results = yield "digest", digest_jobs(groups, partial_region,
+                                                  partial_hash)
+            partial_groups = group_by_digest(groups, results, errors)
+            record_stage(stats, "partial", groups, partial_groups,
+                         partial_region, results, start)
+            groups = partial_groups
+
+            prev = read_size
+
+        possible_duplicates += groups
+
+        prefix_done = lambda size: schedule_done_offset(partial_schedule,
+                                                        size)
+
+        if partial_hash == full_hash:
+            # the schedule compared the prefix as thoroughly as the full
+            # stage would; only hash what it didn't cover
+            def full_region(size):
+                """Get the region of a file not covered by the schedule."""
+                done = prefix_done(size)
+                return [(done, size - done)]
         else:
-            # found a potential duplicate (same beginning)
-            files_by_md5[md5].append(filename)
+            # a weak partial_hash may have matched different prefixes
+            full_region = lambda size: [(0, size)]
+
+    if sample_blocks:
+        # Large files whose heads match (e.g. containers with a common
+        # header) are then compared by a few blocks from all over the
+        # file, including the tail, before being read in full.
+        min_size = 2 * sample_blocks * SAMPLE_BLOCK_SIZE
+        sampled = [(size, filenames) for size, filenames in possible_duplicates
+                   if size > min_size]
+        possible_duplicates = [(size, filenames)
+                               for size, filenames in possible_duplicates
+                               if size <= min_size]
+
+        sample_region = lambda size: sample_regions(size, sample_blocks,
+                                                    prefix_done(size))
+        start = time.time()
+        results = yield "digest", digest_jobs(sampled, sample_region,
+                                              partial_hash)
+        sampled_groups = group_by_digest(sampled, results, errors)
+        record_stage(stats, "sample", sampled, sampled_groups, sample_region,
+                     results, start)
+
+        possible_duplicates += sampled_groups
+
+    # Do full hash scan on suspected duplicates, plus all the small files
+    # (which are grouped together by size only). calculate_digest needs to
+    # know how many bytes to scan. We're using the file's size, as per
+    # stat(); this is a problem if the file is growing. We'll only scan up
+    # to the size the file had when we indexed. Would be better to somehow
+    # tell calculate_digest to scan until EOF (e.g. give it a negative
+    # size).
+    start = time.time()
+    if lockstep:
+        results = yield "lockstep", lockstep_jobs(possible_duplicates)
+        duplicates = group_lockstep(possible_duplicates, results, errors)
+        # reading stops early; the whole files are planned
+        full_region = lambda size: [(0, size)]
+    else:
+        results = yield "digest", digest_jobs(possible_duplicates,
+                                              full_region, full_hash)
+        duplicates = group_by_digest(possible_duplicates, results, errors)
+    record_stage(stats, "full", possible_duplicates, duplicates, full_region,
+                 results, start)
+
+    result = []
+    for size, filenames in empty_groups + linked_groups + duplicates:
+        expanded = expand_hardlinks(filenames, links)
+        if stats is not None:
+            # links to the same file take no extra space
+            stats.add_duplicates(size, len(expanded), len(filenames))
+        result.append(expanded)
+
+    yield "done", result
+
+
+def run_stages(stages, digest_cache, executor, max_open_files,
+        io_order=None, scheduler=None,
+        read_options=readers.DEFAULT_READ_OPTIONS):
+    """Run the jobs of a compare_stages() generator, to the end.
+
+    Hashing jobs are run with run_digest_jobs(), and lockstep jobs with
+    run_lockstep_jobs(), which see for the arguments.
+
+    Returns the groups of duplicates found by the stages.
 
-    # Filter out the unique files (lists of files with the same md5 that
-    # only contain 1 file), and create a list of the lists of duplicates.
-    # Don't use values() because on Python 2 this creates a list of all
-    # values (file lists), and that may be very large.
-    duplicates = [l for l in py3compat.itervalues(files_by_md5) if len(l) >= 2]
+    """
+    kind, jobs = next(stages)
 
-    return duplicates, errors
+    while kind != "done":
+        if kind == "digest":
+            results = run_digest_jobs(jobs, digest_cache, executor,
+                                      io_order, scheduler, read_options)
+        else:
+            results = run_lockstep_jobs(jobs, max_open_files, executor,
+                                        read_options)
+
+        kind, jobs = stages.send(results)
+
+    stages.close()
+
+    return jobs
 
 
+def iter_stages_scheduled(stage_iter, digest_cache, executor,
+        max_open_files, scheduler, io_order=None,
+        read_options=readers.DEFAULT_READ_OPTIONS):
+    """Run the jobs of many compare_stages() generators at once.
+
+    stage_iter is an iterable of compare_stages() generators, e.g. one for
+    each batch of size groups. Hashing jobs are queued on scheduler, a
+    capidup.devsched.DeviceScheduler, and lockstep jobs on executor (or
+    run right away, if it is None). The other arguments are as in
+    run_stages().
+
+    Each generator moves on to its next stage as soon as its own jobs are
+    done, without waiting for the other generators; new ones are started
+    while the scheduler has room (see DeviceScheduler.has_room). So the
+    queue of each device keeps running across stages and batches, and a
+    slow device only holds back the batches with files on it.
+
+    Yields each group of duplicates, as the generators finish.
+
+    """
+    try:
+        import queue
+    except ImportError:     # pragma: no cover
+        # Python 2
+        import Queue as queue
+
+    # finished futures are put here by their callbacks, so that waiting
+    # for the next one doesn't go through all the pending ones
+    done_queue = queue.Queue()
+    # future -> (state, index of its job); state is a list
+    # [generator, results, number of jobs not done]
+    pending = {}
+    # lockstep jobs pending on executor, which the scheduler doesn't see
+    counts = {"lockstep": 0}
+
+    def _submit(kind, jobs):
+        """Queue the jobs of a stage. Yields (index, future) tuples."""
+
+        if kind == "lockstep":
+            for i, (filenames, size) in enumerate(jobs):
+                counts["lockstep"] += 1
+                yield i, executor.submit(split_group_lockstep, filenames,
+                                         size, MD5_CHUNK_SIZE,
+                                         max_open_files,
+                                         read_options.cache_friendly)
+            return
+
+        if io_order is None:
+            order = range(len(jobs))
+        else:
+            order = ioorder.read_order(
+                [filename for filename, _, _ in jobs],
+                [regions[0][0] for _, regions, _ in jobs], io_order)
+
+        for i in order:
+            filename, regions, algorithm = jobs[i]
+            yield i, scheduler.submit(scheduler.device_of(filename),
+                                      digest_or_error, filename, regions,
+                                      algorithm, digest_cache, read_options)
+
+    def _advance(stages, kind, jobs):
+        """Run a generator until it has jobs queued, or is done.
+
+        Returns its groups of duplicates once done, or None.
+
+        """
+        while kind != "done":
+            if not jobs:
+                kind, jobs = stages.send([])
+            elif kind == "lockstep" and executor is None:
+                kind, jobs = stages.send(run_lockstep_jobs(
+                    jobs, max_open_files, None, read_options))
+            else:
+                state = [stages, [None] * len(jobs), len(jobs)]
+                for i, future in _submit(kind, jobs):
+                    pending[future] = (state, i)
+                    future.add_done_callback(done_queue.put)
+                return None
+
+        stages.close()
+        return jobs
+
+    stage_iter = iter(stage_iter)
+    exhausted = False
+    try:
+        while True:
+            # always keep something going; beyond that, only as much as
+            # the devices can take
+            while not exhausted and (
+                    not pending
+                    or (scheduler.has_room(MAX_PENDING_JOBS)
+                        and counts["lockstep"] < MAX_PENDING_JOBS)):
+                try:
+                    stages = next(stage_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                kind, jobs = next(stages)
+                duplicates = _advance(stages, kind, jobs)
+                if duplicates is not None:
+                    for dup_group in duplicates:
+                        yield dup_group
+
+            if not pending:
+                break
+
+            future = done_queue.get()
+            state, i = pending.pop(future)
+            state[1][i] = future.result()
+            state[2] -= 1
+
+            if not state[2]:
+                stages, results, _ = state
+                kind, jobs = stages.send(results)
+                duplicates = _advance(stages, kind, jobs)
+                if duplicates is not None:
+                    for dup_group in duplicates:
+                        yield dup_group
+    finally:
+        # on errors, or if the caller stops early, don't leave jobs behind
+        for future in pending:
+            future.cancel()
+
+
+def group_stages(groups, partial_hash, full_hash, lockstep,
+        partial_schedule, errors, sample_blocks=0, links=None,
+        restat=False, stats=None):
+    """Get the compare_stages() generator for groups of files.
+
+    If restat is True, the files of groups with at least two files are
+    first regrouped by their current size (see restat_groups). The
+    arguments are as in find_duplicates_in_groups().
+
+    """
+    if restat:
+        kept_groups = []
+        candidate_groups = []
+        for size, filenames in groups:
+            if len(filenames) >= 2:
+                candidate_groups.append((size, filenames))
+            elif links and filenames[0] in links:
+                kept_groups.append((size, filenames))
+        groups = kept_groups + restat_groups(candidate_groups, errors)
+
+    return compare_stages(groups, partial_hash, full_hash, lockstep,
+                          partial_schedule, errors, sample_blocks, links,
+                          stats)
+
+
+def find_duplicates_in_groups(groups, partial_hash, full_hash, lockstep,
+        max_open_files, partial_schedule, digest_cache, executor, errors,
+        sample_blocks=0, links=None, io_order=None, scheduler=None,
+        restat=False, stats=None, read_options=readers.DEFAULT_READ_OPTIONS):
+    """Find duplicates within groups of files of the same size.
+
+    groups is a list of 2-tuples ``(size, filenames)``, as taken from a
+    files_by_size index. Groups with less than two files are ignored.
+
+    partial_hash and full_hash are the names of the hash algorithms for
+    the partial and the full stages. If lockstep is True, the full stage
+    compares file contents directly instead, with at most max_open_files
+    open files per group.
+
+    partial_schedule is None for a single partial stage, sized according
+    to the PARTIAL_MD5_* constants, or a validated sequence of read sizes
+    (see check_partial_schedule) for a stage per read size.
+
+    If sample_blocks is not 0, a sampling stage follows the partial
+    stage(s): see sample_regions(). It only applies to files larger than
+    twice the total size of the samples, so it never reads more than half
+    of a file.
+
+    links, if provided, is a dictionary of the other hard links of indexed
+    files, as returned by hardlink_links(). They are added to the reported
+    groups, after the path they are links to. A file with other links is a
+    group of duplicates on its own, even if it has a unique size.
+
+    If restat is True, the sizes in groups may be out of date: the files of
+    groups with at least two files are regrouped by their current size
+    before being compared (see restat_groups).
+
+    stats, if provided, should be a capidup.scanstats.ScanStats. Each
+    stage, and the groups of duplicates found, are counted in it
+    *in-place*.
+
+    digest_cache, executor, io_order, scheduler and read_options are as in
+    run_digest_jobs(), and apply to every hashing stage. Error messages
+    are printed to stderr and appended *in-place* to the errors list.
+
+    The stages themselves are in compare_stages().
+
+    Returns a (possibly empty) list of lists: the names of files that have
+    at least two copies, grouped together.
+
+    """
+    stages = group_stages(groups, partial_hash, full_hash, lockstep,
+                          partial_schedule, errors, sample_blocks, links,
+                          restat, stats)
+
+    return run_stages(stages, digest_cache, executor, max_open_files,
+                      io_order, scheduler, read_options)
+
+
+def hardlink_links(hardlinks):
+    """Get the other hard links of each indexed file.
+
+    hardlinks is a dictionary filled by index_files_by_size(). Returns a
+    dictionary mapping each indexed path that has other links in the scan
+    to a list of those links.
+
+    """
+    return dict((paths[0], paths[1:])
+                for paths in py3compat.itervalues(hardlinks)
+                if len(paths) > 1)
+
+
+def expand_hardlinks(filenames, links):
+    """Add the other hard links of files to a list of filenames.
+
+    Each file is followed by its links, if it has any in the links
+    dictionary (see hardlink_links). Returns a new list.
+
+    """
+    expanded = []
+    for filename in filenames:
+        expanded.append(filename)
+        expanded += links.get(filename, [])
+
+    return expanded
+
+
+def check_hardlinks_mode(hardlinks):
+    """Validate a hard links mode.
+
+    Raises ValueError unless hardlinks is "include" or "exclude".
+
+    """
+    if hardlinks not in ("include", "exclude"):
+        raise ValueError("hardlinks must be 'include' or 'exclude': %r"
+                         % (hardlinks,))
+
+
+def index_dirs(directories, exclude_dirs, exclude_files, follow_dirlinks,
+        executor, errors, hardlinks=None, min_size=0, max_size=None,
+        file_filter=None, compact_index=False, memory_limit=None,
+        spill_dir=None, snapshot=None, stats=None):
+    """Index the files of a list of directories by size.
+
+    Calls index_files_by_size() for each directory. Error messages are
+    appended *in-place* to the errors list. hardlinks, min_size, max_size,
+    file_filter, snapshot and stats are as in index_files_by_size();
+    hardlinks and snapshot are shared by all directories. The time spent
+    is added to the crawl_seconds of stats, if provided.
+
+    If compact_index is True, the files are indexed in a
+    capidup.fileindex.CompactFileIndex instead of a dictionary. If
+    memory_limit is not None, they are indexed in a
+    capidup.spillindex.SpillingFileIndex with that memory limit, spilling
+    to spill_dir; the caller must close it.
+
+    Returns the files_by_size index.
+
+    """
+    exclude_dirs = compile_excludes(exclude_dirs)
+    exclude_files = compile_excludes(exclude_files)
+
+    if memory_limit is not None:
+        files_by_size = SpillingFileIndex(memory_limit, spill_dir)
+    elif compact_index:
+        files_by_size = CompactFileIndex()
+    else:
+        files_by_size = {}
+
+    start = time.time()
+    try:
+        for directory in directories:
+            sub_errors = index_files_by_size(directory, files_by_size,
+                                             exclude_dirs, exclude_files,
+                                             follow_dirlinks,
+                                             executor=executor,
+                                             hardlinks=hardlinks,
+                                             min_size=min_size,
+                                             max_size=max_size,
+                                             file_filter=file_filter,
+                                             snapshot=snapshot, stats=stats)
+            errors += sub_errors
+    except:
+        close_index(files_by_size)
+        raise
+
+    if stats is not None:
+        stats.crawl_seconds += time.time() - start
+
+    return files_by_size
+
+
+def close_index(files_by_size):
+    """Release the resources of a files_by_size index, if it has any."""
+
+    if isinstance(files_by_size, SpillingFileIndex):
+        files_by_size.close()
+
+
+def check_index_options(compact_index, memory_limit):
+    """Validate the choice of file index.
+
+    Raises ValueError if both a compact and a spilling index are asked
+    for, or if memory_limit is not positive.
+
+    """
+    if memory_limit is not None:
+        if compact_index:
+            raise ValueError("compact_index and memory_limit are mutually "
+                             "exclusive")
+        if memory_limit <= 0:
+            raise ValueError("memory_limit must be positive: %r"
+                             % (memory_limit,))
+
+
+def iter_size_groups(files_by_size, links=None, stats=None):
+    """Remove and yield all groups of files from a files_by_size index.
+
+    Groups are taken in the order of the index: the order their sizes were
+    first added, for a dictionary or a CompactFileIndex, and increasing
+    size for a SpillingFileIndex. Each group is removed from the index
+    before being yielded, so it is only kept in memory for as long as the
+    caller needs it.
+
+    Groups with a single file are discarded, unless the file has other
+    hard links in the links dictionary (see hardlink_links). Every group
+    taken is counted in stats, if provided; see count_groups().
+
+    Yields 2-tuples ``(size, filenames)``.
+
+    """
+    if isinstance(files_by_size, CompactFileIndex):
+        for group in pop_compact_groups(files_by_size, links, stats):
+            yield group
+        return
+
+    if isinstance(files_by_size, SpillingFileIndex):
+        # merged back from disk; each group can only be read once anyway
+        groups = py3compat.iteritems(files_by_size)
+    else:
+        groups = ((size, files_by_size.pop(size))
+                  for size in list(files_by_size))
+
+    for size, filenames in count_groups(groups, stats):
+        if len(filenames) >= 2 or (links and filenames[0] in links):
+            yield size, filenames
+
+
+def pop_compact_groups(index, links=None, stats=None):
+    """Remove and yield all groups of files from a CompactFileIndex.
+
+    This is iter_size_groups() for a capidup.fileindex.CompactFileIndex.
+    The path of a file with a unique size is only built to look it up in
+    links, if there are any; otherwise, its size is removed without ever
+    building it.
+
+    Yields 2-tuples ``(size, filenames)``.
+
+    """
+    for size in list(index):
+        count = index.count(size)
+        if stats is not None:
+            stats.add_bucket(count)
+
+        if count >= 2:
+            yield size, index.pop(size)
+        elif links:
+            filenames = index.pop(size)
+            if filenames[0] in links:
+                yield size, filenames
+        else:
+            del index[size]
+
+
+def iter_group_batches(groups, max_files):
+    """Split groups of files into batches of at least max_files files.
+
+    groups is an iterable of 2-tuples ``(size, filenames)``. Only the last
+    batch may have less than max_files files; size groups are never split.
+
+    Yields lists of 2-tuples ``(size, filenames)``.
+
+    """
+    batch = []
+    num_files = 0
+
+    for size, filenames in groups:
+        batch.append((size, filenames))
+        num_files += len(filenames)
+
+        if num_files >= max_files:
+            yield batch
+            batch = []
+            num_files = 0
+
+    if batch:
+        yield batch
+
+
+def count_groups(groups, stats):
+    """Count groups of files in stats, as they go by.
+
+    groups is an iterable of 2-tuples ``(size, filenames)``, and stats a
+    capidup.scanstats.ScanStats, or None. Each group is counted as a size
+    bucket.
+
+    Yields the same groups.
+
+    """
+    for size, filenames in groups:
+        if stats is not None:
+            stats.add_bucket(len(filenames))
+        yield size, filenames
+
+
+def check_process_options(processes, digest_cache, device_workers):
+    """Validate the use of worker processes.
+
+    Raises ValueError if processes is not None nor a positive number, or if
+    it is combined with a digest_cache or device_workers, which can't be
+    shared between processes.
+
+    """
+    if processes is None:
+        return
+
+    if processes < 1:
+        raise ValueError("processes must be positive: %r" % (processes,))
+    if digest_cache is not None:
+        raise ValueError("processes and digest_cache are mutually exclusive")
+    if device_workers is not None:
+        raise ValueError("processes and device_workers are mutually "
+                         "exclusive")
+
+
+def pack_groups(groups):
+    """Pack groups of files compactly, for sending to a worker process.
+
+    groups is a list of 2-tuples ``(size, filenames)``. Each directory
+    name is only included once, however many files are in it.
+
+    Returns a 2-tuple ``(dirs, packed)``: dirs is a list of directory
+    names, and packed a list of ``(size, entries)`` tuples, where entries
+    is a list of ``(dir_index, base_name)`` tuples. See unpack_groups().
+
+    """
+    dir_indexes = {}
+    dirs = []
+    packed = []
+
+    for size, filenames in groups:
+        entries = []
+        for filename in filenames:
+            dirname, base_name = os.path.split(filename)
+
+            index = dir_indexes.get(dirname)
+            if index is None:
+                index = dir_indexes[dirname] = len(dirs)
+                dirs.append(dirname)
+
+            entries.append((index, base_name))
+        packed.append((size, entries))
+
+    return dirs, packed
+
+
+def unpack_groups(dirs, packed):
+    """Unpack groups of files packed by pack_groups()."""
+
+    return [(size, [os.path.join(dirs[index], base_name)
+                    for index, base_name in entries])
+            for size, entries in packed]
+
+
+def find_duplicates_in_batch(dirs, packed, options, with_stats=False):
+    """Find duplicates within a batch of size groups, in a worker process.
+
+    dirs and packed are the groups of the batch, from pack_groups().
+    options is a tuple of the arguments ``(partial_hash, full_hash,
+    lockstep, max_open_files, partial_schedule, sample_blocks, io_order,
+    restat, read_options)`` of find_duplicates_in_groups().
+
+    Returns a 3-tuple ``(duplicate_groups, errors, stats)``. stats is a
+    capidup.scanstats.ScanStats of the batch if with_stats is True, or
+    None otherwise.
+
+    """
+    (partial_hash, full_hash, lockstep, max_open_files, partial_schedule,
+     sample_blocks, io_order, restat, read_options) = options
+
+    errors = []
+    stats = ScanStats() if with_stats else None
+    duplicates = find_duplicates_in_groups(
+        unpack_groups(dirs, packed), partial_hash, full_hash, lockstep,
+        max_open_files, partial_schedule, None, None, errors, sample_blocks,
+        None, io_order, None, restat, stats, read_options)
+
+    return duplicates, errors, stats
+
+
+def iter_batches(groups, links):
+    """Split size groups into batches, for worker processes.
+
+    groups is an iterable of 2-tuples ``(size, filenames)``. Groups with a
+    single file are left out, unless the file has other hard links in the
+    links dictionary (see hardlink_links): these are yielded as a batch of
+    their own, with a True flag.
+
+    Yields 2-tuples ``(batch, linked)``, where batch is a list of groups.
+    Batches are closed after PROCESS_BATCH_BYTES bytes or MAX_PENDING_JOBS
+    files, whichever comes first.
+
+    """
+    batch = []
+    batch_bytes = 0
+    batch_files = 0
+
+    for size, filenames in groups:
+        if len(filenames) < 2:
+            if links and filenames[0] in links:
+                yield [(size, filenames)], True
+            continue
+
+        batch.append((size, filenames))
+        batch_bytes += size * len(filenames)
+        batch_files += len(filenames)
+
+        if (batch_bytes >= PROCESS_BATCH_BYTES
+                or batch_files >= MAX_PENDING_JOBS):
+            yield batch, False
+            batch = []
+            batch_bytes = 0
+            batch_files = 0
+
+    if batch:
+        yield batch, False
+
+
+def make_process_pool(processes):
+    """Create a pool of processes worker processes.
+
+    The workers are started by a fork server where the platform has one,
+    rather than forked from this process: the crawl leaves thread pools
+    behind, and a process forked while other threads hold locks may
+    deadlock on them.
+
+    """
+    # import here: concurrent.futures needs the "futures" backport on
+    # Python 2, and is only required when using processes
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    try:
+        context = multiprocessing.get_context("forkserver")
+    except (AttributeError, ValueError):     # pragma: no cover
+        # Python 2, or a platform that only spawns (e.g. Windows), where
+        # workers don't inherit our threads anyway
+        return ProcessPoolExecutor(max_workers=processes)
+
+    return ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+
+def iter_duplicates_in_processes(groups, processes, options, errors,
+        links=None, stats=None):
+    """Find duplicates within groups of files, in worker processes.
+
+    groups is an iterable of 2-tuples ``(size, filenames)``, like for
+    find_duplicates_in_groups(). It is split into batches of whole size
+    groups, sized by their estimated bytes (see iter_batches), which are
+    sent to a pool of processes worker processes in a compact form (see
+    pack_groups). Each worker runs all the stages for its own batches.
+    See make_process_pool() for how the workers are started.
+
+    options is as in find_duplicates_in_batch(). links is as in
+    find_duplicates_in_groups(). Error messages from the workers are
+    appended *in-place* to the errors list; the workers print them to
+    stderr themselves. stats is as in find_duplicates_in_groups(); the
+    statistics of the workers are merged into it, counting the wall time
+    of each stage rather than the sum of the workers' times.
+
+    Yields each group of duplicates (a list of filenames), as the batches
+    are done. The groups are the same as from find_duplicates_in_groups(),
+    but in a different order.
+
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    if links is None:
+        links = {}
+
+    pool = make_process_pool(processes)
+    pending = set()
+
+    def _finished(futures):
+        """Get the groups of duplicates from finished batches."""
+        duplicates = []
+        for future in futures:
+            batch_duplicates, batch_errors, batch_stats = future.result()
+            errors.extend(batch_errors)
+            for filenames in batch_duplicates:
+                expanded = expand_hardlinks(filenames, links)
+                if stats is not None:
+                    # the worker didn't know of the links
+                    batch_stats.duplicate_files += (len(expanded)
+                                                    - len(filenames))
+                duplicates.append(expanded)
+            if stats is not None:
+                stats.merge(batch_stats)
+        return duplicates
+
+    try:
+        for batch, linked in iter_batches(groups, links):
+            if linked:
+                # nothing to compare
+                size, filenames = batch[0]
+                expanded = expand_hardlinks(filenames, links)
+                if stats is not None:
+                    stats.add_duplicates(size, len(expanded), 1)
+                yield expanded
+                continue
+
+            dirs, packed = pack_groups(batch)
+            pending.add(pool.submit(find_duplicates_in_batch, dirs, packed,
+                                    options, stats is not None))
+            del batch, dirs, packed
+
+            # keep every worker busy, with one batch queued for each
+            if len(pending) >= 2 * processes:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for dup_group in _finished(done):
+                    yield dup_group
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for dup_group in _finished(done):
+                yield dup_group
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def iter_duplicates_in_dirs(directories, exclude_dirs=None,
+        exclude_files=None, follow_dirlinks=False, digest_cache=None,
+        workers=None, executor=None, partial_hash=DEFAULT_PARTIAL_HASH,
+        full_hash=DEFAULT_FULL_HASH, lockstep=False,
+        max_open_files=LOCKSTEP_MAX_OPEN_FILES, partial_schedule=None,
+        sample_blocks=0, hardlinks="include", io_order=None,
+        device_workers=None, device_stats=None, min_size=0, max_size=None,
+        file_filter=None, compact_index=False, memory_limit=None,
+        spill_dir=None, snapshot=None, processes=None, stats=None,
+        read_backend="auto", cache_friendly=False, errors=None):
+    """Recursively scan a list of directories, yielding duplicate files.
+
+    This is a generator version of :func:`find_duplicates_in_dirs`, which
+    see. It takes the same arguments, in the same order, and yields each
+    group of duplicates (a list of filenames) as soon as it is confirmed,
+    instead of returning a list of them at the end.
+
+    All directories must still be crawled before the first group can be
+    found. After that, size groups are resolved a few at a time (enough to
+    keep `workers` busy), and each one is dropped from memory as soon as
+    its duplicates have been yielded.
+
+    `errors`, if provided, should be a list. Error messages are appended to
+    it *in-place* as they occur, so they can be checked between groups.
+    They are also printed to stderr, as always. It should be passed by
+    keyword.
+
+    """
+    if errors is None:
+        errors = []
+
+    hashers.check_algorithm(partial_hash)
+    hashers.check_algorithm(full_hash)
+    if partial_schedule is not None:
+        partial_schedule = check_partial_schedule(partial_schedule)
+    check_sample_blocks(sample_blocks)
+    check_hardlinks_mode(hardlinks)
+    ioorder.check_io_order(io_order)
+    check_index_options(compact_index, memory_limit)
+    check_snapshot_options(snapshot, file_filter)
+    check_process_options(processes, digest_cache, device_workers)
+    read_options = readers.ReadOptions(read_backend, cache_friendly)
+
+    executor, owned = make_executor(workers, executor)
+    scheduler = make_scheduler(device_workers, device_stats)
+    files_by_size = None
+    start = time.time()
+    try:
+        inodes = {}
+        files_by_size = index_dirs(directories, exclude_dirs, exclude_files,
+                                   follow_dirlinks, executor, errors, inodes,
+                                   min_size, max_size, file_filter,
+                                   compact_index, memory_limit, spill_dir,
+                                   snapshot, stats)
+        links = hardlink_links(inodes) if hardlinks == "include" else None
+        del inodes
+
+        # sizes from the snapshot may be out of date
+        restat = snapshot is not None
+
+        size_groups = iter_size_groups(files_by_size, links, stats)
+
+        if processes is not None:
+            options = (partial_hash, full_hash, lockstep, max_open_files,
+                       partial_schedule, sample_blocks, io_order, restat,
+                       read_options)
+            for dup_group in iter_duplicates_in_processes(
+                    size_groups, processes, options, errors, links, stats):
+                yield dup_group
+        elif scheduler is not None:
+            # run the batches side by side, so that each device's queue
+            # keeps going across batches and stages
+            stage_iter = (group_stages(groups, partial_hash, full_hash,
+                                       lockstep, partial_schedule, errors,
+                                       sample_blocks, links, restat, stats)
+                          for groups in iter_group_batches(
+                              size_groups, MAX_PENDING_JOBS))
+            for dup_group in iter_stages_scheduled(
+                    stage_iter, digest_cache, executor, max_open_files,
+                    scheduler, io_order, read_options):
+                yield dup_group
+        else:
+            for groups in iter_group_batches(size_groups, MAX_PENDING_JOBS):
+                duplicates = find_duplicates_in_groups(
+                    groups, partial_hash, full_hash, lockstep,
+                    max_open_files, partial_schedule, digest_cache, executor,
+                    errors, sample_blocks, links, io_order, scheduler, restat,
+                    stats, read_options)
+                del groups
+
+                for dup_group in duplicates:
+                    yield dup_group
+
+        if digest_cache is not None:
+            digest_cache.commit()
+        if snapshot is not None:
+            snapshot.commit()
+        if stats is not None:
+            stats.seconds += time.time() - start
+    finally:
+        close_index(files_by_size)
+        if owned:
+            executor.shutdown()
+        if scheduler is not None:
+            scheduler.shutdown()
 
 
 def find_duplicates_in_dirs(directories, exclude_dirs=None, exclude_files=None,
-        follow_dirlinks=False):
+        follow_dirlinks=False, digest_cache=None, workers=None,
+        executor=None, partial_hash=DEFAULT_PARTIAL_HASH,
+        full_hash=DEFAULT_FULL_HASH, lockstep=False,
+        max_open_files=LOCKSTEP_MAX_OPEN_FILES, partial_schedule=None,
+        sample_blocks=0, hardlinks="include", io_order=None,
+        device_workers=None, device_stats=None, min_size=0, max_size=None,
+        file_filter=None, compact_index=False, memory_limit=None,
+        spill_dir=None, snapshot=None, processes=None, stats=None,
+        read_backend="auto", cache_friendly=False):
     """Recursively scan a list of directories, looking for duplicate files.
 
     `exclude_dirs`, if provided, should be a list of glob patterns.
@@ -363,9 +2314,141 @@ def find_duplicates_in_dirs(directories, exclude_dirs=None, exclude_files=None,
     `exclude_files`, if provided, should be a list of glob patterns. Files
     whose names match these patterns are excluded from the scan.
 
+    Exclude patterns with a slash at the beginning or in the middle are
+    matched against the path relative to each directory being scanned,
+    like in gitignore: ``build/out`` excludes only that subdirectory, and
+    ``**/tmp`` excludes ``tmp`` at any depth. Whole subtrees are pruned
+    without being listed. See :mod:`capidup.matcher`.
+
     ``follow_dirlinks`` controls whether to follow symbolic links to
     subdirectories while crawling.
 
+    `min_size` and `max_size`, if provided, leave out files smaller or
+    larger than the given number of bytes. `file_filter`, if provided,
+    should be a function ``file_filter(path, stat_result)``, returning
+    True for files to include: e.g. to select files by modification time,
+    owner or extension. It may be called from several threads at once, if
+    using `workers`. Files that are left out are never indexed nor opened.
+
+    `digest_cache`, if provided, should be a
+    :class:`capidup.digestcache.DigestCache`. Both partial and full hashes
+    are looked up in it before reading a file, and stored in it after.
+    Pending changes to the cache are committed before returning.
+
+    `workers` and `executor` are as in :func:`find_duplicates`. They are
+    used both to crawl directories concurrently, and to hash files. Size
+    groups are compared a batch at a time, and the files of all groups in
+    a batch are hashed concurrently, in each of the partial and the full
+    stages.
+
+    `partial_hash` and `full_hash` are the names of the hash algorithms
+    used to compare the initial portion of large files, and entire files,
+    respectively. See :mod:`capidup.hashers` for the supported algorithms.
+    By default, a fast non-cryptographic hash is used for the partial
+    stage if the xxhash package is installed, and MD5 otherwise; MD5 is
+    always used for the full stage. Any matches in the partial stage are
+    confirmed by the full stage, so a weak `partial_hash` never causes
+    false positives.
+
+    `lockstep` and `max_open_files` are as in :func:`find_duplicates`. If
+    `lockstep` is True, `full_hash` is not used, and files in the full
+    stage are compared byte by byte instead.
+
+    `partial_schedule`, if provided, should be a sequence of increasing
+    read sizes in bytes, e.g. :data:`PROGRESSIVE_PARTIAL_SCHEDULE`. It
+    replaces the single partial stage with one stage per read size: each
+    stage only hashes the next portion of the files that matched so far,
+    up to its read size. Files no larger than a read size skip it and any
+    further stages. If `partial_hash` is the same as `full_hash`, the full
+    stage then only hashes the rest of the file; otherwise, it hashes the
+    whole file, so that the prefixes are also compared with `full_hash`.
+    By default, a single partial stage is done, sized according to the
+    ``PARTIAL_MD5_*`` constants.
+
+    `sample_blocks`, if not 0, adds a sampling stage after the partial
+    stage(s), for files larger than ``2 * sample_blocks *``
+    :data:`SAMPLE_BLOCK_SIZE` bytes. It hashes `sample_blocks` blocks
+    spread evenly over each file, from the head to the tail, at offsets
+    derived from the file size. This weeds out large files that share a
+    common header, such as media containers or disk images, before they
+    are read in full. It must be 0, or at least 2.
+
+    Files with several hard links are only read once, whatever path they
+    are found at. `hardlinks` controls how they are reported: with
+    ``"include"`` (the default), every path is reported, so that all the
+    links to a file are a group of duplicates; with ``"exclude"``, only
+    the first path found for each file is reported.
+
+    `io_order`, if provided, sorts the reads of each hashing stage by
+    their location on disk, across the size groups of each batch:
+    ``"inode"`` sorts them by inode number, and ``"physical"`` by the
+    physical offset of the data, where the OS and filesystem can tell. See
+    :mod:`capidup.ioorder`. This speeds up scans of spinning disks, by
+    reducing seeks. It doesn't change the results, nor the order of
+    lockstep comparisons.
+
+    `device_workers`, if provided, gives each device (st_dev) its own
+    queue of files to hash, with that many threads. All devices are then
+    kept busy at once, and a slow device doesn't hold back the others:
+    batches of size groups go through the stages independently, so only
+    the batches with files on a slow device wait for it.
+    This replaces `workers` and `executor` for hashing, but not for
+    crawling nor for lockstep comparisons. `device_stats`, if provided,
+    should be a dictionary; the number of files, bytes read and seconds
+    spent hashing on each device are added to it *in-place*. See
+    :class:`capidup.devsched.DeviceScheduler`.
+
+    `compact_index`, if True, indexes the files in a
+    :class:`capidup.fileindex.CompactFileIndex` instead of a dictionary of
+    lists of paths. This uses much less memory for very large trees: full
+    paths are not kept in memory, and are only built for one batch of
+    size groups at a time, when they are about to be compared. The
+    results are the same.
+
+    `memory_limit`, if provided, bounds the memory used by the index to
+    approximately that many bytes: past it, files are spilled to sorted
+    run files in a temporary directory, under `spill_dir` if provided.
+    Size groups are then read back in increasing order of size, by merging
+    the runs, and compared a batch at a time; so memory usage doesn't grow
+    with the number of files. The duplicate groups found are the same, but
+    may be in a different order. See
+    :class:`capidup.spillindex.SpillingFileIndex`. It can't be combined
+    with `compact_index`.
+
+    `snapshot`, if provided, should be a
+    :class:`capidup.snapshot.DirSnapshot`. The listing of each directory
+    is stored in it, and directories whose modification time hasn't
+    changed since are not listed again: a rescan of a mostly unchanged
+    tree then costs one stat per directory, plus the files that may have
+    duplicates. These are stat'ed again before being compared, so files
+    modified in place are regrouped by their current size; but a file
+    whose stored size was unique is not, and a duplicate it became by
+    changing size is missed until its directory changes. With a
+    `digest_cache`, the groups that didn't change are then confirmed
+    without reading any files. It can't be combined with `file_filter`.
+    Pending changes to the snapshot are committed before returning.
+
+    `processes`, if provided, compares the files in that many worker
+    processes instead of in this one, which helps with CPU-heavy hash
+    algorithms that would otherwise be bound by the GIL. The size groups
+    are split into batches of about :data:`PROCESS_BATCH_BYTES` bytes to
+    compare, which are sent to the workers as compact lists of paths; each
+    worker runs all the stages for its own batches. The duplicate groups
+    found are the same, but in a different order. `workers` and
+    `executor` are then only used for crawling. It can't be combined with
+    `digest_cache` nor `device_workers`.
+
+    `stats`, if provided, should be a
+    :class:`capidup.scanstats.ScanStats`. It is filled *in-place* with
+    counters and timings of the scan: directories and files visited or
+    pruned, size buckets, the files and bytes that went through each
+    stage and the fraction of them each stage eliminated, the time spent
+    in each stage, and the bytes that could be reclaimed by removing the
+    duplicates.
+
+    `read_backend` and `cache_friendly` are as in :func:`find_duplicates`.
+    They apply to every stage, in worker processes as well.
+
     Returns a 2-tuple of two values: ``(duplicate_groups, errors)``.
 
     `duplicate_groups` is a (possibly empty) list of lists: the names of files
@@ -385,57 +2468,30 @@ def find_duplicates_in_dirs(directories, exclude_dirs=None, exclude_files=None,
       >>> errs
       []
 
-    """
-    if exclude_dirs is None:
-        exclude_dirs = []
+    Only `directories`, `exclude_dirs`, `exclude_files` and
+    `follow_dirlinks` should be passed by position; any other arguments
+    should be passed by keyword.
 
-    if exclude_files is None:
-        exclude_files = []
+    See also :func:`iter_duplicates_in_dirs`, which yields the groups of
+    duplicates as they are found.
 
-    errors_in_total = []
-    files_by_size = {}
-
-    # First, group all files by size
-    for directory in directories:
-        sub_errors = index_files_by_size(directory, files_by_size, exclude_dirs,
-                                         exclude_files, follow_dirlinks)
-        errors_in_total += sub_errors
+    """
+    errors = []
 
-    all_duplicates = []
+    duplicates = list(iter_duplicates_in_dirs(
+        directories, exclude_dirs, exclude_files, follow_dirlinks,
+        digest_cache=digest_cache, workers=workers, executor=executor,
+        partial_hash=partial_hash, full_hash=full_hash, lockstep=lockstep,
+        max_open_files=max_open_files, partial_schedule=partial_schedule,
+        sample_blocks=sample_blocks, hardlinks=hardlinks, io_order=io_order,
+        device_workers=device_workers, device_stats=device_stats,
+        min_size=min_size, max_size=max_size, file_filter=file_filter,
+        compact_index=compact_index, memory_limit=memory_limit,
+        spill_dir=spill_dir, snapshot=snapshot, processes=processes,
+        stats=stats, read_backend=read_backend,
+        cache_friendly=cache_friendly, errors=errors))
 
-    # Now, within each file size, check for duplicates.
-    #
-    # We use an iterator over the dict (which gives us the keys), instead
-    # of explicitly accessing dict.keys(). On Python 2, dict.keys() returns
-    # a list copy of the keys, which may be very large.
-    for size in iter(files_by_size):
-        # for large file sizes, divide them further into groups by matching
-        # initial portion; how much of the file is used to match depends on
-        # the file size
-        if size >= PARTIAL_MD5_THRESHOLD:
-            partial_size = min(round_up_to_mult(size // PARTIAL_MD5_READ_RATIO,
-                                                PARTIAL_MD5_READ_MULT),
-                               PARTIAL_MD5_MAX_READ)
-
-            possible_duplicates_list, sub_errors = find_duplicates(files_by_size[size], partial_size)
-            errors_in_total += sub_errors
-        else:
-            # small file size, group them all together and do full MD5s
-            possible_duplicates_list = [files_by_size[size]]
-
-
-        # Do full MD5 scan on suspected duplicates. calculate_md5 (and
-        # therefore find_duplicates) needs to know how many bytes to scan.
-        # We're using the file's size, as per stat(); this is a problem if
-        # the file is growing. We'll only scan up to the size the file had
-        # when we indexed. Would be better to somehow tell calculate_md5 to
-        # scan until EOF (e.g. give it a negative size).
-        for possible_duplicates in possible_duplicates_list:
-            duplicates, sub_errors = find_duplicates(possible_duplicates, size)
-            all_duplicates += duplicates
-            errors_in_total += sub_errors
-
-    return all_duplicates, errors_in_total
+    return duplicates, errors
 
 
 # vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
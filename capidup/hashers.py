@@ -0,0 +1,148 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Hash algorithms for comparing file contents.
+
+Public functions:
+
+    new_hasher -- create a hash object for an algorithm, by name
+    check_algorithm -- make sure an algorithm is supported
+    available_algorithms -- get the names of all usable algorithms
+
+Public data attributes:
+
+    FAST_ALGORITHM -- fastest available algorithm, for pre-filtering
+    DEFAULT_PARTIAL_HASH -- default algorithm for partial comparisons
+    DEFAULT_FULL_HASH -- default algorithm for full comparisons
+
+Besides every algorithm supported by hashlib (md5, sha1, sha256, blake2b,
+and so on), the non-cryptographic ``crc32`` is always available, and
+``xxh64``, ``xxh3_64`` and ``xxh128`` are available if the xxhash package
+is installed.
+
+Non-cryptographic algorithms are much faster, but more prone to
+collisions. They are well suited for the partial stage, whose matches
+are always confirmed by a full comparison.
+
+"""
+
+import hashlib
+import struct
+import zlib
+
+try:
+    import xxhash
+except ImportError:     # pragma: no cover
+    xxhash = None
+
+
+__all__ = [ "new_hasher", "check_algorithm", "available_algorithms",
+        "FAST_ALGORITHM", "DEFAULT_PARTIAL_HASH", "DEFAULT_FULL_HASH" ]
+
+
+class Crc32Hasher(object):
+    """CRC-32 with a hashlib-like interface."""
+
+    name = "crc32"
+    digest_size = 4
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        """Update the CRC with more data."""
+
+        self._crc = zlib.crc32(data, self._crc)
+
+    def digest(self):
+        """Get the CRC as a 4-byte big-endian string."""
+
+        return struct.pack(">I", self._crc & 0xffffffff)
+
+
+_EXTRA_ALGORITHMS = { "crc32": Crc32Hasher }
+
+if xxhash is not None:  # pragma: no cover
+    for _name in ("xxh64", "xxh3_64", "xxh128"):
+        if hasattr(xxhash, _name):
+            _EXTRA_ALGORITHMS[_name] = getattr(xxhash, _name)
+
+
+_HASHLIB_CONSTRUCTORS = ("md5", "sha1", "sha224", "sha256", "sha384", "sha512",
+                         "blake2b", "blake2s")
+
+
+def new_hasher(name):
+    """Create a new hash object, for the algorithm with the given name.
+
+    The returned object has update() and digest() methods, like the ones
+    from hashlib.
+
+    Raises ValueError if the algorithm is not supported.
+
+    """
+    constructor = _EXTRA_ALGORITHMS.get(name)
+    if constructor is not None:
+        return constructor()
+
+    # the named constructors are faster than hashlib.new()
+    if name in _HASHLIB_CONSTRUCTORS and hasattr(hashlib, name):
+        return getattr(hashlib, name)()
+
+    try:
+        return hashlib.new(name)
+    except (ValueError, TypeError):
+        raise ValueError("unsupported hash algorithm: %r" % (name,))
+
+
+def check_algorithm(name):
+    """Make sure an algorithm is supported.
+
+    Raises ValueError if it isn't.
+
+    """
+    new_hasher(name)
+
+
+def available_algorithms():
+    """Get the names of all supported algorithms, as a set."""
+
+    # algorithms_available is Python 3.2+; algorithms is Python 2.7
+    hashlib_names = getattr(hashlib, "algorithms_available",
+                            getattr(hashlib, "algorithms",
+                                    ("md5", "sha1", "sha224", "sha256",
+                                     "sha384", "sha512")))
+
+    return set(hashlib_names) | set(_EXTRA_ALGORITHMS)
+
+
+FAST_ALGORITHM = "xxh3_64" if "xxh3_64" in _EXTRA_ALGORITHMS else \
+        "xxh64" if "xxh64" in _EXTRA_ALGORITHMS else "md5"
+"""Fastest available algorithm: from xxhash if installed, otherwise MD5."""
+
+DEFAULT_PARTIAL_HASH = FAST_ALGORITHM
+"""Default algorithm for hashing the initial portion of files."""
+
+DEFAULT_FULL_HASH = "md5"
+"""Default algorithm for hashing entire files."""
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
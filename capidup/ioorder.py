@@ -0,0 +1,161 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Ordering of file reads by their location on disk.
+
+Public functions:
+
+    check_io_order -- make sure an ordering mode is supported
+    read_order -- get the order in which to read a list of files
+    physical_offset -- get the physical location of a file on disk
+
+Reading many files from a spinning disk in an arbitrary order is bound by
+seek time. Reading them in the order they are laid out on disk turns that
+into a mostly sequential sweep. Two ordering modes are supported:
+
+``inode``
+    Sort by device and inode number. Most filesystems allocate the data
+    of files roughly in the order of their inodes, so this is a cheap
+    approximation of their physical order.
+``physical``
+    Sort by device and physical offset of the data, as reported by the
+    FIEMAP ioctl. Only on Linux, and only on filesystems that support it;
+    files whose offset can't be found are sorted by inode instead, after
+    the others on the same device.
+
+"""
+
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:     # pragma: no cover
+    fcntl = None
+
+
+__all__ = [ "check_io_order", "read_order", "physical_offset" ]
+
+
+IO_ORDERS = ("inode", "physical")
+"""Names of the supported ordering modes."""
+
+_FS_IOC_FIEMAP = 0xC020660B
+
+# struct fiemap, followed by a single struct fiemap_extent
+_FIEMAP_FORMAT = "=QQLLLL"
+_FIEMAP_EXTENT_FORMAT = "=QQQQQLLLL"
+
+_FIEMAP_EXTENT_UNKNOWN = 0x00000002
+
+
+def check_io_order(io_order):
+    """Make sure an ordering mode is supported.
+
+    io_order may also be None, for no particular order. Raises ValueError
+    otherwise.
+
+    """
+    if io_order is not None and io_order not in IO_ORDERS:
+        raise ValueError("unsupported I/O order: %r" % (io_order,))
+
+
+def physical_offset(filename, offset=0):
+    """Get the physical location on disk of a file's data.
+
+    offset is the position in the file of interest; the physical location
+    of the extent containing it (or the next one) is returned.
+
+    Returns the physical offset in bytes from the start of the device, or
+    None if it can't be found: the OS or filesystem doesn't support FIEMAP,
+    the file has no data allocated there, or an error occurred.
+
+    """
+    if fcntl is None:   # pragma: no cover
+        return None
+
+    request = struct.pack(_FIEMAP_FORMAT, offset, (1 << 64) - 1 - offset,
+                          0, 0, 1, 0)
+    request += b"\0" * struct.calcsize(_FIEMAP_EXTENT_FORMAT)
+
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        reply = fcntl.ioctl(fd, _FS_IOC_FIEMAP, request)
+    except (IOError, OSError):
+        return None
+    finally:
+        os.close(fd)
+
+    header_size = struct.calcsize(_FIEMAP_FORMAT)
+    mapped_extents = struct.unpack(_FIEMAP_FORMAT, reply[:header_size])[3]
+    if not mapped_extents:
+        return None
+
+    extent = struct.unpack(_FIEMAP_EXTENT_FORMAT, reply[header_size:])
+    physical, flags = extent[1], extent[5]
+    if flags & _FIEMAP_EXTENT_UNKNOWN:
+        # e.g. delayed allocation: location not decided yet
+        return None
+
+    return physical
+
+
+def _sort_key(filename, offset, io_order):
+    """Get the sort key of a file, for read_order().
+
+    Files that can't be stat'ed go last; hashing them will report the error.
+
+    """
+    try:
+        file_info = os.stat(filename)
+    except OSError:
+        return (1, 0, 0, 0)
+
+    if io_order == "physical":
+        physical = physical_offset(filename, offset)
+        if physical is not None:
+            return (0, file_info.st_dev, 0, physical)
+
+    return (0, file_info.st_dev, 1, file_info.st_ino)
+
+
+def read_order(filenames, offsets, io_order):
+    """Get the order in which to read a list of files.
+
+    offsets gives the position in each file that will be read first.
+    io_order is one of the supported modes (see check_io_order).
+
+    Returns a list of indexes into filenames, in reading order. Files are
+    stat'ed (and possibly opened) to sort them, but not read.
+
+    """
+    keys = [_sort_key(filename, offset, io_order)
+            for filename, offset in zip(filenames, offsets)]
+
+    return sorted(range(len(filenames)), key=keys.__getitem__)
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
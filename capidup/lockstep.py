@@ -0,0 +1,221 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Byte-by-byte comparison of groups of files, reading them in lockstep.
+
+Public functions:
+
+    split_group_lockstep -- split a group of files by their exact contents
+
+Public data attributes:
+
+    LOCKSTEP_MAX_OPEN_FILES -- default limit of open files per group
+    LOCKSTEP_MAX_BUFFER -- memory limit for the chunks of a group
+
+All files of a group are read chunk by chunk, at the same offset. After
+each chunk, the group is split by the contents of that chunk, and files
+left on their own are dropped. Reading stops as soon as no two files
+match, so files that differ early on are never read to the end. Since
+the files themselves are compared, and not their hashes, there is no
+risk of collisions.
+
+"""
+
+import errno
+
+from capidup import readers
+
+
+__all__ = [ "split_group_lockstep", "LOCKSTEP_MAX_OPEN_FILES",
+        "LOCKSTEP_MAX_BUFFER" ]
+
+
+LOCKSTEP_MAX_OPEN_FILES = 256
+"""Default maximum number of files kept open, while comparing a group.
+
+Files beyond this limit are reopened for every chunk.
+"""
+
+LOCKSTEP_MAX_BUFFER = 64 * 1024 * 1024
+"""Maximum total size in bytes of the chunks held in memory for a group.
+
+Large groups are read in smaller chunks, to stay below this limit.
+"""
+
+LOCKSTEP_MIN_CHUNK_SIZE = 4 * 1024
+"""Minimum chunk size in bytes, regardless of LOCKSTEP_MAX_BUFFER."""
+
+
+class LockstepFile(object):
+    """A file being compared, possibly without an open file descriptor.
+
+    If keep_open is False, the file is opened, read and closed again on
+    every read, so it doesn't count against the open files limit. If
+    cache_friendly is True, files are opened and read as in the
+    cache-friendly mode of capidup.readers.
+
+    """
+
+    def __init__(self, filename, keep_open, cache_friendly=False):
+        self.filename = filename
+        self.offset = 0
+        self._cache_friendly = cache_friendly
+        self._file = (readers.open_file(filename, cache_friendly)
+                      if keep_open else None)
+
+    def _read(self, f, size):
+        """Read size bytes from an open file, at the current offset."""
+
+        chunk = f.read(size)
+        if self._cache_friendly:
+            readers.drop_cache(f, self.offset, len(chunk))
+
+        return chunk
+
+    def read(self, size):
+        """Read the next size bytes from the file."""
+
+        if self._file is not None:
+            chunk = self._read(self._file, size)
+        else:
+            f = readers.open_file(self.filename, self._cache_friendly)
+            try:
+                f.seek(self.offset)
+                chunk = self._read(f, size)
+            finally:
+                f.close()
+
+        self.offset += len(chunk)
+
+        return chunk
+
+    def close(self):
+        """Close the file, if it is open."""
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _error_message(filename, e):
+    """Format an error message for a file that couldn't be read."""
+
+    return "unable to read '%s': %s" % (filename, e.strerror)
+
+
+def split_group_lockstep(filenames, size, chunk_size,
+        max_open_files=LOCKSTEP_MAX_OPEN_FILES, cache_friendly=False):
+    """Split a group of files of the same size by their exact contents.
+
+    filenames is the list of files to compare, all with the given size.
+
+    chunk_size is the preferred size in bytes of each read. It is reduced
+    for large groups, so that at most LOCKSTEP_MAX_BUFFER bytes are held
+    in memory at a time.
+
+    At most max_open_files files are kept open at any time; the others are
+    reopened for each chunk.
+
+    If cache_friendly is True, files are read in the cache-friendly mode
+    of capidup.readers: each chunk is dropped from the page cache once it
+    has been compared.
+
+    Returns a 3-tuple ``(duplicate_groups, errors, bytes_read)``. The
+    first two are like capidup.finddups.find_duplicates(): files that
+    can't be read are left out of the results, with an error message each.
+    bytes_read is the number of bytes actually read, over all the files;
+    reading a file stops as soon as it differs from all the others.
+
+    """
+    errors = []
+    bytes_read = 0
+
+    if len(filenames) < 2:
+        return [], errors, bytes_read
+
+    chunk_size = min(chunk_size,
+                     max(LOCKSTEP_MAX_BUFFER // len(filenames),
+                         LOCKSTEP_MIN_CHUNK_SIZE))
+
+    group = []
+    for filename in filenames:
+        try:
+            group.append(LockstepFile(filename,
+                                      len(group) < max_open_files,
+                                      cache_friendly))
+        except EnvironmentError as e:
+            errors.append(_error_message(filename, e))
+
+    if len(group) >= 2:
+        groups = [group]
+    else:
+        groups = []
+        for f in group:
+            f.close()
+
+    offset = 0
+    try:
+        while groups and offset < size:
+            length = min(chunk_size, size - offset)
+            new_groups = []
+
+            for group in groups:
+                files_by_chunk = {}
+
+                for f in group:
+                    try:
+                        chunk = f.read(length)
+                    except EnvironmentError as e:
+                        errors.append(_error_message(f.filename, e))
+                        f.close()
+                        continue
+
+                    bytes_read += len(chunk)
+
+                    if len(chunk) != length:
+                        # truncated while we were reading
+                        e = EnvironmentError(errno.EIO, "file changed size")
+                        errors.append(_error_message(f.filename, e))
+                        f.close()
+                        continue
+
+                    files_by_chunk.setdefault(chunk, []).append(f)
+
+                for subgroup in files_by_chunk.values():
+                    if len(subgroup) >= 2:
+                        new_groups.append(subgroup)
+                    else:
+                        # diverged from all others; stop reading it
+                        subgroup[0].close()
+
+            groups = new_groups
+            offset += length
+    finally:
+        for group in groups:
+            for f in group:
+                f.close()
+
+    duplicates = [[f.filename for f in group] for group in groups]
+
+    return duplicates, errors, bytes_read
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
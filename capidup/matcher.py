@@ -0,0 +1,288 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Matching of names and paths against exclude patterns.
+
+Public classes:
+
+    ExcludeMatcher -- a list of exclude patterns, compiled for speed
+
+Public functions:
+
+    compile_excludes -- get an ExcludeMatcher from a list of patterns
+
+Patterns are shell-style globs, as for the fnmatch module. There are two
+kinds of patterns, following the rules of gitignore:
+
+- Patterns without a slash, other than a trailing one, match the name of
+  a file or directory anywhere in the tree: ``*.bak`` excludes every file
+  ending in ".bak".
+
+- Patterns with a slash at the beginning or in the middle match the path
+  relative to the root directory being scanned. ``build/out`` excludes
+  only that subdirectory of the root, and not e.g. ``src/build/out``.
+  Here, ``*`` and ``?`` don't match a slash. ``**`` matches across
+  slashes: ``**/tmp`` matches ``tmp`` at any depth, and ``a/**/b``
+  matches ``a/b``, ``a/x/b``, ``a/x/y/b`` and so on.
+
+A trailing slash is ignored, as only directory patterns are ever matched
+against directories.
+
+All patterns are compiled into a single regular expression for each kind.
+Patterns that are literal names, or a ``*`` followed by a literal suffix
+(e.g. ``*.bak``), don't even need that: they are checked with a set lookup
+and a single str.endswith() call.
+
+"""
+
+import os
+import re
+
+from capidup import py3compat
+
+
+__all__ = [ "ExcludeMatcher", "compile_excludes" ]
+
+
+_GLOB_CHARS = "*?["
+
+
+def _normcase(s):
+    """Normalize the case of a name or path, as fnmatch does."""
+
+    return os.path.normcase(s).replace(os.sep, "/")
+
+
+def _translate_set(pattern, i, j, path_mode):
+    """Translate a glob character set into a regular expression.
+
+    The set is pattern[i:j], without the brackets. This follows what
+    fnmatch does on current Python versions: empty ranges (e.g. ``z-a``)
+    are dropped, and characters that are special in regular expression
+    sets (backslashes, hyphens not making ranges, and the ``&``, ``~``
+    and ``|`` of set operations) are escaped. A set that can't match
+    anything becomes ``(?!)``.
+
+    In path_mode, negated sets don't match slashes.
+
+    """
+    stuff = pattern[i:j]
+
+    if "-" not in stuff:
+        stuff = stuff.replace("\\", "\\\\")
+    else:
+        # split at the hyphens that make ranges
+        chunks = []
+        k = i + 2 if pattern[i] == "!" else i + 1
+        while True:
+            k = pattern.find("-", k, j)
+            if k < 0:
+                break
+            chunks.append(pattern[i:k])
+            i = k + 1
+            k = k + 3
+        chunk = pattern[i:j]
+        if chunk:
+            chunks.append(chunk)
+        else:
+            chunks[-1] += "-"
+
+        # remove empty ranges, which are invalid in regular expressions
+        for k in range(len(chunks) - 1, 0, -1):
+            if chunks[k - 1][-1] > chunks[k][0]:
+                chunks[k - 1] = chunks[k - 1][:-1] + chunks[k][1:]
+                del chunks[k]
+
+        stuff = "-".join(chunk.replace("\\", "\\\\").replace("-", "\\-")
+                         for chunk in chunks)
+
+    # escape set operations (&&, ~~ and ||)
+    stuff = re.sub(r"([&~|])", r"\\\1", stuff)
+
+    if not stuff:
+        # empty set: never matches
+        return "(?!)"
+    if stuff == "!":
+        # negated empty set: matches any character
+        return "[^/]" if path_mode else "."
+
+    if stuff[0] == "!":
+        stuff = ("^/" if path_mode else "^") + stuff[1:]
+    elif stuff[0] in ("^", "["):
+        stuff = "\\" + stuff
+
+    return "[%s]" % stuff
+
+
+def _translate(pattern, path_mode):
+    """Translate a glob pattern into a regular expression.
+
+    In path_mode, ``*`` and ``?`` don't match slashes, and ``**`` does.
+    Otherwise, the translation is the same as fnmatch's.
+
+    Returns the regular expression, as a string without anchors.
+
+    """
+    any_char = "[^/]" if path_mode else "."
+    i, n = 0, len(pattern)
+    res = []
+
+    while i < n:
+        c = pattern[i]
+        i += 1
+
+        if c == "*":
+            if path_mode and pattern[i:i + 1] == "*":
+                i += 1
+                if pattern[i:i + 1] == "/":
+                    # "**/": zero or more leading directories
+                    i += 1
+                    res.append("(?:.*/)?")
+                else:
+                    res.append(".*")
+            else:
+                res.append(any_char + "*")
+
+        elif c == "?":
+            res.append(any_char)
+
+        elif c == "[":
+            j = i
+            if pattern[j:j + 1] == "!":
+                j += 1
+            if pattern[j:j + 1] == "]":
+                j += 1
+            j = pattern.find("]", j)
+
+            if j < 0:
+                # no closing bracket: a literal "["
+                res.append("\\[")
+            else:
+                res.append(_translate_set(pattern, i, j, path_mode))
+                i = j + 1
+
+        else:
+            res.append(re.escape(c))
+
+    return "".join(res)
+
+
+def _compile(regexes):
+    """Compile a list of regular expressions into one, or None if empty."""
+
+    if not regexes:
+        return None
+
+    return re.compile("(?:%s)\\Z" % "|".join(regexes), re.DOTALL)
+
+
+class ExcludeMatcher(object):
+    """A list of exclude patterns, compiled for fast matching.
+
+    patterns is a list of glob patterns, as described in the module
+    documentation. The original list is kept in the `patterns` attribute.
+
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+
+        literals = set()
+        suffixes = []
+        name_regexes = []
+        path_regexes = []
+
+        for pattern in self.patterns:
+            pattern = _normcase(pattern).rstrip("/")
+
+            if "/" in pattern:
+                # anchored to the root; a leading slash is only a marker
+                path_regexes.append(_translate(pattern.lstrip("/"), True))
+            elif not any(c in pattern for c in _GLOB_CHARS):
+                literals.add(pattern)
+            elif (pattern.startswith("*")
+                  and not any(c in pattern[1:] for c in _GLOB_CHARS)):
+                suffixes.append(pattern[1:])
+            else:
+                name_regexes.append(_translate(pattern, False))
+
+        self._literals = frozenset(literals)
+        self._suffixes = tuple(suffixes)
+        self._name_regex = _compile(name_regexes)
+        self._path_regex = _compile(path_regexes)
+
+        self.has_path_rules = self._path_regex is not None
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    __nonzero__ = __bool__
+
+    def match(self, name, rel_dir=""):
+        """Check whether a file or directory is excluded.
+
+        name is its base name. rel_dir is the path of its parent directory,
+        relative to the root of the scan, with "/" as the separator ("" for
+        the root itself). It's only needed if there are path patterns.
+
+        name may be bytes, as listed from a bytes root; it is then decoded
+        as the OS does for file names.
+
+        Returns True if at least one of the patterns matches.
+
+        """
+        if not self.patterns:
+            return False
+
+        name = _normcase(py3compat.fsdecode(name))
+
+        if name in self._literals:
+            return True
+
+        if self._suffixes and name.endswith(self._suffixes):
+            return True
+
+        if self._name_regex is not None and self._name_regex.match(name):
+            return True
+
+        if self._path_regex is not None:
+            path = "%s/%s" % (rel_dir, name) if rel_dir else name
+            if self._path_regex.match(path):
+                return True
+
+        return False
+
+
+def compile_excludes(patterns):
+    """Get an ExcludeMatcher for a list of patterns.
+
+    patterns may be None (no patterns), a list of patterns, or an existing
+    ExcludeMatcher, which is returned as is.
+
+    """
+    if isinstance(patterns, ExcludeMatcher):
+        return patterns
+
+    return ExcludeMatcher(patterns or [])
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
@@ -25,9 +25,15 @@ Public members:
 
     itervalues: get an iterator over a dict's values
     iteritems: get an iterator over a dict's (key, value) items
+    izip: get an iterator over tuples of items from several iterables
+    scandir: get an iterator over the entries of a directory
+    fsdecode: get a file name as text, decoding it if it's bytes
 
 """
 
+import os
+import stat
+
 # Dictionary helper functions. Definitions from PEP469 (public domain)
 try:
     dict.iteritems
@@ -47,3 +53,86 @@ else:                   # pragma: no cover
     def iteritems(d):
         """Get an iterator over the (key, value) items of d."""
         return d.iteritems()
+
+try:
+    from os import fsdecode
+except ImportError:     # pragma: no cover
+    # Python 2: file names are str, as are patterns
+    def fsdecode(filename):
+        """Get a file name as text; a no-op on Python 2."""
+        return filename
+
+try:
+    from itertools import izip
+except ImportError:     # pragma: no cover
+    # Python 3
+    izip = zip
+
+
+class _DirEntry(object):
+    """Minimal replacement for os.DirEntry, for the scandir() fallback.
+
+    Only the parts used by capidup are implemented. Nothing is known from
+    the directory listing, so the first call to any method does an
+    lstat(), whose result is cached like in os.DirEntry.
+
+    """
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._lstat = None
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        """Get the stat result of the entry, cached."""
+
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+
+        if not follow_symlinks or not stat.S_ISLNK(self._lstat.st_mode):
+            return self._lstat
+
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+
+        return self._stat
+
+    def _test_mode(self, test, follow_symlinks):
+        """Test the file type, with the same semantics as os.DirEntry."""
+
+        try:
+            return test(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self, follow_symlinks=True):
+        """Check if the entry is a directory."""
+
+        return self._test_mode(stat.S_ISDIR, follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        """Check if the entry is a regular file."""
+
+        return self._test_mode(stat.S_ISREG, follow_symlinks)
+
+    def is_symlink(self):
+        """Check if the entry is a symbolic link."""
+
+        return self._test_mode(stat.S_ISLNK, False)
+
+
+def _listdir_scandir(path):
+    """Fallback scandir(), for when neither os nor scandir have it."""
+
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+try:
+    from os import scandir
+except ImportError:     # pragma: no cover
+    try:
+        # Python 2, with the scandir backport
+        from scandir import scandir
+    except ImportError:
+        scandir = _listdir_scandir
@@ -0,0 +1,336 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Ways of reading file contents into a hash object.
+
+Public classes:
+
+    ReadOptions -- how files are read for hashing
+
+Public functions:
+
+    hash_region -- feed a region of an open file to a new hash object
+    available_backends -- get the names of all usable backends
+    open_file -- open a file for hashing
+    drop_cache -- drop an already read region of a file from the cache
+
+Public data attributes:
+
+    DEFAULT_READ_OPTIONS -- the default ReadOptions
+    MMAP_MIN_SIZE -- smallest region the mmap backend maps into memory
+
+The available backends are:
+
+``read``
+    Read the file chunk by chunk. Each chunk is a new bytes object.
+``readinto``
+    Read into a single buffer, reused for every chunk. This avoids
+    allocating and freeing memory for each chunk.
+``mmap``
+    Map large regions of the file into memory, and hash them from there
+    without any copy. Smaller regions are read as with ``readinto``.
+``file_digest``
+    Use hashlib.file_digest(), on Python 3.11 and later. Only for regions
+    that extend to the end of the file; others are read as with
+    ``readinto``.
+
+By default (``auto``), ``file_digest`` is used where possible, and
+``readinto`` otherwise. The ``mmap`` backend is never chosen
+automatically: if a file is truncated while it is mapped, accessing the
+missing pages kills the process with SIGBUS on most systems.
+
+In cache-friendly mode, files are opened with O_NOATIME (where the OS
+supports it, and the user is allowed to), so that their access times are
+not touched. The kernel is told that the files will be read sequentially,
+and each chunk is dropped from the page cache as soon as it has been
+hashed. This keeps a scan of a large tree from evicting the working set of
+other processes. It makes repeated scans slower, as nothing is left in the
+cache for them. ``file_digest`` reads the whole file on its own, so it is
+not used in cache-friendly mode; ``readinto`` is used instead.
+
+The backend and the cache-friendly mode are given for each read, as a
+ReadOptions.
+
+"""
+
+import collections
+import errno
+import hashlib
+import os
+import sys
+
+try:
+    import mmap
+except ImportError:     # pragma: no cover
+    mmap = None
+
+
+__all__ = [ "ReadOptions", "hash_region", "available_backends",
+        "open_file", "drop_cache", "DEFAULT_READ_OPTIONS",
+        "MMAP_MIN_SIZE" ]
+
+
+MMAP_MIN_SIZE = 16 * 1024 * 1024
+"""Regions smaller than this, in bytes, are never mapped into memory."""
+
+
+def _hash_read(f, offset, length, new_hasher, chunk_size, drop):
+    """Hash a region of a file, reading a new bytes object per chunk."""
+
+    summer = new_hasher()
+
+    bytes_read = 0
+    while bytes_read < length:
+        chunk = f.read(min(chunk_size, length - bytes_read))
+
+        if not chunk:
+            # found EOF: means length was larger than the file size, or
+            # file was truncated while reading -- print warning?
+            break
+
+        summer.update(chunk)
+        if drop:
+            drop_cache(f, offset + bytes_read, len(chunk))
+        bytes_read += len(chunk)
+
+    return summer, bytes_read
+
+
+def _hash_readinto(f, offset, length, new_hasher, chunk_size, drop):
+    """Hash a region of a file, reading into a reused buffer."""
+
+    summer = new_hasher()
+    buf = memoryview(bytearray(min(chunk_size, length)))
+
+    bytes_read = 0
+    while bytes_read < length:
+        n = f.readinto(buf[:min(len(buf), length - bytes_read)])
+
+        if not n:
+            break
+
+        summer.update(buf[:n])
+        if drop:
+            drop_cache(f, offset + bytes_read, n)
+        bytes_read += n
+
+    return summer, bytes_read
+
+
+def _hash_mmap(f, offset, length, new_hasher, chunk_size, drop):
+    """Hash a region of a file, mapping it into memory.
+
+    Regions smaller than MMAP_MIN_SIZE are read with _hash_readinto.
+    Mapped pages can't be dropped from the cache, so with drop the region
+    is only dropped once it has been unmapped.
+
+    """
+    # never map past EOF: the file may have shrunk since it was indexed
+    length = min(length, max(os.fstat(f.fileno()).st_size - offset, 0))
+
+    if length < MMAP_MIN_SIZE:
+        return _hash_readinto(f, offset, length, new_hasher, chunk_size,
+                              drop)
+
+    # the mapping must start at a multiple of the allocation granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    skip = offset - start
+
+    summer = new_hasher()
+    mapped = mmap.mmap(f.fileno(), skip + length, offset=start,
+                       access=mmap.ACCESS_READ)
+    try:
+        view = memoryview(mapped)
+        try:
+            # update by chunks, so other threads get a chance to run
+            for pos in range(skip, skip + length, chunk_size):
+                summer.update(view[pos:min(pos + chunk_size, skip + length)])
+        finally:
+            view.release()
+    finally:
+        mapped.close()
+
+    if drop:
+        drop_cache(f, offset, length)
+
+    return summer, length
+
+
+def _hash_file_digest(f, offset, length, new_hasher, chunk_size, drop):
+    """Hash a region of a file with hashlib.file_digest().
+
+    Regions that don't extend to the end of the file, and any region with
+    drop, are read with _hash_readinto.
+
+    """
+    if drop or offset + length != os.fstat(f.fileno()).st_size:
+        return _hash_readinto(f, offset, length, new_hasher, chunk_size,
+                              drop)
+
+    summer = hashlib.file_digest(f, new_hasher)
+
+    # reads to EOF, wherever it is by now
+    return summer, f.tell() - offset
+
+
+_BACKENDS = { "read": _hash_read }
+
+if sys.version_info >= (3,):
+    # Python 2 files don't reliably support readinto() with a memoryview
+    _BACKENDS["readinto"] = _hash_readinto
+
+    if mmap is not None:
+        _BACKENDS["mmap"] = _hash_mmap
+
+if hasattr(hashlib, "file_digest"):     # pragma: no cover
+    _BACKENDS["file_digest"] = _hash_file_digest
+
+_AUTO_BACKEND = _BACKENDS.get("file_digest",
+                              _BACKENDS.get("readinto", _hash_read))
+
+
+class ReadOptions(collections.namedtuple("ReadOptions",
+                                         "backend cache_friendly")):
+    """How files are read for hashing.
+
+    backend is the name of an available backend, or ``"auto"`` to choose
+    one automatically. cache_friendly enables the cache-friendly mode.
+    Raises ValueError if the backend is not available.
+
+    ReadOptions are immutable and can be pickled, so they can be passed to
+    worker processes.
+
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, backend="auto", cache_friendly=False):
+        if backend != "auto" and backend not in _BACKENDS:
+            raise ValueError("unsupported read backend: %r" % (backend,))
+
+        return super(ReadOptions, cls).__new__(cls, backend,
+                                               bool(cache_friendly))
+
+
+DEFAULT_READ_OPTIONS = ReadOptions()
+"""Read with an automatically chosen backend, not in cache-friendly mode."""
+
+
+def available_backends():
+    """Get the names of all backends usable on this system, as a set."""
+
+    return set(_BACKENDS)
+
+
+def _fadvise(fd, offset, length, advice_name):
+    """Give advice to the kernel about a file, if supported."""
+
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, "posix_fadvise"):
+        return
+
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        # advice only; some filesystems don't take it
+        pass
+
+
+def open_file(filename, cache_friendly=False):
+    """Open a file for hashing, in binary mode.
+
+    If cache_friendly is True, the file is opened with O_NOATIME if
+    possible, and advised for sequential access.
+
+    Returns a file object. Raises IOError or OSError in case of error.
+
+    """
+    if not cache_friendly:
+        return open(filename, 'rb')
+
+    flags = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+    noatime = getattr(os, "O_NOATIME", 0)
+
+    fd = None
+    if noatime:
+        try:
+            fd = os.open(filename, flags | noatime)
+        except OSError as e:
+            # only the owner (or a privileged user) may use O_NOATIME
+            if e.errno != errno.EPERM:
+                raise
+
+    if fd is None:
+        fd = os.open(filename, flags)
+
+    try:
+        f = os.fdopen(fd, 'rb')
+    except:
+        os.close(fd)
+        raise
+
+    _fadvise(fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+
+    return f
+
+
+def drop_cache(f, offset, length):
+    """Drop an already read region of an open file from the page cache.
+
+    Does nothing on systems without posix_fadvise().
+
+    """
+    if length > 0:
+        _fadvise(f.fileno(), offset, length, "POSIX_FADV_DONTNEED")
+
+
+def hash_region(f, offset, length, new_hasher, chunk_size,
+        options=DEFAULT_READ_OPTIONS):
+    """Hash a region of an open file.
+
+    f is a file object opened in binary mode. The length bytes starting at
+    offset are hashed, or up to EOF if the file is shorter.
+
+    new_hasher is a callable with no arguments that returns a new hash
+    object. chunk_size is the largest amount of data read at a time.
+
+    options is a ReadOptions. In cache-friendly mode, each chunk is
+    dropped from the page cache as soon as it has been hashed.
+
+    Returns a 2-tuple ``(hash_object, bytes_read)``, where bytes_read is
+    the number of bytes actually hashed. Raises IOError or OSError in case
+    of error.
+
+    """
+    if options.backend == "auto":
+        backend = _AUTO_BACKEND
+    else:
+        backend = _BACKENDS[options.backend]
+
+    if offset != f.tell():
+        f.seek(offset)
+
+    return backend(f, offset, length, new_hasher, chunk_size,
+                   options.cache_friendly)
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
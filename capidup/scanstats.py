@@ -0,0 +1,274 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Statistics of a duplicate scan.
+
+Public classes:
+
+    ScanStats -- counters and timings of a whole scan
+    StageStats -- counters and timing of one comparison stage
+
+A ScanStats can be passed as `stats` to
+capidup.finddups.find_duplicates_in_dirs() and
+capidup.finddups.iter_duplicates_in_dirs(), which fill it *in-place*.
+as_dict() gives all the values as a flat dictionary, for exporting to
+metrics systems.
+
+"""
+
+
+import bisect
+
+
+__all__ = [ "ScanStats", "StageStats" ]
+
+
+STAGES = ("partial", "sample", "full")
+"""Names of the comparison stages, in the order files go through them."""
+
+
+class StageStats(object):
+    """Counters and timing of one comparison stage.
+
+    Attributes:
+
+    files_in -- number of files compared by the stage
+    files_out -- number of those still possible duplicates after it
+    bytes_read -- number of bytes actually read by the stage
+    bytes_planned -- number of bytes the stage set out to compare
+    seconds -- wall time spent in the stage
+
+    Runs of a stage that overlap in time, e.g. for batches compared in
+    worker processes or on several devices at once, have their wall time
+    counted only once, so that seconds is never more than the time the
+    scan took. The two byte counts differ when digests come from a digest cache
+    (nothing is read), when files shrank since they were indexed, and with
+    lockstep comparisons, where reading a file stops as soon as it differs
+    from the others. With a partial schedule, files are counted once for
+    each step they go through.
+
+    """
+
+    def __init__(self):
+        self.files_in = 0
+        self.files_out = 0
+        self.bytes_read = 0
+        self.bytes_planned = 0
+        # time added without a start, and the sorted, disjoint (start,
+        # end) intervals of the runs with one
+        self._untimed_seconds = 0.0
+        self._busy = []
+        self._busy_seconds = 0.0
+
+    @property
+    def seconds(self):
+        """Wall time spent in the stage."""
+
+        return self._untimed_seconds + self._busy_seconds
+
+    def add_seconds(self, seconds, start=None):
+        """Count time spent in the stage.
+
+        If start is given, the stage ran from start (a time.time() value)
+        for seconds, and only the part of that time not already counted is
+        added. Otherwise, seconds are added as they are.
+
+        """
+        if start is None:
+            self._untimed_seconds += seconds
+            return
+
+        end = start + seconds
+        busy = self._busy
+
+        # find the intervals that overlap or touch [start, end], and
+        # replace them with their union
+        i = bisect.bisect_left(busy, (start,))
+        if i > 0 and busy[i - 1][1] >= start:
+            i -= 1
+        j = i
+        while j < len(busy) and busy[j][0] <= end:
+            start = min(start, busy[j][0])
+            end = max(end, busy[j][1])
+            self._busy_seconds -= busy[j][1] - busy[j][0]
+            j += 1
+
+        busy[i:j] = [(start, end)]
+        self._busy_seconds += end - start
+
+    @property
+    def elimination_ratio(self):
+        """Fraction of files that the stage ruled out as duplicates.
+
+        None if no files went through the stage.
+
+        """
+        if not self.files_in:
+            return None
+
+        return 1.0 - float(self.files_out) / self.files_in
+
+    def merge(self, other):
+        """Add the values of another StageStats to this one.
+
+        The times of runs with a start are merged, not added: where the
+        runs of both overlap, the time counts once.
+
+        """
+
+        self.files_in += other.files_in
+        self.files_out += other.files_out
+        self.bytes_read += other.bytes_read
+        self.bytes_planned += other.bytes_planned
+        self._untimed_seconds += other._untimed_seconds
+        for start, end in other._busy:
+            self.add_seconds(end - start, start)
+
+
+class ScanStats(object):
+    """Counters and timings of a whole scan.
+
+    Attributes:
+
+    directories -- number of directories listed
+    files -- number of files found and indexed
+    excluded_dirs -- subdirectories pruned by exclude patterns
+    excluded_files -- files pruned by exclude patterns
+    filtered_files -- files left out by size or by a file filter
+    size_buckets -- number of distinct file sizes
+    singleton_buckets -- number of sizes with a single file
+    stages -- dictionary of StageStats, by stage name (see STAGES)
+    duplicate_groups -- number of groups of duplicates found
+    duplicate_files -- number of files in those groups
+    reclaimable_bytes -- bytes that would be freed by keeping a single
+        copy of each group; hard links to the same file count once
+    crawl_seconds -- wall time spent crawling directories
+    seconds -- wall time of the whole scan
+
+    """
+
+    def __init__(self):
+        self.directories = 0
+        self.files = 0
+        self.excluded_dirs = 0
+        self.excluded_files = 0
+        self.filtered_files = 0
+        self.size_buckets = 0
+        self.singleton_buckets = 0
+        self.stages = dict((name, StageStats()) for name in STAGES)
+        self.duplicate_groups = 0
+        self.duplicate_files = 0
+        self.reclaimable_bytes = 0
+        self.crawl_seconds = 0.0
+        self.seconds = 0.0
+
+    def add_dir(self, num_files, pruned):
+        """Count a directory listing.
+
+        num_files is the number of files indexed from it, and pruned the
+        tuple of counts from capidup.finddups.scan_dir().
+
+        """
+        excluded_dirs, excluded_files, filtered_files = pruned
+
+        self.directories += 1
+        self.files += num_files
+        self.excluded_dirs += excluded_dirs
+        self.excluded_files += excluded_files
+        self.filtered_files += filtered_files
+
+    def add_bucket(self, num_files):
+        """Count a group of files of the same size."""
+
+        self.size_buckets += 1
+        if num_files == 1:
+            self.singleton_buckets += 1
+
+    def add_stage(self, name, files_in, files_out, bytes_read, seconds,
+            bytes_planned=0, start=None):
+        """Count a run of a comparison stage.
+
+        start, if given, is the time the run started at; see
+        StageStats.add_seconds().
+
+        """
+        stage = self.stages[name]
+        stage.files_in += files_in
+        stage.files_out += files_out
+        stage.bytes_read += bytes_read
+        stage.bytes_planned += bytes_planned
+        stage.add_seconds(seconds, start)
+
+    def add_duplicates(self, size, num_files, num_copies):
+        """Count a group of duplicates.
+
+        num_files is the number of paths reported, and num_copies the
+        number of distinct files among them (i.e. not counting hard links
+        to the same file).
+
+        """
+        self.duplicate_groups += 1
+        self.duplicate_files += num_files
+        self.reclaimable_bytes += size * (num_copies - 1)
+
+    def merge(self, other):
+        """Add the values of another ScanStats to this one.
+
+        Useful to combine the statistics of scans done separately, e.g. in
+        several processes. Stage times are merged as in
+        StageStats.merge(): runs that overlap in time count once.
+
+        """
+        for name in ("directories", "files", "excluded_dirs",
+                     "excluded_files", "filtered_files", "size_buckets",
+                     "singleton_buckets", "duplicate_groups",
+                     "duplicate_files", "reclaimable_bytes",
+                     "crawl_seconds", "seconds"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+        for name, stage in other.stages.items():
+            self.stages[name].merge(stage)
+
+    def as_dict(self):
+        """Get all the values, as a flat dictionary.
+
+        The counters of each stage are prefixed with the stage name, e.g.
+        ``full_bytes_read``.
+
+        """
+        values = dict((name, getattr(self, name)) for name in (
+            "directories", "files", "excluded_dirs", "excluded_files",
+            "filtered_files", "size_buckets", "singleton_buckets",
+            "duplicate_groups", "duplicate_files", "reclaimable_bytes",
+            "crawl_seconds", "seconds"))
+
+        for name, stage in self.stages.items():
+            values[name + "_files_in"] = stage.files_in
+            values[name + "_files_out"] = stage.files_out
+            values[name + "_bytes_read"] = stage.bytes_read
+            values[name + "_bytes_planned"] = stage.bytes_planned
+            values[name + "_seconds"] = stage.seconds
+            values[name + "_elimination_ratio"] = stage.elimination_ratio
+
+        return values
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
@@ -0,0 +1,296 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Duplicate finding across several hosts, each scanning its own files.
+
+Public functions:
+
+    dump_size_index -- write a files_by_size index to a file
+    load_size_index -- read a files_by_size index from a file
+    merge_size_indexes -- find the sizes that may have duplicates
+    hash_candidates -- hash the files of the given sizes
+    dump_digests -- write digests from hash_candidates() to a file
+    load_digests -- read digests from a file
+    group_digests -- group the digests of all shards into duplicates
+
+A shard is the part of the files seen by one host (or process). A scan
+across shards goes in three steps:
+
+1. Each shard indexes its own files by size, e.g. with
+   capidup.finddups.index_files_by_size(), and writes the index with
+   dump_size_index().
+2. The indexes of all shards are merged with merge_size_indexes(). This
+   gives the sizes found more than once, on any shards: the only ones
+   that can have duplicates.
+3. Each shard hashes its own files of those sizes with hash_candidates(),
+   and writes the digests with dump_digests(). group_digests() then
+   groups the digests of all shards into duplicates.
+
+Only sizes and digests need to be brought together; no shard reads the
+files of another. Candidates are hashed in full, since a separate
+partial stage would need another round trip between the shards.
+
+All files are written as text, one JSON value per line, so they can be
+read a line at a time and concatenated or compressed freely. On Python 3,
+file objects must be opened in text mode.
+
+"""
+
+import binascii
+import json
+import sys
+
+from capidup import py3compat
+from capidup import finddups
+from capidup.hashers import DEFAULT_FULL_HASH
+
+
+__all__ = [ "dump_size_index", "load_size_index", "merge_size_indexes",
+        "hash_candidates", "dump_digests", "load_digests", "group_digests" ]
+
+
+SIZE_INDEX_FORMAT = "capidup-size-index"
+"""Format name, in the header of size index files."""
+
+DIGESTS_FORMAT = "capidup-digests"
+"""Format name, in the header of digest files."""
+
+FORMAT_VERSION = 1
+"""Version of the size index and digest file formats."""
+
+
+def _write_header(fileobj, format_name, shard, **extra):
+    """Write the header line of a size index or digest file."""
+
+    header = dict(format=format_name, version=FORMAT_VERSION, shard=shard)
+    header.update(extra)
+    fileobj.write(json.dumps(header) + "\n")
+
+
+def _read_header(fileobj, format_name):
+    """Read and check the header line of a size index or digest file.
+
+    Returns the header, as a dictionary. Raises ValueError if the file is
+    not of the expected format and version.
+
+    """
+    line = fileobj.readline()
+    try:
+        header = json.loads(line)
+    except ValueError:
+        header = None
+
+    if (not isinstance(header, dict)
+            or header.get("format") != format_name):
+        raise ValueError("not a %s file" % format_name)
+
+    if header.get("version") != FORMAT_VERSION:
+        raise ValueError("unsupported %s version: %r"
+                         % (format_name, header.get("version")))
+
+    return header
+
+
+def dump_size_index(files_by_size, fileobj, shard):
+    """Write a files_by_size index to a file.
+
+    files_by_size is a dictionary of lists of filenames, indexed by size,
+    as filled by capidup.finddups.index_files_by_size(). shard is a name
+    identifying the shard, e.g. the host name; it must be unique among the
+    shards being compared.
+
+    """
+    _write_header(fileobj, SIZE_INDEX_FORMAT, shard)
+
+    for size, filenames in py3compat.iteritems(files_by_size):
+        fileobj.write(json.dumps([size, filenames]) + "\n")
+
+
+def _iter_size_index(fileobj):
+    """Iterate over the ``(size, filenames)`` items of a size index file.
+
+    The header must already have been read.
+
+    """
+    for line in fileobj:
+        size, filenames = json.loads(line)
+        yield size, filenames
+
+
+def load_size_index(fileobj):
+    """Read a files_by_size index from a file.
+
+    Returns a 2-tuple ``(shard, files_by_size)``. Raises ValueError if the
+    file was not written by dump_size_index().
+
+    """
+    header = _read_header(fileobj, SIZE_INDEX_FORMAT)
+
+    return header["shard"], dict(_iter_size_index(fileobj))
+
+
+def merge_size_indexes(fileobjs):
+    """Find the sizes that may have duplicates, across several shards.
+
+    fileobjs is a list of size index files from dump_size_index(), one per
+    shard. They are read a line at a time; only the number of files of
+    each size is kept in memory.
+
+    Returns a sorted list of the sizes found more than once, whether on
+    the same shard or on different ones. Raises ValueError if any of the
+    files is not a size index, or if two files are from the same shard.
+
+    """
+    counts = {}
+    shards = set()
+
+    for fileobj in fileobjs:
+        shard = _read_header(fileobj, SIZE_INDEX_FORMAT)["shard"]
+        if shard in shards:
+            raise ValueError("duplicate shard: %r" % (shard,))
+        shards.add(shard)
+
+        for size, filenames in _iter_size_index(fileobj):
+            counts[size] = counts.get(size, 0) + len(filenames)
+
+    return sorted(size for size, count in py3compat.iteritems(counts)
+                  if count >= 2)
+
+
+def hash_candidates(files_by_size, candidate_sizes,
+        algorithm=DEFAULT_FULL_HASH, digest_cache=None, workers=None,
+        executor=None, errors=None):
+    """Hash the files of a shard that may have duplicates.
+
+    files_by_size is the shard's own index, and candidate_sizes the sizes
+    from merge_size_indexes(). Every file of those sizes is hashed in
+    full, with the named algorithm. digest_cache, workers and executor
+    are as in capidup.finddups.find_duplicates().
+
+    Files that can't be read are left out. Error messages are printed to
+    stderr and, if errors is not None, appended to it *in-place*.
+
+    Returns a list of ``(size, digest, filename)`` tuples, where digest is
+    a binary string.
+
+    """
+    if errors is None:
+        errors = []
+
+    jobs = []
+    for size in candidate_sizes:
+        for filename in files_by_size.get(size, ()):
+            jobs.append((size, filename))
+
+    executor, owned = finddups.make_executor(workers, executor)
+    records = []
+    try:
+        results = finddups.ordered_map(
+            executor,
+            lambda size, filename: finddups.digest_or_error(
+                filename, [(0, size)], algorithm, digest_cache),
+            [size for size, _ in jobs], [filename for _, filename in jobs])
+
+        for (size, filename), (digest, error, _) in py3compat.izip(jobs,
+                                                                   results):
+            if error is not None:
+                sys.stderr.write("%s\n" % error)
+                errors.append(error)
+            else:
+                records.append((size, digest, filename))
+    finally:
+        if owned:
+            executor.shutdown()
+
+    if digest_cache is not None:
+        digest_cache.commit()
+
+    return records
+
+
+def dump_digests(records, fileobj, shard, algorithm=DEFAULT_FULL_HASH):
+    """Write the digests from hash_candidates() to a file.
+
+    shard is the same name given to dump_size_index(). algorithm is the
+    one the digests were calculated with; digests with different
+    algorithms are never grouped together.
+
+    """
+    _write_header(fileobj, DIGESTS_FORMAT, shard, algorithm=algorithm)
+
+    for size, digest, filename in records:
+        fileobj.write(json.dumps([size, binascii.hexlify(digest).decode(),
+                                  filename]) + "\n")
+
+
+def _iter_digests(fileobj):
+    """Iterate over the records of a digest file, after the header."""
+
+    for line in fileobj:
+        size, digest, filename = json.loads(line)
+        yield size, binascii.unhexlify(digest), filename
+
+
+def load_digests(fileobj):
+    """Read digests from a file written by dump_digests().
+
+    Returns a 3-tuple ``(shard, algorithm, records)``, where records is a
+    list of ``(size, digest, filename)`` tuples. Raises ValueError if the
+    file was not written by dump_digests().
+
+    """
+    header = _read_header(fileobj, DIGESTS_FORMAT)
+
+    return header["shard"], header["algorithm"], list(_iter_digests(fileobj))
+
+
+def group_digests(fileobjs):
+    """Group the digests of several shards into duplicates.
+
+    fileobjs is a list of digest files from dump_digests(), one per
+    shard.
+
+    Returns a (possibly empty) list of lists of ``(shard, filename)``
+    tuples: the files that have at least two copies, on any shards,
+    grouped together. Raises ValueError if the files use different hash
+    algorithms.
+
+    """
+    files_by_digest = {}
+    algorithms = set()
+
+    for fileobj in fileobjs:
+        header = _read_header(fileobj, DIGESTS_FORMAT)
+        algorithms.add(header["algorithm"])
+        if len(algorithms) > 1:
+            raise ValueError("digests use different hash algorithms: %s"
+                             % ", ".join(sorted(algorithms)))
+
+        for size, digest, filename in _iter_digests(fileobj):
+            files_by_digest.setdefault((size, digest), []).append(
+                (header["shard"], filename))
+
+    return [files for files in py3compat.itervalues(files_by_digest)
+            if len(files) >= 2]
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
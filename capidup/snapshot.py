@@ -0,0 +1,346 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Persistent snapshot of directory listings, for incremental rescans.
+
+Public classes:
+
+    DirSnapshot -- SQLite-backed store of directory listings
+
+Public functions:
+
+    dir_stamp -- get the identifying tuple of a directory
+
+Listing a directory and stat'ing its entries is the bulk of the cost of
+crawling a large tree that mostly doesn't change. A DirSnapshot stores the
+result of listing each directory, together with the directory's device,
+inode, modification time and change time. Adding, removing or renaming an
+entry updates the directory's modification time; so, while those are the
+same, the stored listing can be used instead of listing the directory
+again.
+
+Modifying a file in place does not update the time of its directory, so
+the stored size of such a file may be out of date. Files that share their
+stored size with others are stat'ed again before being compared, and
+regrouped by their current size. A file whose stored size was unique is
+not stat'ed again, though: if it has since grown or shrunk to the size
+of another file and become its duplicate, that duplicate is missed until
+the file's directory changes.
+
+Directories are stored by their path as bytes, exactly as the OS gives
+it, so that names which aren't valid in the filesystem encoding can be
+stored too. Bytes names in listings are stored with surrogate escapes,
+and given back as bytes when listing a bytes path.
+
+A snapshot is only valid for the same crawl settings (exclude patterns,
+whether to follow symlinks, size limits). It is cleared when used with
+different ones.
+
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from capidup.digestcache import stat_key
+
+
+__all__ = [ "DirSnapshot", "dir_stamp" ]
+
+
+SNAPSHOT_SCHEMA_VERSION = 3
+"""Version of the on-disk snapshot format.
+
+A snapshot file with a different version is discarded and recreated.
+"""
+
+RACY_INTERVAL = 2.0
+"""Directories modified less than this many seconds ago are not stored.
+
+A directory modified right after being listed might keep the same
+timestamp, on filesystems with coarse timestamps. Such a listing would
+look valid, while being out of date.
+"""
+
+COMMIT_INTERVAL = 1000
+"""Number of snapshot writes between implicit commits."""
+
+
+_SCHEMA = ["""
+CREATE TABLE IF NOT EXISTS dirs (
+    path BLOB NOT NULL PRIMARY KEY,
+    stamp TEXT NOT NULL,
+    listing TEXT NOT NULL,
+    last_used REAL NOT NULL
+)
+""", """
+CREATE TABLE IF NOT EXISTS settings (
+    id INTEGER NOT NULL PRIMARY KEY,
+    value TEXT NOT NULL
+)
+"""]
+
+
+def _path_key(path):
+    """Get the key a directory is stored under: its path, as bytes.
+
+    On Python 3, names that aren't valid in the filesystem encoding are
+    decoded with surrogate escapes; os.fsencode() turns them back into
+    the original bytes, where storing them as text would fail.
+
+    """
+    if not isinstance(path, bytes):
+        if sys.version_info >= (3,):
+            path = os.fsencode(path)
+        else:           # pragma: no cover
+            path = path.encode(sys.getfilesystemencoding() or "utf-8")
+
+    return sqlite3.Binary(path)
+
+
+def _encode_name(name):
+    """Get a name from a listing as text, for storing it as JSON.
+
+    On Python 3, bytes names are decoded with surrogate escapes, which
+    _decode_name() turns back into the original bytes.
+
+    """
+    if isinstance(name, bytes) and sys.version_info >= (3,):
+        return os.fsdecode(name)
+
+    return name
+
+
+def _decode_name(name, as_bytes):
+    """Get a name stored by _encode_name(), as bytes if as_bytes."""
+
+    if as_bytes and sys.version_info >= (3,):
+        return os.fsencode(name)
+
+    return name
+
+
+def dir_stamp(file_info, rel_dir=""):
+    """Get the stamp of a directory, from its stat result.
+
+    rel_dir is the path of the directory relative to the root of the scan,
+    which path patterns are matched against.
+
+    Returns a tuple ``(st_dev, st_ino, mtime_ns, ctime_ns, rel_dir)``. If
+    any of these changes, the directory's stored listing is no longer
+    valid.
+
+    """
+    dev, ino, _, mtime_ns, ctime_ns = stat_key(file_info)
+    return (dev, ino, mtime_ns, ctime_ns, rel_dir)
+
+
+class DirSnapshot(object):
+    """Persistent snapshot of directory listings.
+
+    path is the filename of the SQLite database. It is created if it does
+    not exist. The special name ``":memory:"`` gives a non-persistent
+    snapshot, mostly useful for testing.
+
+    The snapshot keeps count of lookups in its `hits` and `misses`
+    attributes. Listings of directories that no longer exist can be
+    removed with `evict_unused`.
+
+    A DirSnapshot may be shared between threads. It may be used as a
+    context manager, in which case it is closed on exit.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+        self._session_start = time.time()
+        self._pending_writes = 0
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._setup_schema()
+
+    def _setup_schema(self):
+        """Create the tables, discarding any incompatible ones."""
+
+        cur = self._conn.cursor()
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        if version != SNAPSHOT_SCHEMA_VERSION:
+            cur.execute("DROP TABLE IF EXISTS dirs")
+            cur.execute("DROP TABLE IF EXISTS settings")
+            cur.execute("PRAGMA user_version = %d" % SNAPSHOT_SCHEMA_VERSION)
+        for statement in _SCHEMA:
+            cur.execute(statement)
+        self._conn.commit()
+
+    def _wrote(self):
+        """Account for a write, committing every COMMIT_INTERVAL writes.
+
+        Must be called with the lock held.
+
+        """
+        self._pending_writes += 1
+        if self._pending_writes >= COMMIT_INTERVAL:
+            self._conn.commit()
+            self._pending_writes = 0
+
+    def use_settings(self, settings):
+        """Set the crawl settings the listings are valid for.
+
+        settings is any value that can be stored as JSON. If it is not the
+        same as the stored one, all listings are discarded.
+
+        """
+        value = json.dumps(settings)
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM settings WHERE id = 0").fetchone()
+
+            if row is None or row[0] != value:
+                self._conn.execute("DELETE FROM dirs")
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO settings (id, value)"
+                    " VALUES (0, ?)", (value,))
+                self._conn.commit()
+                self._pending_writes = 0
+
+    def get(self, path, stamp):
+        """Look up the listing of a directory.
+
+        stamp is the directory's current stamp, from dir_stamp().
+
+        Returns the stored ``(subdirs, files, pruned)`` listing, as from
+        capidup.finddups.scan_dir(), or None if there is no valid one.
+
+        """
+        stamp = json.dumps(stamp)
+        key = _path_key(path)
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stamp, listing FROM dirs WHERE path = ?",
+                (key,)).fetchone()
+
+            if row is None or row[0] != stamp:
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE dirs SET last_used = ? WHERE path = ?",
+                (time.time(), key))
+            self._wrote()
+            self.hits += 1
+
+        # names listed from a bytes path are bytes too
+        as_bytes = isinstance(path, bytes)
+
+        subdirs, files, pruned = json.loads(row[1])
+        subdirs = [(_decode_name(name, as_bytes), tuple(dev_inode))
+                   for name, dev_inode in subdirs]
+        files = [(_decode_name(name, as_bytes), size, inode,
+                  tuple(dev_inode) if dev_inode is not None else None)
+                 for name, size, inode, dev_inode in files]
+
+        return subdirs, files, tuple(pruned)
+
+    def put(self, path, stamp, subdirs, files, pruned=(0, 0, 0)):
+        """Store the listing of a directory.
+
+        subdirs, files and pruned are as returned by
+        capidup.finddups.scan_dir().
+
+        stamp should be the directory's stamp from *before* it was listed,
+        so that a concurrent modification is caught on the next lookup.
+        Directories modified too recently are not stored; see
+        RACY_INTERVAL.
+
+        """
+        mtime = stamp[2] / 1e9
+        if mtime > time.time() - RACY_INTERVAL:
+            return
+
+        listing = json.dumps([
+            [(_encode_name(name), dev_inode) for name, dev_inode in subdirs],
+            [(_encode_name(name), size, inode, dev_inode)
+             for name, size, inode, dev_inode in files],
+            pruned])
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO dirs (path, stamp, listing, last_used)"
+                " VALUES (?, ?, ?, ?)",
+                (_path_key(path), json.dumps(stamp), listing, time.time()))
+            self._wrote()
+
+    def evict_unused(self):
+        """Remove the listings not used or stored since it was opened.
+
+        Call this after a complete scan of the same trees, to get rid of
+        listings of directories that were deleted or are no longer
+        included.
+
+        Returns the number of evicted listings.
+
+        """
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM dirs WHERE last_used < ?",
+                (self._session_start,))
+            self._conn.commit()
+            self._pending_writes = 0
+
+        return cur.rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM dirs").fetchone()[0]
+
+    def commit(self):
+        """Write any pending changes to disk."""
+
+        with self._lock:
+            self._conn.commit()
+            self._pending_writes = 0
+
+    def close(self):
+        """Commit pending changes and close the snapshot."""
+
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
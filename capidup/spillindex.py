@@ -0,0 +1,286 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Index of files by size that spills to disk, for huge scans.
+
+Public classes:
+
+    SpillingFileIndex -- files_by_size index with bounded memory usage
+
+Files are added to an in-memory buffer of ``(size, path)`` records. When
+the buffer grows past a memory limit, it is sorted by size and written to
+a run file in a temporary directory, and a new buffer is started. When
+the index is read, the runs and the last buffer are merged, and size
+groups are streamed in increasing order of size. At most MAX_MERGE_RUNS
+runs are merged at once: if there are more, they are first merged into
+fewer, larger runs, in as many passes as needed. Memory usage is then
+bounded by the memory limit, plus one read buffer per merged run, plus
+the largest size group; and the number of open files by MAX_MERGE_RUNS.
+
+"""
+
+import heapq
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+
+__all__ = [ "SpillingFileIndex" ]
+
+
+RECORD_OVERHEAD = 120
+"""Estimated memory used by a buffered record, besides the path itself."""
+
+RUN_BUFFER_SIZE = 64 * 1024
+"""Size in bytes of the read buffer for each run file, while merging."""
+
+MAX_MERGE_RUNS = 64
+"""Maximum number of run files open at once, while merging."""
+
+_HEADER = struct.Struct(">qQI")
+
+if sys.version_info >= (3,):
+    _PATH_ERRORS = "surrogateescape"
+else:                   # pragma: no cover
+    _PATH_ERRORS = "strict"
+
+
+def _write_run(path, records):
+    """Write ``(size, seq, path)`` records to a new run file."""
+
+    with open(path, "wb", RUN_BUFFER_SIZE) as f:
+        for size, seq, record_path in records:
+            f.write(_HEADER.pack(size, seq, len(record_path)))
+            f.write(record_path)
+
+
+def _read_run(path):
+    """Iterate over the ``(size, seq, path)`` records of a run file."""
+
+    with open(path, "rb", RUN_BUFFER_SIZE) as f:
+        while True:
+            header = f.read(_HEADER.size)
+            if not header:
+                break
+
+            size, seq, length = _HEADER.unpack(header)
+            yield size, seq, f.read(length)
+
+
+class SpillingFileIndex(object):
+    """Index of files by size, spilling to disk past a memory limit.
+
+    This can be used instead of a files_by_size dictionary, with
+    capidup.finddups.index_files_by_size(). It is filled first, and then
+    read once, with items() or popitem(); nothing can be added after it
+    starts being read. Sizes are read in increasing order, and the paths
+    of each size in the order they were added.
+
+    memory_limit is the approximate number of bytes of records to keep in
+    memory before spilling them to disk. spill_dir is the directory where
+    to create the temporary run files, by default the system's temporary
+    directory.
+
+    The index should be closed when no longer needed, to remove the run
+    files. It may be used as a context manager, in which case it is closed
+    on exit.
+
+    """
+
+    def __init__(self, memory_limit, spill_dir=None):
+        if memory_limit <= 0:
+            raise ValueError("memory_limit must be positive: %r"
+                             % (memory_limit,))
+
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._seq = 0
+        self._runs = []
+        self._run_files = 0
+        self._tmpdir = None
+        self._bytes_paths = None
+
+        # merged stream of groups, once reading has started
+        self._groups = None
+        self._next_group = None
+
+    def add_file(self, size, dirpath, name, inode=0):
+        """Add a file to the index.
+
+        dirpath is the path of its directory, and name its base name. inode
+        is accepted for compatibility with CompactFileIndex, and ignored.
+
+        """
+        if self._groups is not None:
+            raise ValueError("cannot add to an index being read")
+
+        path = os.path.join(dirpath, name)
+
+        if self._bytes_paths is None:
+            self._bytes_paths = isinstance(path, bytes)
+        if not self._bytes_paths:
+            path = path.encode("utf-8", _PATH_ERRORS)
+
+        self._buffer.append((size, self._seq, path))
+        self._seq += 1
+        self._buffer_bytes += len(path) + RECORD_OVERHEAD
+
+        if self._buffer_bytes > self.memory_limit:
+            self._spill()
+
+    def num_runs(self):
+        """Get the number of run files spilled to disk so far."""
+
+        return len(self._runs)
+
+    def _new_run_path(self):
+        """Get the path for a new run file."""
+
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix="capidup-",
+                                            dir=self.spill_dir)
+
+        self._run_files += 1
+        return os.path.join(self._tmpdir, "run%d" % self._run_files)
+
+    def _spill(self):
+        """Write the buffer to a new sorted run file, and empty it."""
+
+        self._buffer.sort()
+
+        run_path = self._new_run_path()
+        _write_run(run_path, self._buffer)
+
+        self._runs.append(run_path)
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def _reduce_runs(self):
+        """Merge runs into larger ones, until at most MAX_MERGE_RUNS left.
+
+        The oldest runs are merged first, so each pass merges runs of
+        similar lengths.
+
+        """
+        while len(self._runs) > MAX_MERGE_RUNS:
+            merged = self._runs[:MAX_MERGE_RUNS]
+            del self._runs[:MAX_MERGE_RUNS]
+
+            run_path = self._new_run_path()
+            _write_run(run_path, heapq.merge(*[_read_run(run)
+                                               for run in merged]))
+            for run in merged:
+                os.remove(run)
+
+            self._runs.append(run_path)
+
+    def _iter_groups(self):
+        """Merge the runs and the buffer, yielding ``(size, paths)``."""
+
+        self._reduce_runs()
+        self._buffer.sort()
+        sources = [_read_run(run) for run in self._runs]
+        sources.append(iter(self._buffer))
+
+        curr_size = None
+        paths = []
+        for size, _, path in heapq.merge(*sources):
+            if not self._bytes_paths:
+                path = path.decode("utf-8", _PATH_ERRORS)
+
+            if size != curr_size:
+                if paths:
+                    yield curr_size, paths
+                curr_size = size
+                paths = []
+
+            paths.append(path)
+
+        if paths:
+            yield curr_size, paths
+
+    def _peek(self):
+        """Get the next group without consuming it, or None at the end."""
+
+        if self._groups is None:
+            self._groups = self._iter_groups()
+
+        if self._next_group is None:
+            self._next_group = next(self._groups, None)
+
+        return self._next_group
+
+    def popitem(self):
+        """Remove the group of the smallest remaining size.
+
+        Returns ``(size, paths)``. Raises KeyError if the index is empty.
+
+        """
+        group = self._peek()
+        if group is None:
+            raise KeyError("popitem(): index is empty")
+
+        self._next_group = None
+        return group
+
+    def iteritems(self):
+        """Get an iterator over the remaining ``(size, paths)`` groups.
+
+        The groups are removed from the index as they are read.
+
+        """
+        while self:
+            yield self.popitem()
+
+    items = iteritems
+
+    def __bool__(self):
+        if self._groups is None:
+            return bool(self._buffer or self._runs)
+        return self._peek() is not None
+
+    __nonzero__ = __bool__
+
+    def close(self):
+        """Remove the run files from disk."""
+
+        self._groups = None
+        self._buffer = []
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+        self._runs = []
+        self._run_files = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
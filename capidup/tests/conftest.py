@@ -0,0 +1,133 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Helpers shared by the test modules."""
+
+import os
+import time
+
+import pytest
+
+import capidup.finddups as finddups
+
+
+def sorted_groups(groups):
+    """Deep sort a list of duplicate groups."""
+
+    return sorted(sorted(g) for g in groups)
+
+
+def age_files(root):
+    """Set the modification time of all files under root to the past.
+
+    Files modified too recently are not stored in a digest cache.
+
+    """
+    old = time.time() - 3600
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            os.utime(os.path.join(dirpath, filename), (old, old))
+
+
+def setup_tree(tmpdir):
+    """Create a tree with files for every stage of a scan to tell apart.
+
+    There are large duplicates in several directories, large files that
+    differ from them at the head (dropped by the partial stage) or at the
+    tail (dropped by the full stage), groups of small duplicates, a
+    unique file, empty files and, where supported, hard links.
+
+    Returns the expected groups of duplicates, deep sorted.
+
+    """
+    # large enough for the partial and the sampling stages
+    big = finddups.SAMPLE_BLOCK_SIZE * 8
+    dirs = ["", "sub", "sub/deeper", "other"]
+    groups = [[], []]
+
+    for i, d in enumerate(dirs):
+        dirpath = tmpdir.ensure(d, dir=True)
+
+        dirpath.join("big").write("b" * big)
+        groups[0].append(dirpath.join("big"))
+        dirpath.join("tail%d" % i).write("b" * (big - 1) + str(i))
+
+        dirpath.join("empty").write("")
+        groups[1].append(dirpath.join("empty"))
+
+    tmpdir.join("head").write("h" + "b" * (big - 1))
+    tmpdir.join("unique").write("u" * 3)
+
+    for i in range(6):
+        content = str(i % 3) * (10 + i // 3)
+        tmpdir.join("small%d" % i).write(content)
+        tmpdir.join("other", "small%d" % i).write(content)
+        groups.append([tmpdir.join("small%d" % i),
+                       tmpdir.join("other", "small%d" % i)])
+
+    if hasattr(os, "link"):
+        os.link(str(tmpdir.join("big")), str(tmpdir.join("sub", "biglink")))
+        groups[0].append(tmpdir.join("sub", "biglink"))
+        os.link(str(tmpdir.join("unique")), str(tmpdir.join("uniquelink")))
+        groups.append([tmpdir.join("unique"), tmpdir.join("uniquelink")])
+
+    return sorted_groups([[str(f) for f in group] for group in groups])
+
+
+@pytest.fixture
+def dup_tree(tmpdir):
+    """A tree made by setup_tree(), with its expected duplicates.
+
+    Returns a 2-tuple ``(root, expected_groups)``, where root is the path
+    of the tree as a string.
+
+    """
+    root = tmpdir.mkdir("tree")
+    expected = setup_tree(root)
+
+    return str(root), expected
+
+
+def check_same_results(root, expected, ordered=False, **kwargs):
+    """Check find_duplicates_in_dirs() and its generator with some options.
+
+    Both should find the expected groups, without errors, when called
+    with the given keyword arguments. If ordered is True, the groups must
+    also be in the same order as with the default options.
+
+    Returns the groups found by find_duplicates_in_dirs().
+
+    """
+    dups, errors = finddups.find_duplicates_in_dirs([root], **kwargs)
+    assert not errors
+    assert sorted_groups(dups) == expected
+
+    if ordered:
+        default_dups, _ = finddups.find_duplicates_in_dirs([root])
+        assert dups == default_dups
+
+    errors = []
+    iter_dups = list(finddups.iter_duplicates_in_dirs([root], errors=errors,
+                                                      **kwargs))
+    assert not errors
+    assert sorted_groups(iter_dups) == expected
+
+    return dups
@@ -0,0 +1,170 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""asyncio interface testing.
+
+The tests don't use the async syntax, so that this module can still be
+collected on older versions of Python, where they are skipped.
+
+"""
+
+import sys
+import threading
+import time
+
+import pytest
+
+import capidup.finddups as finddups
+
+if sys.version_info < (3, 5):
+    pytest.skip("asyncio interface needs Python 3.5", allow_module_level=True)
+
+import asyncio
+
+import capidup.aio as aio
+from capidup.tests.conftest import sorted_groups
+
+
+def run(coro):
+    """Run a coroutine to completion, in a new event loop."""
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_same_results(dup_tree):
+    """Test that the async API finds the same duplicates."""
+
+    root, expected = dup_tree
+
+    result, errors = run(aio.find_duplicates_in_dirs([root],
+                                                     max_in_flight=2))
+
+    assert not errors
+    assert sorted_groups(result) == expected
+
+
+def test_async_iterator(dup_tree):
+    """Test getting the groups one at a time from the async iterator."""
+
+    root, expected = dup_tree
+    groups = aio.iter_duplicates_in_dirs([root], exclude_files=["empty"])
+
+    # without the async for syntax
+    result = []
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                result.append(loop.run_until_complete(groups.__anext__()))
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.close()
+
+    assert sorted_groups(result) == [group for group in expected
+                                     if not group[0].endswith("empty")]
+
+
+def test_index_dirs(dup_tree):
+    """Test that indexing gives the same index and hard links."""
+
+    root, _ = dup_tree
+
+    expected = {}
+    expected_hardlinks = {}
+    finddups.index_files_by_size(root, expected, ["sub"], [], False,
+                                 hardlinks=expected_hardlinks)
+
+    hardlinks = {}
+    files_by_size = run(aio.index_dirs([root], exclude_dirs=["sub"],
+                                       hardlinks=hardlinks))
+
+    assert files_by_size == expected
+    assert hardlinks == expected_hardlinks
+
+
+def test_bounded_window(tmpdir, monkeypatch):
+    """Test that at most max_in_flight files are hashed at once."""
+
+    futures = pytest.importorskip("concurrent.futures")
+
+    for i in range(20):
+        tmpdir.join("f%02d" % i).write("x" * 100)
+
+    lock = threading.Lock()
+    running = [0]
+    most_running = [0]
+    real_digest_or_error = finddups.digest_or_error
+
+    def counting_digest(*args):
+        """digest_or_error() that counts the calls running at once."""
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        try:
+            time.sleep(0.01)
+            return real_digest_or_error(*args)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    monkeypatch.setattr(finddups, "digest_or_error", counting_digest)
+
+    executor = futures.ThreadPoolExecutor(max_workers=8)
+    try:
+        result, errors = run(aio.find_duplicates_in_dirs(
+            [str(tmpdir)], executor=executor, max_in_flight=3))
+    finally:
+        executor.shutdown()
+
+    assert not errors
+    assert sorted_groups(result) == [sorted(str(tmpdir.join("f%02d" % i))
+                                            for i in range(20))]
+    assert 1 < most_running[0] <= 3
+
+
+def test_cancellation(tmpdir):
+    """Test that cancelling the scan stops it."""
+
+    for i in range(50):
+        tmpdir.mkdir("d%d" % i).join("f").write("x")
+
+    loop = asyncio.new_event_loop()
+    try:
+        task = loop.create_task(aio.find_duplicates_in_dirs(
+            [str(tmpdir)], max_in_flight=1))
+        loop.call_soon(task.cancel)
+
+        with pytest.raises(asyncio.CancelledError):
+            loop.run_until_complete(task)
+    finally:
+        loop.close()
+
+
+def test_bad_max_in_flight():
+    """Test that max_in_flight must be positive."""
+
+    with pytest.raises(ValueError):
+        aio.iter_duplicates_in_dirs(["."], max_in_flight=0)
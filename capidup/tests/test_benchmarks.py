@@ -0,0 +1,97 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Benchmark tools testing."""
+
+import os
+
+import pytest
+
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.pardir, os.pardir, "benchmarks")
+
+if not os.path.isdir(BENCHMARKS_DIR):
+    pytest.skip("benchmarks not available (installed package)",
+                allow_module_level=True)
+
+
+@pytest.fixture
+def benchmarks(monkeypatch):
+    """Make the benchmark scripts importable."""
+
+    monkeypatch.syspath_prepend(BENCHMARKS_DIR)
+
+
+def read_tree(root):
+    """Get the contents of all files under root, by relative path."""
+
+    contents = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, "rb") as f:
+                contents[os.path.relpath(path, root)] = f.read()
+
+    return contents
+
+
+TREE_ARGS = dict(files=60, depth=2, fanout=3, sizes="uniform:16:20000",
+                 dup_ratio=0.3, prefix_ratio=0.1, suffix_ratio=0.1)
+
+
+def test_gentree_same_seed(tmpdir, benchmarks):
+    """Test that the same seed always gives the same tree."""
+
+    import gentree
+
+    first = gentree.generate_tree(str(tmpdir.join("a")), seed=7, **TREE_ARGS)
+    second = gentree.generate_tree(str(tmpdir.join("b")), seed=7,
+                                   **TREE_ARGS)
+    other = gentree.generate_tree(str(tmpdir.join("c")), seed=8, **TREE_ARGS)
+
+    del first["root"], second["root"]
+    assert first == second
+
+    tree = read_tree(str(tmpdir.join("a")))
+    assert len(tree) == TREE_ARGS["files"]
+    assert read_tree(str(tmpdir.join("b"))) == tree
+    assert read_tree(str(tmpdir.join("c"))) != tree
+
+
+def test_run_scan(tmpdir, benchmarks):
+    """Test that run_scan reports the stages of a real scan."""
+
+    import gentree
+    import run_benchmarks
+
+    root = str(tmpdir.join("tree"))
+    manifest = gentree.generate_tree(root, seed=1, **TREE_ARGS)
+
+    result = run_benchmarks.run_scan(root)
+
+    assert result["errors"] == 0
+    assert result["duplicate_groups"] > 0
+    assert result["crawl"]["files"] == manifest["files"]
+    assert result["crawl"]["bytes"] == 0
+    assert result["full"]["bytes"] > 0
+    for stage in run_benchmarks.STAGES:
+        assert stage in result
@@ -0,0 +1,182 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Per-device scheduling testing."""
+
+import os
+import threading
+import time
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.devsched import DeviceScheduler
+from capidup.tests.conftest import check_same_results
+
+
+def setup_files(tmpdir):
+    """Create a few groups of duplicates, in several size groups."""
+
+    big = finddups.PARTIAL_MD5_THRESHOLD * 4
+    for i in range(12):
+        tmpdir.join("f%02d" % i).write(str(i % 2) * (big + i % 3))
+
+
+def test_same_results(dup_tree):
+    """Test that per-device queues give the same results."""
+
+    check_same_results(*dup_tree, ordered=True, device_workers=2)
+
+
+def test_device_stats(tmpdir):
+    """Test the statistics of each device."""
+
+    setup_files(tmpdir)
+
+    device_stats = {}
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(tmpdir)], device_workers=2, device_stats=device_stats)
+    assert not errors
+    assert len(dups) == 6
+
+    dev = os.stat(str(tmpdir)).st_dev
+    assert list(device_stats) == [dev]
+    # every file in the full stage, plus the partial stage
+    assert device_stats[dev]["files"] == 24
+    assert device_stats[dev]["bytes"] > 12 * finddups.PARTIAL_MD5_THRESHOLD
+    assert device_stats[dev]["seconds"] >= 0
+
+
+def test_independent_queues():
+    """Test that a slow device doesn't hold back the others."""
+
+    fast_done = threading.Event()
+    slow_done_first = []
+
+    def job(device, i):
+        """Fake hashing job: slow device waits for the fast one."""
+        if device == "slow":
+            # only finishes once all fast jobs are done, or times out
+            slow_done_first.append(not fast_done.wait(5))
+        elif i == 9:
+            fast_done.set()
+        return (device, i)
+
+    devices = ["slow"] * 2 + ["fast"] * 8
+    indexes = list(range(len(devices)))
+
+    stats = {}
+    scheduler = DeviceScheduler(1, stats)
+    try:
+        results = scheduler.map(job, devices, devices, indexes)
+    finally:
+        scheduler.shutdown()
+
+    assert results == list(zip(devices, indexes))
+    assert slow_done_first == [False, False]
+    assert stats["slow"]["files"] == 2
+    assert stats["fast"]["files"] == 8
+
+
+def test_concurrency_limit():
+    """Test that each device runs at most its number of workers."""
+
+    lock = threading.Lock()
+    running = {}
+    max_running = {}
+
+    def job(device):
+        """Fake hashing job that tracks concurrency per device."""
+        with lock:
+            running[device] = running.get(device, 0) + 1
+            max_running[device] = max(max_running.get(device, 0),
+                                      running[device])
+        time.sleep(0.01)
+        with lock:
+            running[device] -= 1
+
+    devices = ["a", "b"] * 10
+
+    scheduler = DeviceScheduler(2)
+    try:
+        scheduler.map(job, devices, devices)
+    finally:
+        scheduler.shutdown()
+
+    assert max_running == {"a": 2, "b": 2}
+
+
+def test_invalid_workers():
+    """Test that a device needs at least one worker."""
+
+    with pytest.raises(ValueError):
+        DeviceScheduler(0)
+
+
+def test_batches_not_held_back(monkeypatch):
+    """Test that batches on a fast device don't wait for a slow one."""
+
+    release = threading.Event()
+
+    def fake_digest(filename, regions, algorithm, digest_cache=None,
+                    read_options=None):
+        """Fake digest_or_error(): files on "slow" wait to be released."""
+        if filename.startswith("slow"):
+            assert release.wait(5)
+        return b"same", None, regions[0][1]
+
+    class NamedDevices(DeviceScheduler):
+        """Scheduler that takes the device from the first path component."""
+
+        @staticmethod
+        def device_of(filename):
+            return filename.split("/")[0]
+
+    monkeypatch.setattr(finddups, "digest_or_error", fake_digest)
+
+    size = finddups.PARTIAL_MD5_THRESHOLD * 4
+    errors = []
+    stage_iter = (finddups.compare_stages([(size, filenames)], "md5", "md5",
+                                          False, None, errors)
+                  for filenames in (["slow/a1", "slow/a2"],
+                                    ["fast/b1", "fast/b2"]))
+
+    device_stats = {}
+    scheduler = NamedDevices(1, device_stats, lambda result: result[2])
+    try:
+        dups = finddups.iter_stages_scheduled(stage_iter, None, None, 2,
+                                              scheduler)
+
+        # both stages of the fast batch are done, while the slow one is
+        # still stuck in its first stage
+        assert next(dups) == ["fast/b1", "fast/b2"]
+        assert not release.is_set()
+
+        release.set()
+        assert list(dups) == [["slow/a1", "slow/a2"]]
+    finally:
+        release.set()
+        scheduler.shutdown()
+
+    assert not errors
+    partial = finddups.partial_md5_size(size)
+    assert device_stats["fast"]["files"] == 4
+    assert device_stats["fast"]["bytes"] == 2 * partial + 2 * size
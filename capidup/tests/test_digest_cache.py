@@ -0,0 +1,185 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Persistent digest cache testing."""
+
+import os
+
+import capidup.finddups as finddups
+from capidup.digestcache import DigestCache
+from capidup.tests.conftest import sorted_groups, age_files
+
+
+def setup_dups(tmpdir):
+    """Create two groups of large duplicates and a unique file.
+
+    The files are large enough to go through both the partial and the full
+    hashing stages.
+
+    """
+    big = finddups.PARTIAL_MD5_THRESHOLD * 4
+    for name, content in [("a1", "a" * big), ("a2", "a" * big),
+                          ("b1", "b" * big), ("b2", "b" * big),
+                          ("c", "c" * (big - 1) + "a")]:
+        tmpdir.join(name).write(content)
+
+    age_files(str(tmpdir))
+
+
+def test_get_put(tmpdir):
+    """Test storing and retrieving a digest."""
+
+    f = tmpdir.join("f")
+    f.write("foo")
+    age_files(str(tmpdir))
+    file_info = os.stat(str(f))
+
+    with DigestCache(str(tmpdir.join("cache.db"))) as cache:
+        assert cache.get(file_info, 3) is None
+        cache.put(file_info, 3, b"digest")
+
+        assert cache.get(file_info, 3) == b"digest"
+        # a different read length is a different entry
+        assert cache.get(file_info, 2) is None
+
+        assert cache.hits == 1
+        assert cache.misses == 2
+
+
+def test_persistence(tmpdir):
+    """Test that entries survive closing and reopening the cache."""
+
+    f = tmpdir.join("f")
+    f.write("foo")
+    age_files(str(tmpdir))
+    file_info = os.stat(str(f))
+    path = str(tmpdir.join("cache.db"))
+
+    with DigestCache(path) as cache:
+        cache.put(file_info, 3, b"digest")
+
+    with DigestCache(path) as cache:
+        assert cache.get(file_info, 3) == b"digest"
+
+
+def test_stale_entry(tmpdir):
+    """Test that entries of modified files are not used, and are evicted."""
+
+    f = tmpdir.join("f")
+    f.write("foo")
+    age_files(str(tmpdir))
+    old_info = os.stat(str(f))
+
+    with DigestCache(":memory:") as cache:
+        cache.put(old_info, 3, b"digest")
+
+        f.write("barbaz")
+        new_info = os.stat(str(f))
+
+        assert cache.get(new_info, 3) is None
+        assert cache.evicted == 1
+        assert len(cache) == 0
+
+
+def test_evict_unused(tmpdir):
+    """Test evicting entries that weren't used in the current session."""
+
+    f = tmpdir.join("f")
+    f.write("foo")
+    age_files(str(tmpdir))
+    file_info = os.stat(str(f))
+    path = str(tmpdir.join("cache.db"))
+
+    with DigestCache(path) as cache:
+        cache.put(file_info, 3, b"digest")
+        cache.put(file_info, 1, b"other")
+
+    with DigestCache(path) as cache:
+        assert cache.get(file_info, 3) == b"digest"
+
+        assert cache.evict_unused() == 1
+        assert len(cache) == 1
+
+
+def test_warm_rescan(tmpdir):
+    """Test that a rescan with a warm cache gives the same results.
+
+    The second scan should get all digests from the cache, and read no
+    files at all.
+
+    """
+    setup_dups(tmpdir)
+    cache_path = str(tmpdir.join("cache.db"))
+    expected = [[str(tmpdir.join(n)) for n in names]
+                for names in (["a1", "a2"], ["b1", "b2"])]
+
+    with DigestCache(cache_path) as cache:
+        dups, errors = finddups.find_duplicates_in_dirs(
+            [str(tmpdir)], exclude_files=["cache.db*"], digest_cache=cache)
+        assert not errors
+        assert sorted_groups(dups) == expected
+        assert cache.hits == 0
+        cold_misses = cache.misses
+
+    with DigestCache(cache_path) as cache:
+        dups, errors = finddups.find_duplicates_in_dirs(
+            [str(tmpdir)], exclude_files=["cache.db*"], digest_cache=cache)
+        assert not errors
+        assert sorted_groups(dups) == expected
+        assert cache.hits == cold_misses
+        assert cache.misses == 0
+
+
+def test_racy_file_not_stored(tmpdir):
+    """Test that digests of just modified files are not stored."""
+
+    f = tmpdir.join("f")
+    f.write("foo")
+    file_info = os.stat(str(f))
+
+    with DigestCache(":memory:") as cache:
+        cache.put(file_info, 3, b"digest")
+
+        assert cache.get(file_info, 3) is None
+        assert len(cache) == 0
+
+
+def test_hits_not_written(tmpdir):
+    """Test that hits only mark entries as used when committing."""
+
+    f = tmpdir.join("f")
+    f.write("foo")
+    age_files(str(tmpdir))
+    file_info = os.stat(str(f))
+    path = str(tmpdir.join("cache.db"))
+
+    with DigestCache(path) as cache:
+        cache.put(file_info, 3, b"digest")
+
+    with DigestCache(path) as cache:
+        changes = cache._conn.total_changes
+        for _ in range(3):
+            assert cache.get(file_info, 3) == b"digest"
+        assert cache._conn.total_changes == changes
+
+        cache.commit()
+        assert cache._conn.total_changes == changes + 1
+        assert cache.evict_unused() == 0
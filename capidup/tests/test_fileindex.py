@@ -0,0 +1,181 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Compact file index testing."""
+
+import os
+import sys
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.fileindex import CompactFileIndex
+from capidup.tests.conftest import check_same_results
+
+
+def test_add_and_get():
+    """Test adding files, and getting them back by size."""
+
+    index = CompactFileIndex()
+    index.add_file(10, "/a", "x", 1)
+    index.add_file(20, "/a", "y", 2)
+    index.add_file(10, "/b/c", "z", 3)
+    index.add_file(30, "/a", "w")
+
+    assert len(index) == 3
+    assert index.num_files() == 4
+    assert 10 in index and 40 not in index
+    assert list(index) == [10, 20, 30]
+
+    assert index[10] == [os.path.join("/a", "x"), os.path.join("/b/c", "z")]
+    assert index.get(40) is None
+    assert [index.inode(e) for e in index.entries(10)] == [1, 3]
+
+    assert list(index.items()) == [(10, index[10]), (20, index[20]),
+                                   (30, index[30])]
+
+
+def test_popitem():
+    """Test removing sizes from the index."""
+
+    index = CompactFileIndex()
+    for size, name in [(1, "a"), (2, "b"), (1, "c")]:
+        index.add_file(size, "/d", name)
+
+    popped = []
+    while index:
+        popped.append(index.popitem())
+
+    assert sorted(popped) == [(1, [os.path.join("/d", "a"),
+                                   os.path.join("/d", "c")]),
+                              (2, [os.path.join("/d", "b")])]
+
+    with pytest.raises(KeyError):
+        index.popitem()
+
+
+def test_count_and_del():
+    """Test counting and removing a size, without building paths."""
+
+    index = CompactFileIndex()
+    for size, name in [(1, "a"), (2, "b"), (1, "c")]:
+        index.add_file(size, "/d", name)
+
+    assert index.count(1) == 2
+    assert index.count(2) == 1
+    with pytest.raises(KeyError):
+        index.count(3)
+
+    del index[2]
+    assert list(index) == [1]
+
+
+def test_unique_sizes_no_paths(tmpdir, monkeypatch):
+    """Test that paths of files with a unique size are never built."""
+
+    for i in range(5):
+        tmpdir.join("u%d" % i).write("x" * (i + 1))
+    tmpdir.join("a1").write("a" * 10)
+    tmpdir.join("a2").write("a" * 10)
+
+    built = []
+    real_path = CompactFileIndex.path
+
+    def _path(self, entry):
+        path = real_path(self, entry)
+        built.append(os.path.basename(path))
+        return path
+
+    monkeypatch.setattr(CompactFileIndex, "path", _path)
+
+    dups, errors = finddups.find_duplicates_in_dirs([str(tmpdir)],
+                                                    compact_index=True)
+    assert not errors
+    assert len(dups) == 1
+    assert sorted(built) == ["a1", "a2"]
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 str names")
+def test_names_roundtrip():
+    """Test that non-ASCII and undecodable names come back intact."""
+
+    names = [u"caf\xe9", u"日本", u"bad\udcff"]
+
+    index = CompactFileIndex()
+    for name in names:
+        index.add_file(1, "/d", name)
+    index.add_file(2, b"/d", b"raw\xff")
+
+    assert index[1] == [os.path.join("/d", n) for n in names]
+    assert index[2] == [b"/d/raw\xff"]
+
+
+def test_same_results(dup_tree):
+    """Test that a compact index gives exactly the same results."""
+
+    check_same_results(*dup_tree, ordered=True, compact_index=True)
+
+
+def test_index_files_by_size(dup_tree):
+    """Test indexing a tree into a compact index."""
+
+    root, _ = dup_tree
+
+    files_by_size = {}
+    finddups.index_files_by_size(root, files_by_size, [], [], False)
+
+    index = CompactFileIndex()
+    errors = finddups.index_files_by_size(root, index, [], [], False)
+
+    assert not errors
+    assert dict(index.items()) == files_by_size
+    for size in index:
+        for entry, path in zip(index.entries(size), index[size]):
+            assert index.inode(entry) == os.stat(path).st_ino
+
+
+def test_batches(tmpdir, monkeypatch):
+    """Test that a compact index is compared a batch at a time.
+
+    The paths of a batch of size groups should only be built when that
+    batch is about to be compared, not all at once.
+
+    """
+    for i in range(10):
+        tmpdir.join("a%d" % i).write("x" * i)
+        tmpdir.join("b%d" % i).write("x" * i)
+
+    batch_files = []
+    real_find = finddups.find_duplicates_in_groups
+
+    def _find(groups, *args, **kwargs):
+        groups = list(groups)
+        batch_files.append(sum(len(filenames) for _, filenames in groups))
+        return real_find(groups, *args, **kwargs)
+
+    monkeypatch.setattr(finddups, "MAX_PENDING_JOBS", 4)
+    monkeypatch.setattr(finddups, "find_duplicates_in_groups", _find)
+
+    dups, errors = finddups.find_duplicates_in_dirs([str(tmpdir)],
+                                                    compact_index=True)
+    assert not errors
+    assert len(dups) == 10
+    assert batch_files == [4] * 5
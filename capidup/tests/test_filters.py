@@ -0,0 +1,118 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Size and predicate filter testing."""
+
+import os
+import threading
+
+import pytest
+
+import capidup.finddups as finddups
+
+
+def setup_files(tmpdir):
+    """Create pairs of duplicates of several sizes and extensions."""
+
+    for size in (1, 10, 100):
+        for ext in ("txt", "bin"):
+            for i in (1, 2):
+                tmpdir.join("%d_%d.%s" % (size, i, ext)).write(
+                    ext[0] * size)
+
+
+def group_names(groups):
+    """Get the sorted base names of the first file of each group."""
+
+    return sorted(os.path.basename(sorted(g)[0]) for g in groups)
+
+
+@pytest.mark.parametrize("min_size,max_size,expected", [
+    (0, None, ["100_1.bin", "100_1.txt", "10_1.bin", "10_1.txt", "1_1.bin",
+               "1_1.txt"]),
+    (10, None, ["100_1.bin", "100_1.txt", "10_1.bin", "10_1.txt"]),
+    (0, 10, ["10_1.bin", "10_1.txt", "1_1.bin", "1_1.txt"]),
+    (10, 10, ["10_1.bin", "10_1.txt"]),
+    (11, 99, []),
+])
+def test_size_limits(tmpdir, min_size, max_size, expected):
+    """Test leaving out files by size."""
+
+    setup_files(tmpdir)
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(tmpdir)], min_size=min_size, max_size=max_size)
+
+    assert not errors
+    assert group_names(dups) == expected
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_file_filter(tmpdir, workers):
+    """Test leaving out files with a predicate on the path and stat."""
+
+    setup_files(tmpdir)
+
+    calls = []
+    lock = threading.Lock()
+
+    def only_large_txt(path, file_info):
+        """Keep only .txt files with more than 1 byte."""
+        with lock:
+            calls.append(path)
+        return path.endswith(".txt") and file_info.st_size > 1
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(tmpdir)], file_filter=only_large_txt, workers=workers)
+
+    assert not errors
+    assert group_names(dups) == ["100_1.txt", "10_1.txt"]
+    assert len(calls) == 12
+
+
+def test_filtered_not_opened(tmpdir, monkeypatch):
+    """Test that rejected files are never hashed, nor passed to filters."""
+
+    setup_files(tmpdir)
+
+    hashed = []
+    real_calculate_digest = finddups.calculate_digest
+
+    def recording_digest(filename, length, algorithm, *args):
+        """calculate_digest() that records the hashed files."""
+        hashed.append(os.path.basename(filename))
+        return real_calculate_digest(filename, length, algorithm, *args)
+
+    monkeypatch.setattr(finddups, "calculate_digest", recording_digest)
+
+    seen = []
+    files_by_size = {}
+    errors = finddups.index_files_by_size(
+        str(tmpdir), files_by_size, [], [], False, min_size=100,
+        file_filter=lambda path, file_info: seen.append(path) or True)
+
+    assert not errors
+    assert sorted(files_by_size) == [100]
+    assert len(seen) == 4
+
+    finddups.find_duplicates_in_dirs([str(tmpdir)], min_size=100)
+    assert sorted(hashed) == ["100_1.bin", "100_1.txt", "100_2.bin",
+                              "100_2.txt"]
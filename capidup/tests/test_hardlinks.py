@@ -0,0 +1,147 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Hard link handling testing."""
+
+import os
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.tests.conftest import sorted_groups
+
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "link"),
+                                reason="hard links not supported")
+
+
+def setup_links(tmpdir):
+    """Create a file with three links, a copy of it, and a unique file.
+
+    Returns a dictionary of the full paths, by name.
+
+    """
+    big = finddups.PARTIAL_MD5_THRESHOLD * 4
+    tmpdir.join("a").write("a" * big)
+    tmpdir.join("copy").write("a" * big)
+    tmpdir.join("unique").write("u" * (big - 1))
+    tmpdir.mkdir("sub")
+    os.link(str(tmpdir.join("a")), str(tmpdir.join("link1")))
+    os.link(str(tmpdir.join("a")), str(tmpdir.join("sub", "link2")))
+
+    return dict((name, str(tmpdir.join(*name.split("/"))))
+                for name in ("a", "copy", "unique", "link1", "sub/link2"))
+
+
+def test_index_once(tmpdir):
+    """Test that each inode is indexed once, and its links recorded."""
+
+    paths = setup_links(tmpdir)
+
+    files_by_size = {}
+    hardlinks = {}
+    errors = finddups.index_files_by_size(str(tmpdir), files_by_size, [], [],
+                                          False, hardlinks=hardlinks)
+
+    assert not errors
+    indexed = [f for filenames in files_by_size.values() for f in filenames]
+    assert len(indexed) == 3
+    assert paths["copy"] in indexed
+    assert paths["unique"] in indexed
+
+    assert len(hardlinks) == 1
+    links = list(hardlinks.values())[0]
+    assert sorted(links) == sorted([paths["a"], paths["link1"],
+                                    paths["sub/link2"]])
+    assert links[0] in indexed
+
+
+def test_hash_once(tmpdir, monkeypatch):
+    """Test that files with several links are only hashed once per stage."""
+
+    setup_links(tmpdir)
+
+    hashed = []
+    real_calculate_digest = finddups.calculate_digest
+
+    def recording_digest(filename, length, algorithm, *args):
+        """calculate_digest() that records the hashed files."""
+        hashed.append(filename)
+        return real_calculate_digest(filename, length, algorithm, *args)
+
+    monkeypatch.setattr(finddups, "calculate_digest", recording_digest)
+
+    finddups.find_duplicates_in_dirs([str(tmpdir)])
+
+    # one link and the copy, in the partial and the full stage
+    assert len(hashed) == 4
+
+
+@pytest.mark.parametrize("func", ["find", "iter"])
+def test_include(tmpdir, func):
+    """Test that all links are reported as duplicates, by default."""
+
+    paths = setup_links(tmpdir)
+
+    if func == "find":
+        dups, errors = finddups.find_duplicates_in_dirs([str(tmpdir)])
+    else:
+        errors = []
+        dups = list(finddups.iter_duplicates_in_dirs([str(tmpdir)],
+                                                     errors=errors))
+
+    assert not errors
+    assert sorted_groups(dups) == sorted_groups(
+        [[paths[n] for n in ("a", "copy", "link1", "sub/link2")]])
+
+
+def test_links_only(tmpdir):
+    """Test that links to a file with a unique size are duplicates."""
+
+    tmpdir.join("a").write("foo")
+    os.link(str(tmpdir.join("a")), str(tmpdir.join("b")))
+
+    dups, errors = finddups.find_duplicates_in_dirs([str(tmpdir)])
+
+    assert not errors
+    assert sorted_groups(dups) == [[str(tmpdir.join("a")),
+                                    str(tmpdir.join("b"))]]
+
+
+def test_exclude(tmpdir):
+    """Test that only one path per file is reported, when excluding."""
+
+    paths = setup_links(tmpdir)
+
+    dups, errors = finddups.find_duplicates_in_dirs([str(tmpdir)],
+                                                    hardlinks="exclude")
+
+    assert not errors
+    assert len(dups) == 1
+    assert len(dups[0]) == 2
+    assert paths["copy"] in dups[0]
+
+
+def test_invalid_mode():
+    """Test that an unknown hard links mode is rejected."""
+
+    with pytest.raises(ValueError):
+        finddups.find_duplicates_in_dirs(["/nonexistent"], hardlinks="foo")
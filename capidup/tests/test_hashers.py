@@ -0,0 +1,134 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Pluggable hash algorithm testing."""
+
+import hashlib
+import os
+import zlib
+import struct
+
+import pytest
+
+import capidup.finddups as finddups
+import capidup.hashers as hashers
+
+
+algorithms = ["md5", "sha1", "sha256", "crc32"]
+if "blake2b" in hashers.available_algorithms():
+    algorithms.append("blake2b")
+if "xxh64" in hashers.available_algorithms():     # pragma: no cover
+    algorithms.append("xxh64")
+
+
+@pytest.mark.parametrize("algorithm", algorithms)
+def test_calculate_digest(tmpdir, algorithm):
+    """Test that digests match a one-shot hash of the same data."""
+
+    data = b"0123456789" * 100000
+    f = tmpdir.join("f")
+    f.write_binary(data)
+
+    length = len(data) - 7
+    digest = finddups.calculate_digest(str(f), length, algorithm)
+
+    if algorithm == "crc32":
+        expected = struct.pack(">I", zlib.crc32(data[:length]) & 0xffffffff)
+    else:
+        h = hashers.new_hasher(algorithm)
+        h.update(data[:length])
+        expected = h.digest()
+
+    assert digest == expected
+
+
+def test_md5_compatible(tmpdir):
+    """Test that calculate_md5 still gives plain MD5 digests."""
+
+    f = tmpdir.join("f")
+    f.write_binary(b"foobar")
+
+    assert finddups.calculate_md5(str(f), 6) == hashlib.md5(b"foobar").digest()
+    assert finddups.calculate_md5(str(f), 0) == hashlib.md5().digest()
+
+
+def test_unsupported():
+    """Test that unknown algorithms are rejected before doing anything."""
+
+    with pytest.raises(ValueError):
+        hashers.new_hasher("nosuchhash")
+
+    with pytest.raises(ValueError):
+        finddups.find_duplicates_in_dirs(["/nonexistent"],
+                                         full_hash="nosuchhash")
+
+
+@pytest.mark.parametrize("partial_hash", algorithms)
+@pytest.mark.parametrize("full_hash", ["md5", "sha256"])
+def test_find_dups(tmpdir, partial_hash, full_hash):
+    """Test finding duplicates with different partial and full algorithms."""
+
+    big = finddups.PARTIAL_MD5_THRESHOLD * 4
+    for name, content in [("a1", "a" * big), ("a2", "a" * big),
+                          ("b1", "a" * (big - 1) + "b"), ("c", "c" * big)]:
+        tmpdir.join(name).write(content)
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(tmpdir)], partial_hash=partial_hash, full_hash=full_hash)
+
+    assert not errors
+    assert [sorted(g) for g in dups] == [[str(tmpdir.join("a1")),
+                                          str(tmpdir.join("a2"))]]
+
+
+def test_cache_per_algorithm(tmpdir):
+    """Test that the digest cache keeps algorithms apart."""
+
+    from capidup.digestcache import DigestCache
+    from capidup.tests.conftest import age_files
+
+    f = tmpdir.join("f")
+    f.write("foo")
+    age_files(str(tmpdir))
+
+    with DigestCache(":memory:") as cache:
+        md5 = finddups.cached_digest(str(f), 3, "md5", cache)
+        sha1 = finddups.cached_digest(str(f), 3, "sha1", cache)
+
+        assert md5 != sha1
+        assert cache.misses == 2
+        assert finddups.cached_digest(str(f), 3, "sha1", cache) == sha1
+        assert cache.hits == 1
+
+
+@pytest.mark.parametrize("algorithm", ["md5", "sha1"])
+def test_error_names_algorithm(tmpdir, algorithm):
+    """Test that read errors name the hash algorithm, as "MD5" by default."""
+
+    f = tmpdir.join("f")
+    f.write("foo")
+    os.chmod(str(f), 0)
+
+    digest, error, _ = finddups.digest_or_error(str(f), [(0, 3)], algorithm)
+
+    assert digest is None
+    assert error.startswith("unable to calculate %s for '%s': "
+                            % (algorithm.upper(), f))
@@ -22,32 +22,59 @@
 """White box file indexing testing."""
 
 
+import os
+
 import pytest
 
 import capidup.finddups as finddups
 
 
+class FakeDirEntry(object):
+    """Fake os.DirEntry, for a file that doesn't exist.
+
+    It claims to be a directory or a regular file, as told, but any attempt
+    to stat it fails.
+
+    """
+    def __init__(self, dirpath, name, is_dir):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._is_dir = is_dir
+
+    def is_dir(self, follow_symlinks=True):
+        return self._is_dir
+
+    def is_file(self, follow_symlinks=True):
+        return not self._is_dir
+
+    def stat(self, follow_symlinks=True):
+        return os.lstat(self.path)
+
+
 def test_nonexistent(tmpdir, monkeypatch):
     """Test indexing a nonexistent directory tree.
 
     This test makes sure that index_files_by_size() can properly handle the
-    race condition where os.walk() provides a certain filename, but when we
-    try to os.lstat() it, the file is no longer there. See issue #12 for
-    more details.
+    race condition where scandir() provides a certain filename, but when we
+    try to stat it, the file is no longer there. See issue #12 for more
+    details.
 
-    Uses a monkeypatch fixture to patch capidup's os module, to use a fake
-    os.walk() that provides fictitious filenames. Uses a tmpdir fixture to
-    make sure the directory tree is empty, so the tested files really don't
-    exist.
+    Uses a monkeypatch fixture to patch capidup's scandir() function, to
+    use a fake scandir() that provides fictitious filenames. Uses a tmpdir
+    fixture to make sure the directory tree is empty, so the tested files
+    really don't exist.
 
     """
-    def fake_walk(top, topdown=True, onerror=None, followlinks=False):
-        """Fake os.walk() function that returns nonexistent paths."""
+    def fake_scandir(path):
+        """Fake scandir() function that returns nonexistent paths."""
 
-        return [ (top, ['subdir1', 'subdir2'], ['file1', 'file2']) ]
+        return [FakeDirEntry(path, 'subdir1', True),
+                FakeDirEntry(path, 'subdir2', True),
+                FakeDirEntry(path, 'file1', False),
+                FakeDirEntry(path, 'file2', False)]
 
-    # patch finddup's os module to replace walk() with our fake_walk()
-    monkeypatch.setattr(finddups.os, 'walk', fake_walk)
+    # patch finddup's scandir() with our fake_scandir()
+    monkeypatch.setattr(finddups.py3compat, 'scandir', fake_scandir)
 
     d = {}
     errors = finddups.index_files_by_size(str(tmpdir), d, [], [], False)
@@ -61,22 +88,137 @@ def test_nonexistent(tmpdir, monkeypatch):
 
 
 @pytest.mark.parametrize("follow_dirlinks", [False, True])
-def test_followlinks(tmpdir, monkeypatch, follow_dirlinks):
+def test_followlinks(tmpdir, follow_dirlinks):
     """Test following symbolic links to subdirectories.
 
-    This test makes sure that os.walk() gets called with the appropriate
-    argument to follow links, if and only if find_duplicates_in_dirs() is
-    called with follow_dirlinks=True.
+    This test makes sure that a symbolic link to a subdirectory is crawled
+    if and only if find_duplicates_in_dirs() is called with
+    follow_dirlinks=True.
+
+    """
+    target = tmpdir.mkdir("target")
+    target.join("a1").write("a")
+    target.join("a2").write("a")
+
+    crawled = tmpdir.mkdir("crawled")
+    os.symlink(str(target), str(crawled.join("link")))
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(crawled)], follow_dirlinks=follow_dirlinks)
+
+    assert not errors
+    assert len(dups) == (1 if follow_dirlinks else 0)
+
+
+def test_stat_once(tmpdir, monkeypatch):
+    """Test that each subdirectory and file is stat'ed only once.
+
+    The directory listing already tells which entries are directories, so
+    the crawl should do exactly one stat per indexed entry, and none for
+    the directories being listed.
 
     """
-    def fake_walk(top, topdown=True, onerror=None, followlinks=False):
-        """Fake os.walk() that validates its followlinks argument."""
-        assert followlinks == follow_dirlinks
+    for d in ("d1", "d2"):
+        sub = tmpdir.mkdir(d)
+        for f in ("f1", "f2", "f3"):
+            sub.join(f).write("a")
+
+    stat_calls = []
+    real_scandir = finddups.py3compat.scandir
+
+    class CountingDirEntry(object):
+        """DirEntry wrapper that counts stat() calls."""
+
+        def __init__(self, entry):
+            self._entry = entry
+            self.name = entry.name
+            self.path = entry.path
 
-        return []
+        def is_dir(self, follow_symlinks=True):
+            return self._entry.is_dir(follow_symlinks=follow_symlinks)
 
-    # patch finddup's os module to replace walk() with our fake_walk()
-    monkeypatch.setattr(finddups.os, 'walk', fake_walk)
+        def is_file(self, follow_symlinks=True):
+            return self._entry.is_file(follow_symlinks=follow_symlinks)
 
-    finddups.find_duplicates_in_dirs(str(tmpdir), follow_dirlinks=follow_dirlinks)
+        def stat(self, follow_symlinks=True):
+            stat_calls.append(self.path)
+            return self._entry.stat(follow_symlinks=follow_symlinks)
+
+    def counting_scandir(path):
+        """scandir() that wraps its entries in CountingDirEntry."""
+
+        return [CountingDirEntry(e) for e in real_scandir(path)]
+
+    monkeypatch.setattr(finddups.py3compat, 'scandir', counting_scandir)
+
+    d = {}
+    errors = finddups.index_files_by_size(str(tmpdir), d, [], [], False)
+
+    assert not errors
+    assert len(d[1]) == 6
+    assert len(stat_calls) == 8
+    assert len(set(stat_calls)) == 8
+
+
+@pytest.mark.parametrize("follow_dirlinks", [False, True])
+def test_no_inodes_from_scandir(tmpdir, monkeypatch, follow_dirlinks):
+    """Test crawling where scandir() gives no inode numbers (Windows)."""
+
+    for d in ("d1", "d2", "d3/d4"):
+        tmpdir.ensure(d, "f", file=True)
+
+    real_scandir = finddups.py3compat.scandir
+
+    class NoInodeDirEntry(object):
+        """DirEntry wrapper whose stat() has st_dev and st_ino 0."""
+
+        def __init__(self, entry):
+            self._entry = entry
+            self.name = entry.name
+            self.path = entry.path
+
+        def is_dir(self, follow_symlinks=True):
+            return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+        def is_file(self, follow_symlinks=True):
+            return self._entry.is_file(follow_symlinks=follow_symlinks)
+
+        def stat(self, follow_symlinks=True):
+            st = self._entry.stat(follow_symlinks=follow_symlinks)
+            return os.stat_result(st[:1] + (0, 0) + st[3:])
+
+    def no_inode_scandir(path):
+        """scandir() that wraps its entries in NoInodeDirEntry."""
+
+        return [NoInodeDirEntry(e) for e in real_scandir(path)]
+
+    monkeypatch.setattr(finddups.py3compat, 'scandir', no_inode_scandir)
+
+    d = {}
+    errors = finddups.index_files_by_size(str(tmpdir), d, [], [],
+                                          follow_dirlinks)
+
+    assert not errors
+    assert len(d[0]) == 3
+
+
+def test_scandir_fallback(tmpdir, monkeypatch):
+    """Test indexing with the listdir-based scandir() fallback."""
+
+    sub = tmpdir.mkdir("sub")
+    sub.join("a").write("a")
+    tmpdir.join("bb").write("bb")
+    os.symlink(str(sub.join("a")), str(tmpdir.join("link")))
+
+    expected = {}
+    finddups.index_files_by_size(str(tmpdir), expected, [], [], False)
+
+    monkeypatch.setattr(finddups.py3compat, 'scandir',
+                        finddups.py3compat._listdir_scandir)
+
+    d = {}
+    errors = finddups.index_files_by_size(str(tmpdir), d, [], [], False)
 
+    assert not errors
+    assert d == expected
+    assert sorted(d) == [1, 2]
@@ -0,0 +1,103 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Disk layout aware read ordering testing."""
+
+import os
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup import ioorder
+from capidup.tests.conftest import check_same_results
+
+
+def setup_files(tmpdir):
+    """Create a few groups of duplicates, in several size groups."""
+
+    for i in range(20):
+        size = 100 + i % 4
+        tmpdir.join("f%02d" % i).write(str(i % 8) * size)
+
+
+@pytest.mark.parametrize("io_order", ioorder.IO_ORDERS)
+def test_same_results(dup_tree, io_order):
+    """Test that ordering the reads doesn't change the results."""
+
+    check_same_results(*dup_tree, ordered=True, io_order=io_order,
+                       workers=4)
+
+
+def test_inode_order(tmpdir, monkeypatch):
+    """Test that files are hashed in inode order, across size groups."""
+
+    setup_files(tmpdir)
+
+    hashed = []
+    real_calculate_digest = finddups.calculate_digest
+
+    def recording_digest(filename, length, algorithm, *args):
+        """calculate_digest() that records the hashed files."""
+        hashed.append(os.stat(filename).st_ino)
+        return real_calculate_digest(filename, length, algorithm, *args)
+
+    monkeypatch.setattr(finddups, "calculate_digest", recording_digest)
+
+    finddups.find_duplicates_in_dirs([str(tmpdir)], io_order="inode")
+
+    assert len(hashed) == 20
+    assert hashed == sorted(hashed)
+
+
+def test_physical_fallback(tmpdir, monkeypatch):
+    """Test falling back to inode order for files without a location."""
+
+    names = ["a", "b", "c"]
+    for name in names:
+        tmpdir.join(name).write(name)
+    paths = [str(tmpdir.join(n)) for n in names]
+
+    locations = {paths[0]: 2000, paths[1]: None, paths[2]: 1000}
+    monkeypatch.setattr(ioorder, "physical_offset",
+                        lambda filename, offset=0: locations[filename])
+
+    order = ioorder.read_order(paths + ["/nonexistent"], [0] * 4, "physical")
+
+    assert order == [2, 0, 1, 3]
+
+
+def test_physical_offset(tmpdir):
+    """Test that physical_offset() gives an offset or None, never fails."""
+
+    f = tmpdir.join("f")
+    f.write("x" * 100000)
+
+    offset = ioorder.physical_offset(str(f))
+    assert offset is None or offset >= 0
+
+    assert ioorder.physical_offset(str(tmpdir.join("nonexistent"))) is None
+
+
+def test_invalid():
+    """Test that an unknown ordering mode is rejected."""
+
+    with pytest.raises(ValueError):
+        finddups.find_duplicates_in_dirs(["/nonexistent"], io_order="foo")
@@ -0,0 +1,129 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Lockstep comparison testing."""
+
+import os
+
+import pytest
+
+import capidup.finddups as finddups
+import capidup.lockstep as lockstep
+
+
+def make_files(tmpdir, contents):
+    """Create files with the given contents, returning their names."""
+
+    names = []
+    for i, content in enumerate(contents):
+        f = tmpdir.join("f%d" % i)
+        f.write_binary(content)
+        names.append(str(f))
+
+    return names
+
+
+@pytest.mark.parametrize("max_open_files", [1, 2, 256])
+def test_split_group(tmpdir, max_open_files):
+    """Test splitting groups, with and without enough open files."""
+
+    size = 10000
+    contents = [b"a" * size, b"b" * size, b"a" * size,
+                b"a" * (size - 1) + b"b", b"a" * (size - 1) + b"b", b"c" * size]
+    names = make_files(tmpdir, contents)
+
+    dups, errors, bytes_read = lockstep.split_group_lockstep(
+        names, size, 1000, max_open_files)
+
+    assert not errors
+    assert sorted(dups) == [[names[0], names[2]], [names[3], names[4]]]
+    # "b" and "c" diverge on the first chunk
+    assert bytes_read == 4 * size + 2 * 1000
+
+
+def test_early_exit(tmpdir, monkeypatch):
+    """Test that files stop being read once they diverge."""
+
+    size = 100000
+    names = make_files(tmpdir, [b"a" + b"x" * (size - 1),
+                                b"b" + b"x" * (size - 1)])
+
+    reads = []
+    real_read = lockstep.LockstepFile.read
+
+    def counting_read(self, length):
+        """LockstepFile.read() that counts the bytes read."""
+        reads.append(length)
+        return real_read(self, length)
+
+    monkeypatch.setattr(lockstep.LockstepFile, "read", counting_read)
+
+    dups, errors, bytes_read = lockstep.split_group_lockstep(names, size,
+                                                             1000)
+
+    assert not dups
+    assert not errors
+    assert sum(reads) == 2 * 1000
+    assert bytes_read == 2 * 1000
+
+
+def test_unreadable(tmpdir):
+    """Test that unreadable files are reported and left out."""
+
+    names = make_files(tmpdir, [b"abc", b"abc", b"abc"])
+    os.chmod(names[1], 0)
+
+    dups, errors, bytes_read = lockstep.split_group_lockstep(names, 3, 1000)
+
+    assert dups == [[names[0], names[2]]]
+    assert len(errors) == 1
+    assert names[1] in errors[0]
+
+
+def test_find_dups_in_dirs(tmpdir):
+    """Test that lockstep mode finds the same duplicates as hashing."""
+
+    big = finddups.PARTIAL_MD5_THRESHOLD * 4
+    for name, content in [("a1", "a" * big), ("a2", "a" * big),
+                          ("b1", "a" * (big - 1) + "b"),
+                          ("b2", "a" * (big - 1) + "b"),
+                          ("c", "c"), ("c2", "c"), ("d", "d")]:
+        tmpdir.join(name).write(content)
+
+    expected, _ = finddups.find_duplicates_in_dirs([str(tmpdir)])
+    dups, errors = finddups.find_duplicates_in_dirs([str(tmpdir)],
+                                                    lockstep=True)
+
+    assert not errors
+    assert sorted(sorted(g) for g in dups) == \
+        sorted(sorted(g) for g in expected)
+    assert len(dups) == 3
+
+
+def test_find_dups(tmpdir):
+    """Test lockstep mode in find_duplicates."""
+
+    names = make_files(tmpdir, [b"ab", b"ab", b"ac", b"ac", b"ad"])
+
+    dups, errors = finddups.find_duplicates(names, 2, lockstep=True)
+
+    assert not errors
+    assert dups == [names[0:2], names[2:4]]
@@ -0,0 +1,194 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Compiled exclude matcher testing."""
+
+import fnmatch
+import os
+import warnings
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.matcher import ExcludeMatcher, compile_excludes
+
+
+NAMES = ["a", "b", "aa", "a.bak", "abak", "a.bak.txt", ".tmp", "x?y",
+         "[a]", "a]", "x*", "^a", "a.b", "ab.c"]
+
+NAME_PATTERNS = ["a", "*", "*.bak", "[ab]", "[ab]*", "[!ac]", "x?", "?a",
+                 "*.b*", "[", "[]]", "[!]]", "a]", "x*", "[^]a", "a.b",
+                 "*ak"]
+
+
+@pytest.mark.parametrize("pattern", NAME_PATTERNS)
+def test_same_as_fnmatch(pattern):
+    """Test that name patterns match exactly like fnmatch."""
+
+    matcher = ExcludeMatcher([pattern])
+
+    for name in NAMES:
+        assert matcher.match(name) == fnmatch.fnmatch(name, pattern), name
+
+
+def test_combined():
+    """Test matching against several patterns of all kinds at once."""
+
+    patterns = ["a", "*.bak", "x?", "sub/*.c"]
+    matcher = ExcludeMatcher(patterns)
+
+    for name in NAMES:
+        expected = any(fnmatch.fnmatch(name, p) for p in patterns[:3])
+        assert matcher.match(name) == expected, name
+
+    assert matcher.match("ab.c", "sub")
+    assert not matcher.match("ab.c", "")
+
+
+@pytest.mark.parametrize("pattern,rel_dir,name,expected", [
+    ("build/out", "build", "out", True),
+    ("build/out", "src/build", "out", False),
+    ("build/out", "", "out", False),
+    ("/build", "", "build", True),
+    ("/build", "src", "build", False),
+    ("build/", "src", "build", True),
+    ("a/*/c", "a/b", "c", True),
+    ("a/*/c", "a/b/b", "c", False),
+    ("a/*", "a/b", "c", False),
+    ("**/tmp", "", "tmp", True),
+    ("**/tmp", "x/y", "tmp", True),
+    ("a/**/b", "a", "b", True),
+    ("a/**/b", "a/x/y", "b", True),
+    ("a/**/b", "c/a", "b", False),
+    ("a/**", "a/x", "y", True),
+    ("a/?", "a", "bb", False),
+    ("a[!x]b/c", "a/b", "c", False),
+    ("a/[!x]", "a", "b", True),
+])
+def test_path_rules(pattern, rel_dir, name, expected):
+    """Test gitignore-style anchored path patterns."""
+
+    assert ExcludeMatcher([pattern]).match(name, rel_dir) == expected
+
+
+@pytest.mark.parametrize("pattern,matching,not_matching", [
+    # empty ranges are dropped, not a regular expression error
+    ("[z-a]", [], ["a", "z", "-"]),
+    ("[!z-a]", ["a", "z"], []),
+    ("[z-ab]", ["b"], ["a", "z"]),
+    ("[a-cz-b]", ["a", "b", "c"], ["z", "d", "-"]),
+    # hyphens that don't make ranges are literal
+    ("[a-]", ["a", "-"], ["b"]),
+    ("[-a]", ["a", "-"], ["b"]),
+    ("[a--]", [], ["a", "-", "b"]),
+    # set operations of regular expressions are literal characters
+    ("[a&&b]", ["a", "b", "&"], ["c"]),
+    ("[a~~b]", ["a", "~"], ["c"]),
+    ("[a||b]", ["a", "|"], ["c"]),
+    ("[!&]", ["a"], ["&"]),
+    ("[[]", ["["], ["a"]),
+    ("[\\]", ["\\"], ["a"]),
+])
+def test_character_sets(pattern, matching, not_matching):
+    """Test character sets that aren't valid regular expression sets."""
+
+    with warnings.catch_warnings():
+        # e.g. FutureWarning, for possible set operations
+        warnings.simplefilter("error")
+        matcher = ExcludeMatcher([pattern])
+
+    for name in matching:
+        assert matcher.match(name), name
+    for name in not_matching:
+        assert not matcher.match(name), name
+
+
+def test_bad_set_in_combined():
+    """Test that an odd character set doesn't break the other patterns."""
+
+    matcher = ExcludeMatcher(["[z-a]", "x?", "sub/[z-a]", "sub/b*"])
+
+    assert matcher.match("xy")
+    assert matcher.match("bb", "sub")
+    assert not matcher.match("a")
+
+
+def test_compile_excludes():
+    """Test getting a matcher from None, a list, or a matcher."""
+
+    assert not compile_excludes(None)
+    assert not compile_excludes(None).match("a")
+
+    matcher = compile_excludes(["a"])
+    assert matcher.patterns == ["a"]
+    assert compile_excludes(matcher) is matcher
+
+
+def test_prune_subtree(tmpdir, monkeypatch):
+    """Test that path patterns prune subtrees without listing them."""
+
+    for d in ("keep/build", "build/out/deep", "build/other"):
+        tmpdir.ensure(d, dir=True)
+        for fname in ("a1", "a2"):
+            tmpdir.join(d, fname).write("a")
+
+    listed = []
+    real_scandir = finddups.py3compat.scandir
+
+    def recording_scandir(path):
+        """scandir() that records the listed directories."""
+        listed.append(path)
+        return real_scandir(path)
+
+    monkeypatch.setattr(finddups.py3compat, "scandir", recording_scandir)
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(tmpdir)], exclude_dirs=["/build/out"], exclude_files=["keep/*"])
+
+    assert not errors
+    assert str(tmpdir.join("build", "out")) not in listed
+    assert str(tmpdir.join("build", "out", "deep")) not in listed
+    # keep/* only matches files directly under keep
+    assert sorted(sorted(g) for g in dups) == [
+        [str(tmpdir.join(d, n)) for d in ("build/other", "keep/build")
+         for n in ("a1", "a2")]]
+
+
+@pytest.mark.skipif(bytes is str, reason="bytes are str on Python 2")
+@pytest.mark.parametrize("exclude_files,exclude_dirs", [
+    (None, None), (["*.tmp"], ["x"]), (["sub/*.tmp"], ["/sub/x"])])
+def test_bytes_root(tmpdir, exclude_files, exclude_dirs):
+    """Test scanning a bytes root, with and without patterns."""
+
+    tmpdir.ensure("sub", "x", dir=True)
+    for name in ("a", "sub/b", "sub/c.tmp", "sub/x/d"):
+        tmpdir.join(name).write("a")
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(tmpdir).encode()], exclude_dirs=exclude_dirs,
+        exclude_files=exclude_files)
+
+    assert not errors
+    expected = [b"a", b"sub/b"]
+    if exclude_files is None:
+        expected += [b"sub/c.tmp", b"sub/x/d"]
+    assert sorted(sorted(g) for g in dups) == [
+        [os.path.join(str(tmpdir).encode(), name) for name in expected]]
@@ -0,0 +1,124 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Parallel directory crawl testing."""
+
+import os
+
+import pytest
+
+import capidup.finddups as finddups
+
+pytest.importorskip("concurrent.futures")
+
+
+def setup_tree(tmpdir, depth=3, fanout=3):
+    """Create a tree of subdirectories, each with a few files."""
+
+    dirs = [tmpdir]
+    for level in range(depth):
+        new_dirs = []
+        for d in dirs:
+            for i in range(fanout):
+                sub = d.mkdir("d%d" % i)
+                sub.join("same").write("same content")
+                sub.join("f%d.txt" % level).write("x" * (level + i))
+                sub.join("f.bak").write("backup")
+                new_dirs.append(sub)
+        dirs = new_dirs
+
+
+def sorted_index(files_by_size):
+    """Sort each list of filenames of an index, for comparison."""
+
+    return dict((size, sorted(names)) for size, names in files_by_size.items())
+
+
+def index(root, workers, exclude_dirs=(), exclude_files=(),
+          follow_dirlinks=False):
+    """Index a directory, returning the sorted index and the errors."""
+
+    files_by_size = {}
+    errors = finddups.index_files_by_size(str(root), files_by_size,
+                                          list(exclude_dirs),
+                                          list(exclude_files),
+                                          follow_dirlinks, workers=workers)
+
+    return sorted_index(files_by_size), errors
+
+
+@pytest.mark.parametrize("exclude_dirs", [[], ["d1"]])
+@pytest.mark.parametrize("exclude_files", [[], ["*.bak"]])
+def test_same_index(tmpdir, exclude_dirs, exclude_files):
+    """Test that a parallel crawl indexes the same files as a serial one."""
+
+    setup_tree(tmpdir)
+
+    expected = index(tmpdir, None, exclude_dirs, exclude_files)
+    result = index(tmpdir, 4, exclude_dirs, exclude_files)
+
+    assert result == expected
+    assert expected[0]
+
+
+def test_symlink_loop(tmpdir):
+    """Test that symlink loops are detected when following dirlinks."""
+
+    setup_tree(tmpdir, depth=2)
+    os.symlink(str(tmpdir), str(tmpdir.join("d0", "loop")))
+
+    expected = index(tmpdir, None, follow_dirlinks=True)
+    result = index(tmpdir, 4, follow_dirlinks=True)
+
+    assert result == expected
+    assert len(result[1]) == 1
+    assert "loop" in result[1][0]
+
+
+def test_symlinks_not_followed(tmpdir):
+    """Test that symlinks are ignored when not following dirlinks."""
+
+    setup_tree(tmpdir, depth=1)
+    os.symlink(str(tmpdir.join("d0")), str(tmpdir.join("link")))
+    os.symlink(str(tmpdir.join("d0", "same")), str(tmpdir.join("filelink")))
+
+    expected = index(tmpdir, None)
+    result = index(tmpdir, 4)
+
+    assert result == expected
+    assert not result[1]
+
+
+def test_unreadable_dir(tmpdir):
+    """Test that listing errors are reported, as in a serial crawl."""
+
+    setup_tree(tmpdir, depth=1)
+    noread = tmpdir.mkdir("noread")
+    os.chmod(str(noread), 0)
+
+    try:
+        expected = index(tmpdir, None)
+        result = index(tmpdir, 4)
+    finally:
+        os.chmod(str(noread), 0o700)
+
+    assert result == expected
+    assert len(result[1]) == 1
@@ -0,0 +1,169 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Progressive partial hashing testing."""
+
+import struct
+import zlib
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.tests.conftest import sorted_groups, check_same_results
+
+
+SCHEDULE = (100, 1000, 10000)
+
+
+def setup_files(tmpdir):
+    """Create files that differ at various offsets.
+
+    Returns the expected groups of duplicates.
+
+    """
+    size = 20000
+    contents = {
+        "same1": b"x" * size,
+        "same2": b"x" * size,
+        # differ from "same" after each step of the schedule
+        "diff50": b"x" * 50 + b"y" * (size - 50),
+        "diff500": b"x" * 500 + b"y" * (size - 500),
+        "diff5000a": b"x" * 5000 + b"y" * (size - 5000),
+        "diff5000b": b"x" * 5000 + b"y" * (size - 5000),
+        "diff15000": b"x" * 15000 + b"y" * (size - 15000),
+        # smaller than some steps of the schedule
+        "small1": b"s" * 500,
+        "small2": b"s" * 500,
+        "small3": b"s" * 499 + b"t",
+    }
+    for name, content in contents.items():
+        tmpdir.join(name).write_binary(content)
+
+    return sorted_groups([[str(tmpdir.join(n)) for n in names]
+                          for names in (["same1", "same2"],
+                                        ["diff5000a", "diff5000b"],
+                                        ["small1", "small2"])])
+
+
+def test_same_results(dup_tree):
+    """Test that a schedule finds the same duplicates."""
+
+    check_same_results(*dup_tree, partial_schedule=SCHEDULE)
+
+
+def test_regions(tmpdir, monkeypatch):
+    """Test that each stage only hashes the survivors' next portion."""
+
+    expected = setup_files(tmpdir)
+
+    regions = []
+    real_calculate_digest = finddups.calculate_digest
+
+    def recording_digest(filename, length, algorithm, offset=0, *args):
+        """calculate_digest() that records the hashed regions."""
+        regions.append((filename.rpartition("/")[2], offset, length))
+        return real_calculate_digest(filename, length, algorithm, offset,
+                                     *args)
+
+    monkeypatch.setattr(finddups, "calculate_digest", recording_digest)
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(tmpdir)], partial_schedule=SCHEDULE, partial_hash="md5",
+        full_hash="md5")
+    assert not errors
+    assert sorted_groups(dups) == expected
+
+    hashed = {}
+    for name, offset, length in regions:
+        hashed.setdefault(name, []).append((offset, length))
+
+    # diverges in the first step, so is never hashed again
+    assert hashed["diff50"] == [(0, 100)]
+    assert hashed["diff500"] == [(0, 100), (100, 900)]
+    # survives all the steps; the full stage hashes the rest
+    assert hashed["same1"] == [(0, 100), (100, 900), (1000, 9000),
+                               (10000, 10000)]
+    # no larger than the second step, so it goes to the full stage then
+    assert hashed["small1"] == [(0, 100), (100, 400)]
+
+
+def crc32_prefix(char):
+    """Get a 4096 byte prefix whose CRC-32 is the same for any char.
+
+    Appending the CRC-32 of a message to it gives a constant CRC-32, so
+    the prefixes of different chars collide.
+
+    """
+    data = char * 4092
+    return data + struct.pack("<I", zlib.crc32(data) & 0xffffffff)
+
+
+def test_weak_partial_hash(tmpdir):
+    """Test that a weak partial_hash doesn't cause false positives."""
+
+    prefix_a = crc32_prefix(b"a")
+    prefix_b = crc32_prefix(b"b")
+    assert prefix_a != prefix_b
+    assert zlib.crc32(prefix_a) == zlib.crc32(prefix_b)
+
+    tail = b"t" * 8192
+    tmpdir.join("a").write_binary(prefix_a + tail)
+    tmpdir.join("b").write_binary(prefix_b + tail)
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(tmpdir)], partial_hash="crc32", partial_schedule=(4096,))
+    assert not errors
+    assert dups == []
+
+
+def test_weak_partial_hash_regions(tmpdir, monkeypatch):
+    """Test that the full stage hashes whole files after a weaker hash."""
+
+    setup_files(tmpdir)
+
+    regions = []
+    real_calculate_digest = finddups.calculate_digest
+
+    def recording_digest(filename, length, algorithm, offset=0, *args):
+        """calculate_digest() that records the hashed regions."""
+        regions.append((filename.rpartition("/")[2], algorithm, offset,
+                        length))
+        return real_calculate_digest(filename, length, algorithm, offset,
+                                     *args)
+
+    monkeypatch.setattr(finddups, "calculate_digest", recording_digest)
+
+    finddups.find_duplicates_in_dirs(
+        [str(tmpdir)], partial_schedule=SCHEDULE, partial_hash="crc32",
+        full_hash="md5")
+
+    full = [(offset, length) for name, algorithm, offset, length in regions
+            if name == "same1" and algorithm == "md5"]
+    assert full == [(0, 20000)]
+
+
+@pytest.mark.parametrize("schedule", [(), (100, 100), (1000, 100), (0, 10)])
+def test_invalid(schedule):
+    """Test that invalid schedules are rejected."""
+
+    with pytest.raises(ValueError):
+        finddups.find_duplicates_in_dirs(["/nonexistent"],
+                                         partial_schedule=schedule)
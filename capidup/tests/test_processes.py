@@ -0,0 +1,91 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Multiprocess comparison testing."""
+
+import os
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.digestcache import DigestCache
+from capidup.tests.conftest import sorted_groups, check_same_results
+
+futures = pytest.importorskip("concurrent.futures")
+
+
+@pytest.mark.parametrize("processes", [1, 3])
+def test_same_results(dup_tree, processes):
+    """Test that worker processes find the same duplicates."""
+
+    check_same_results(*dup_tree, processes=processes)
+
+
+def test_small_batches(dup_tree, monkeypatch):
+    """Test splitting the groups into many batches."""
+
+    monkeypatch.setattr(finddups, "PROCESS_BATCH_BYTES", 1)
+
+    check_same_results(*dup_tree, processes=2)
+
+
+def test_spilling_index(dup_tree):
+    """Test worker processes with groups streamed from a spilling index."""
+
+    check_same_results(*dup_tree, processes=2, memory_limit=1)
+
+
+def test_hardlinks(tmpdir):
+    """Test that hard links are reported with worker processes."""
+
+    tmpdir.join("a").write("unique")
+    os.link(str(tmpdir.join("a")), str(tmpdir.join("b")))
+
+    result, _ = finddups.find_duplicates_in_dirs([str(tmpdir)], processes=2)
+
+    assert sorted_groups(result) == [[str(tmpdir.join("a")),
+                                      str(tmpdir.join("b"))]]
+
+
+def test_pack_groups():
+    """Test that packed groups unpack to the same groups."""
+
+    groups = [(3, ["/a/x", "/b/y", "/a/z"]), (5, ["/b/w", "u"])]
+    dirs, packed = finddups.pack_groups(groups)
+
+    assert len(dirs) == 3
+    assert finddups.unpack_groups(dirs, packed) == groups
+
+
+def test_bad_options(tmpdir):
+    """Test the options that can't be combined with processes."""
+
+    with pytest.raises(ValueError):
+        finddups.find_duplicates_in_dirs([str(tmpdir)], processes=0)
+
+    with DigestCache(":memory:") as cache:
+        with pytest.raises(ValueError):
+            finddups.find_duplicates_in_dirs([str(tmpdir)], processes=2,
+                                             digest_cache=cache)
+
+    with pytest.raises(ValueError):
+        finddups.find_duplicates_in_dirs([str(tmpdir)], processes=2,
+                                         device_workers=1)
@@ -0,0 +1,241 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Read backend testing."""
+
+import errno
+import hashlib
+import pickle
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup import readers
+from capidup.tests.conftest import sorted_groups
+
+
+SIZE = 3 * 1024 * 1024 + 17
+
+# (offset, length) regions: whole file, head, unaligned middle, tail, and
+# past EOF
+REGIONS = [(0, SIZE), (0, 4096), (12345, 1024 * 1024 + 3),
+           (SIZE - 5000, 5000), (SIZE - 100, 1000)]
+
+
+BACKENDS = sorted(readers.available_backends())
+
+
+@pytest.fixture
+def small_mmap(monkeypatch):
+    """Map even small regions, to exercise the mmap code."""
+
+    monkeypatch.setattr(readers, "MMAP_MIN_SIZE", 1024)
+
+
+@pytest.fixture
+def data_file(tmpdir):
+    """Create a file with varied contents, and return (path, contents)."""
+
+    contents = bytes(bytearray(i * 7 % 251 for i in range(SIZE)))
+    f = tmpdir.join("data")
+    f.write_binary(contents)
+
+    return str(f), contents
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("offset,length", REGIONS)
+def test_backends(small_mmap, backend, data_file, offset, length):
+    """Test that every backend hashes the same bytes."""
+
+    path, contents = data_file
+
+    read_counts = []
+    digest = finddups.calculate_digest(path, length, "md5", offset,
+                                       readers.ReadOptions(backend),
+                                       read_counts)
+
+    assert digest == hashlib.md5(contents[offset:offset + length]).digest()
+    assert read_counts == [len(contents[offset:offset + length])]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_multiple_regions(small_mmap, backend, data_file):
+    """Test hashing several regions of a file, opened once."""
+
+    path, contents = data_file
+
+    digests = finddups.calculate_digests(path, REGIONS, "sha1",
+                                         readers.ReadOptions(backend))
+
+    assert digests == [hashlib.sha1(contents[o:o + n]).digest()
+                       for o, n in REGIONS]
+
+
+def test_read_options():
+    """Test validating and pickling read options."""
+
+    assert readers.DEFAULT_READ_OPTIONS == ("auto", False)
+
+    options = readers.ReadOptions("read", cache_friendly=1)
+    assert options == ("read", True)
+    assert pickle.loads(pickle.dumps(options)) == options
+
+    with pytest.raises(ValueError):
+        readers.ReadOptions("foo")
+
+    with pytest.raises(ValueError):
+        finddups.find_duplicates([], 0, read_backend="foo")
+
+
+@pytest.fixture
+def fadvise(monkeypatch):
+    """Record all fadvise calls."""
+
+    advice = []
+
+    def fake_fadvise(fd, offset, length, advice_value):
+        """posix_fadvise() that only records its arguments."""
+        advice.append((offset, length, advice_value))
+
+    monkeypatch.setattr(readers.os, "posix_fadvise", fake_fadvise,
+                        raising=False)
+    monkeypatch.setattr(readers.os, "POSIX_FADV_SEQUENTIAL", "seq",
+                        raising=False)
+    monkeypatch.setattr(readers.os, "POSIX_FADV_DONTNEED", "dontneed",
+                        raising=False)
+
+    return advice
+
+
+CACHE_FRIENDLY = readers.ReadOptions(cache_friendly=True)
+
+
+def test_cache_friendly(fadvise, data_file):
+    """Test advising sequential reads, and dropping hashed regions."""
+
+    path, contents = data_file
+
+    digest = finddups.calculate_digest(path, 4096, "md5", 8192,
+                                       CACHE_FRIENDLY)
+
+    assert digest == hashlib.md5(contents[8192:8192 + 4096]).digest()
+    assert fadvise == [(0, 0, "seq"), (8192, 4096, "dontneed")]
+
+
+def test_not_cache_friendly(fadvise, data_file):
+    """Test that nothing is advised, unless in cache-friendly mode."""
+
+    path, contents = data_file
+
+    finddups.calculate_digest(path, SIZE, "md5")
+
+    assert fadvise == []
+
+
+@pytest.mark.parametrize("backend", sorted(set(BACKENDS) - set(["mmap"]))
+                         + ["auto"])
+def test_cache_friendly_chunks(fadvise, data_file, backend):
+    """Test dropping each chunk as soon as it has been hashed."""
+
+    path, contents = data_file
+    chunk = finddups.MD5_CHUNK_SIZE
+
+    digest = finddups.calculate_digest(
+        path, SIZE, "md5", 0, readers.ReadOptions(backend, True))
+
+    assert digest == hashlib.md5(contents).digest()
+    # not even file_digest reads the whole file at once
+    assert fadvise[1:] == [(offset, min(chunk, SIZE - offset), "dontneed")
+                           for offset in range(0, SIZE, chunk)]
+
+
+def test_cache_friendly_lockstep(fadvise, tmpdir):
+    """Test dropping compared chunks in lockstep mode."""
+
+    for name in ("a", "b"):
+        tmpdir.join(name).write("x" * 100)
+
+    dups, errors = finddups.find_duplicates(
+        [str(tmpdir.join("a")), str(tmpdir.join("b"))], 100, lockstep=True,
+        cache_friendly=True)
+
+    assert not errors
+    assert len(dups) == 1
+    assert fadvise.count((0, 100, "dontneed")) == 2
+
+
+def test_cache_friendly_dirs(fadvise, dup_tree):
+    """Test that the cache-friendly mode applies to every stage."""
+
+    root, expected = dup_tree
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [root], partial_schedule=(100, 1000), sample_blocks=2,
+        cache_friendly=True)
+
+    assert not errors
+    assert sorted_groups(dups) == expected
+    assert fadvise.count((0, 100, "dontneed")) > 0
+
+
+def test_options_to_processes(dup_tree, monkeypatch):
+    """Test that the read options are passed to worker processes."""
+
+    root, expected = dup_tree
+    options = []
+    real_iter_duplicates = finddups.iter_duplicates_in_processes
+
+    def recording_iter(groups, processes, batch_options, *args):
+        """iter_duplicates_in_processes() that records the options."""
+        options.append(batch_options)
+        return real_iter_duplicates(groups, processes, batch_options,
+                                    *args)
+
+    monkeypatch.setattr(finddups, "iter_duplicates_in_processes",
+                        recording_iter)
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [root], processes=2, read_backend="read", cache_friendly=True)
+
+    assert not errors
+    assert sorted_groups(dups) == expected
+    assert options[0][-1] == readers.ReadOptions("read", True)
+
+
+def test_noatime_fallback(fadvise, data_file, monkeypatch):
+    """Test falling back to a normal open, if O_NOATIME isn't allowed."""
+
+    path, contents = data_file
+    real_open = readers.os.open
+
+    def fake_open(filename, flags, *args):
+        """os.open() that refuses O_NOATIME, like for non-owners."""
+        if flags & readers.os.O_NOATIME:
+            raise OSError(errno.EPERM, "Operation not permitted", filename)
+        return real_open(filename, flags, *args)
+
+    monkeypatch.setattr(readers.os, "O_NOATIME", 0o1000000, raising=False)
+    monkeypatch.setattr(readers.os, "open", fake_open)
+
+    digest = finddups.calculate_digest(path, SIZE, "md5", 0, CACHE_FRIENDLY)
+
+    assert digest == hashlib.md5(contents).digest()
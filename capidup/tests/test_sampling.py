@@ -0,0 +1,131 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Sampling stage testing."""
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.tests.conftest import (sorted_groups, check_same_results,
+                                    age_files)
+
+
+BLOCK = finddups.SAMPLE_BLOCK_SIZE
+
+
+def setup_files(tmpdir):
+    """Create large files with a common header, differing further on.
+
+    Returns the expected groups of duplicates.
+
+    """
+    size = 64 * BLOCK
+    header = b"h" * (size // 2)
+    contents = {
+        "same1": header + b"x" * (size // 2),
+        "same2": header + b"x" * (size // 2),
+        "tail": header + b"x" * (size // 2 - 1) + b"y",
+        # the middle sample straddles the end of the header
+        "middle": header + b"y" + b"x" * (size // 2 - 1),
+        # differs between samples; only the full stage can tell
+        "between": header + b"x" * BLOCK + b"y"
+                   + b"x" * (size // 2 - BLOCK - 1),
+    }
+    for name, content in contents.items():
+        tmpdir.join(name).write_binary(content)
+
+    return [sorted(str(tmpdir.join(n)) for n in ("same1", "same2"))]
+
+
+@pytest.mark.parametrize("size,blocks,done,expected", [
+    (100 * BLOCK, 2, 0, [(0, BLOCK), (99 * BLOCK, BLOCK)]),
+    (101 * BLOCK, 3, 0, [(0, BLOCK), (50 * BLOCK, BLOCK),
+                         (100 * BLOCK, BLOCK)]),
+    # head already compared by the partial stage
+    (101 * BLOCK, 3, BLOCK, [(50 * BLOCK, BLOCK), (100 * BLOCK, BLOCK)]),
+    # unaligned tail
+    (10 * BLOCK + 1, 2, 0, [(0, BLOCK), (9 * BLOCK + 1, BLOCK)]),
+    # overlapping blocks are dropped
+    (3 * BLOCK, 8, 0, [(0, BLOCK), (finddups.PARTIAL_MD5_READ_MULT * 4,
+                                    BLOCK), (2 * BLOCK, BLOCK)]),
+])
+def test_sample_regions(size, blocks, done, expected):
+    """Test the placement of sample blocks."""
+
+    assert finddups.sample_regions(size, blocks, done) == expected
+
+
+def test_same_results(dup_tree):
+    """Test that sampling finds the same duplicates."""
+
+    check_same_results(*dup_tree, sample_blocks=3)
+
+
+def test_fewer_full_reads(tmpdir, monkeypatch):
+    """Test that files differing at a sample are not read in full."""
+
+    expected = setup_files(tmpdir)
+    size = 64 * BLOCK
+
+    full_reads = []
+    real_calculate_digest = finddups.calculate_digest
+
+    def recording_digest(filename, length, algorithm, *args):
+        """calculate_digest() that records files hashed in full."""
+        if length == size:
+            full_reads.append(filename.rpartition("/")[2])
+        return real_calculate_digest(filename, length, algorithm, *args)
+
+    monkeypatch.setattr(finddups, "calculate_digest", recording_digest)
+
+    dups, errors = finddups.find_duplicates_in_dirs([str(tmpdir)],
+                                                    sample_blocks=3)
+    assert not errors
+    assert sorted_groups(dups) == expected
+
+    assert sorted(full_reads) == ["between", "same1", "same2"]
+
+
+def test_cache(tmpdir):
+    """Test that sample digests are cached, one entry per block."""
+
+    from capidup.digestcache import DigestCache
+
+    expected = setup_files(tmpdir)
+    age_files(str(tmpdir))
+
+    with DigestCache(":memory:") as cache:
+        for _ in range(2):
+            dups, errors = finddups.find_duplicates_in_dirs(
+                [str(tmpdir)], sample_blocks=3, digest_cache=cache)
+            assert not errors
+            assert sorted_groups(dups) == expected
+
+        assert cache.hits == cache.misses
+
+
+@pytest.mark.parametrize("blocks", [-1, 1])
+def test_invalid(blocks):
+    """Test that invalid numbers of sample blocks are rejected."""
+
+    with pytest.raises(ValueError):
+        finddups.find_duplicates_in_dirs(["/nonexistent"],
+                                         sample_blocks=blocks)
@@ -0,0 +1,284 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Scan statistics testing."""
+
+import os
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.digestcache import DigestCache
+from capidup.scanstats import ScanStats, StageStats
+from capidup.tests.conftest import age_files
+
+
+def setup_tree(tmpdir):
+    """Create a tree with duplicates, unique files and excluded entries.
+
+    The large files go through both the partial and the full stages.
+
+    """
+    big = finddups.PARTIAL_MD5_THRESHOLD * 4
+    for name, content in [("a1", "a" * big), ("a2", "a" * big),
+                          ("b", "b" * (big - 1) + "a"),
+                          ("s1", "xyz"), ("s2", "xyz"),
+                          ("unique", "unique"),
+                          ("skip.tmp", "xyz")]:
+        tmpdir.join(name).write(content)
+
+    tmpdir.mkdir("sub").join("s3").write("xyz")
+    tmpdir.mkdir("ignored").join("a3").write("a" * big)
+
+    return big
+
+
+def scan(tmpdir, **kwargs):
+    """Scan tmpdir with a new ScanStats, returning the stats."""
+
+    stats = ScanStats()
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(tmpdir)], exclude_dirs=["ignored"], exclude_files=["*.tmp"],
+        stats=stats, **kwargs)
+    assert not errors
+    assert len(dups) == 2
+
+    return stats
+
+
+def test_crawl_counts(tmpdir):
+    """Test counting directories, files and pruned entries."""
+
+    setup_tree(tmpdir)
+    tmpdir.join("empty").write("")
+
+    stats = scan(tmpdir, min_size=1)
+
+    assert stats.directories == 2
+    assert stats.files == 7
+    assert stats.excluded_dirs == 1
+    assert stats.excluded_files == 1
+    assert stats.filtered_files == 1
+    assert stats.crawl_seconds >= 0
+    assert stats.seconds >= stats.crawl_seconds
+
+
+def test_buckets(tmpdir):
+    """Test counting size buckets and singletons."""
+
+    setup_tree(tmpdir)
+
+    stats = scan(tmpdir)
+
+    # sizes: big (3 files), 3 (3 files), 6 (1 file)
+    assert stats.size_buckets == 3
+    assert stats.singleton_buckets == 1
+
+
+def test_stages(tmpdir):
+    """Test the per-stage counters."""
+
+    big = setup_tree(tmpdir)
+
+    stats = scan(tmpdir)
+
+    partial = stats.stages["partial"]
+    full = stats.stages["full"]
+
+    # small files skip the partial stage; "b" differs from the start
+    assert partial.files_in == 3
+    assert partial.files_out == 2
+    assert 0 < partial.bytes_read < 3 * big
+    assert partial.bytes_planned == partial.bytes_read
+    assert partial.elimination_ratio == pytest.approx(1.0 / 3)
+
+    assert full.files_in == 5
+    assert full.files_out == 5
+    assert full.bytes_read == 2 * big + 3 * 3
+    assert full.bytes_planned == full.bytes_read
+    assert full.elimination_ratio == 0.0
+
+    assert stats.stages["sample"].files_in == 0
+    assert stats.stages["sample"].elimination_ratio is None
+
+
+def test_bytes_read_from_cache(tmpdir):
+    """Test that digests from the cache count as planned, but not read."""
+
+    setup_tree(tmpdir)
+    age_files(str(tmpdir))
+
+    with DigestCache(":memory:") as cache:
+        first = scan(tmpdir, digest_cache=cache)
+        second = scan(tmpdir, digest_cache=cache)
+
+    for name in ("partial", "full"):
+        assert second.stages[name].bytes_read == 0
+        assert (second.stages[name].bytes_planned ==
+                first.stages[name].bytes_planned ==
+                first.stages[name].bytes_read)
+
+
+def test_bytes_read_lockstep(tmpdir):
+    """Test that lockstep comparisons count the bytes actually read."""
+
+    big = setup_tree(tmpdir)
+
+    # same heads, so they get to the full stage; they differ in the third
+    # chunk of four
+    chunk = finddups.MD5_CHUNK_SIZE
+    tmpdir.join("c1").write("x" * (2 * chunk) + "c" * (2 * chunk))
+    tmpdir.join("c2").write("x" * (2 * chunk) + "d" * (2 * chunk))
+
+    stats = scan(tmpdir, lockstep=True)
+
+    full = stats.stages["full"]
+    assert full.bytes_planned == 2 * big + 3 * 3 + 2 * 4 * chunk
+    assert full.bytes_read == 2 * big + 3 * 3 + 2 * 3 * chunk
+
+
+def test_duplicates(tmpdir):
+    """Test counting duplicates and reclaimable bytes."""
+
+    big = setup_tree(tmpdir)
+
+    stats = scan(tmpdir)
+
+    assert stats.duplicate_groups == 2
+    assert stats.duplicate_files == 5
+    assert stats.reclaimable_bytes == big + 2 * 3
+
+
+@pytest.mark.skipif(not hasattr(os, "link"), reason="needs hard links")
+def test_hard_links_reclaim_once(tmpdir):
+    """Test that hard links to the same file are not counted as savings."""
+
+    content = "x" * 100
+    tmpdir.join("a").write(content)
+    tmpdir.join("b").write(content)
+    os.link(str(tmpdir.join("a")), str(tmpdir.join("a_link")))
+
+    stats = ScanStats()
+    dups, errors = finddups.find_duplicates_in_dirs([str(tmpdir)],
+                                                    stats=stats)
+    assert not errors
+    assert len(dups) == 1
+    assert stats.duplicate_files == len(dups[0])
+    assert stats.reclaimable_bytes == 100
+
+
+def test_iter_and_processes(tmpdir):
+    """Test that every scanning mode gives the same counters."""
+
+    setup_tree(tmpdir)
+
+    expected = scan(tmpdir).as_dict()
+
+    stats = ScanStats()
+    groups = list(finddups.iter_duplicates_in_dirs(
+        [str(tmpdir)], exclude_dirs=["ignored"], exclude_files=["*.tmp"],
+        stats=stats))
+    assert len(groups) == 2
+
+    for other in (stats, scan(tmpdir, processes=2),
+                  scan(tmpdir, memory_limit=1)):
+        values = other.as_dict()
+        for name, value in expected.items():
+            if not name.endswith("seconds"):
+                assert values[name] == value, name
+
+
+def test_as_dict_and_merge():
+    """Test flattening and merging statistics."""
+
+    stats = ScanStats()
+    stats.add_dir(3, (1, 0, 2))
+    stats.add_bucket(1)
+    stats.add_bucket(2)
+    stats.add_stage("full", 2, 2, 20, 0.5, 30)
+    stats.add_duplicates(10, 2, 2)
+
+    other = ScanStats()
+    other.merge(stats)
+    other.merge(stats)
+
+    values = other.as_dict()
+    assert values["directories"] == 2
+    assert values["files"] == 6
+    assert values["excluded_dirs"] == 2
+    assert values["filtered_files"] == 4
+    assert values["size_buckets"] == 4
+    assert values["singleton_buckets"] == 2
+    assert values["full_files_in"] == 4
+    assert values["full_bytes_read"] == 40
+    assert values["full_bytes_planned"] == 60
+    assert values["full_seconds"] == 1.0
+    assert values["full_elimination_ratio"] == 0.0
+    assert values["partial_elimination_ratio"] is None
+    assert values["reclaimable_bytes"] == 20
+
+
+def test_stage_elimination_ratio():
+    """Test the elimination ratio of a stage."""
+
+    stage = StageStats()
+    assert stage.elimination_ratio is None
+
+    stage.files_in = 4
+    stage.files_out = 1
+    assert stage.elimination_ratio == 0.75
+
+
+def test_overlapping_stage_runs():
+    """Test that runs of a stage overlapping in time count once."""
+
+    stage = StageStats()
+    stage.add_seconds(2.0, 10.0)
+    stage.add_seconds(2.0, 20.0)
+    assert stage.seconds == 4.0
+
+    # overlaps both, and fills the gap between them
+    stage.add_seconds(9.0, 11.0)
+    assert stage.seconds == 12.0
+
+    # inside what is already counted
+    stage.add_seconds(1.0, 15.0)
+    assert stage.seconds == 12.0
+
+    stage.add_seconds(0.5)
+    assert stage.seconds == 12.5
+
+    other = StageStats()
+    other.add_seconds(4.0, 20.0)
+    other.add_seconds(1.0, 0.0)
+    stage.merge(other)
+    assert stage.seconds == 15.5
+
+
+def test_process_stage_seconds(tmpdir):
+    """Test that stages in worker processes count their wall time."""
+
+    setup_tree(tmpdir)
+
+    stats = scan(tmpdir, processes=3)
+
+    for stage in stats.stages.values():
+        assert stage.seconds <= stats.seconds
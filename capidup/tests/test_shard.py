@@ -0,0 +1,174 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Sharded scan testing."""
+
+import io
+import multiprocessing
+
+import pytest
+
+import capidup.finddups as finddups
+import capidup.shard as shard
+
+
+def setup_shards(tmpdir):
+    """Create three shard directories, with duplicates within and across.
+
+    Returns the list of shard directories.
+
+    """
+    files = {
+        "s1": [("a1", "aaa"), ("b1", "bbbb"), ("u1", "x" * 10)],
+        "s2": [("a2", "aaa"), ("c1", "ccccc"), ("c2", "ccccc")],
+        "s3": [("b2", "bbbb"), ("d1", "ddd"), ("u2", "y" * 11)],
+    }
+
+    dirs = []
+    for name in sorted(files):
+        d = tmpdir.mkdir(name)
+        for filename, content in files[name]:
+            d.join(filename).write(content)
+        dirs.append(d)
+
+    return dirs
+
+
+def index_shard(directory, index_path):
+    """Index one shard, writing its size index. Runs in a child process."""
+
+    files_by_size = {}
+    finddups.index_files_by_size(directory, files_by_size, [], [], False)
+
+    with io.open(index_path, "w") as f:
+        shard.dump_size_index(files_by_size, f, directory)
+
+
+def hash_shard(index_path, candidate_sizes, digests_path):
+    """Hash the candidates of one shard. Runs in a child process."""
+
+    with io.open(index_path) as f:
+        name, files_by_size = shard.load_size_index(f)
+
+    records = shard.hash_candidates(files_by_size, candidate_sizes)
+
+    with io.open(digests_path, "w") as f:
+        shard.dump_digests(records, f, name)
+
+
+def run_processes(target, args_list):
+    """Run a function in a child process for each set of arguments."""
+
+    processes = [multiprocessing.Process(target=target, args=args)
+                 for args in args_list]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+
+
+def test_sharded_scan(tmpdir):
+    """Test a scan across shards, with a process standing in for each."""
+
+    dirs = setup_shards(tmpdir)
+    index_paths = [str(tmpdir.join("index%d" % i)) for i in range(len(dirs))]
+    digests_paths = [str(tmpdir.join("digests%d" % i))
+                     for i in range(len(dirs))]
+
+    run_processes(index_shard, [(str(d), path)
+                                for d, path in zip(dirs, index_paths)])
+
+    index_files = [io.open(path) for path in index_paths]
+    try:
+        candidate_sizes = shard.merge_size_indexes(index_files)
+    finally:
+        for f in index_files:
+            f.close()
+
+    # 10 and 11 are unique sizes, and never hashed
+    assert candidate_sizes == [3, 4, 5]
+
+    run_processes(hash_shard, [(index_path, candidate_sizes, digests_path)
+                               for index_path, digests_path
+                               in zip(index_paths, digests_paths)])
+
+    digest_files = [io.open(path) for path in digests_paths]
+    try:
+        groups = shard.group_digests(digest_files)
+    finally:
+        for f in digest_files:
+            f.close()
+
+    def entry(name, filename):
+        """Get the expected (shard, filename) tuple of a file."""
+        return (str(tmpdir.join(name)), str(tmpdir.join(name, filename)))
+
+    expected = [
+        [entry("s1", "a1"), entry("s2", "a2")],
+        [entry("s1", "b1"), entry("s3", "b2")],
+        [entry("s2", "c1"), entry("s2", "c2")],
+    ]
+    assert sorted(sorted(g) for g in groups) == expected
+
+
+def test_size_index_roundtrip():
+    """Test writing and reading back a size index."""
+
+    files_by_size = {3: ["/a", "/b"], 7: ["/c"]}
+    f = io.StringIO()
+    shard.dump_size_index(files_by_size, f, "host1")
+
+    f.seek(0)
+    assert shard.load_size_index(f) == ("host1", files_by_size)
+
+
+def test_bad_files():
+    """Test that files of the wrong format or from the same shard fail."""
+
+    f = io.StringIO()
+    shard.dump_digests([], f, "host1")
+    f.seek(0)
+    with pytest.raises(ValueError):
+        shard.load_size_index(f)
+
+    indexes = []
+    for _ in range(2):
+        f = io.StringIO()
+        shard.dump_size_index({}, f, "host1")
+        f.seek(0)
+        indexes.append(f)
+    with pytest.raises(ValueError):
+        shard.merge_size_indexes(indexes)
+
+
+def test_different_algorithms():
+    """Test that digests of different algorithms are not grouped."""
+
+    files = []
+    for algorithm in ("md5", "sha1"):
+        f = io.StringIO()
+        shard.dump_digests([(3, b"\x01", "/a")], f, algorithm, algorithm)
+        f.seek(0)
+        files.append(f)
+
+    with pytest.raises(ValueError):
+        shard.group_digests(files)
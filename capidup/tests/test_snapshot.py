@@ -0,0 +1,250 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Directory snapshot and incremental rescan testing."""
+
+import os
+import sys
+import time
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.snapshot import DirSnapshot, dir_stamp
+
+
+def age_dirs(root):
+    """Set the modification time of all directories under root to the past.
+
+    Directories modified too recently are not stored in a snapshot.
+
+    """
+    old = time.time() - 3600
+    for dirpath, _, _ in os.walk(root):
+        os.utime(dirpath, (old, old))
+
+
+def setup_tree(tmpdir):
+    """Create a tree with duplicates in several subdirectories."""
+
+    tmpdir.join("a1").write("aaa")
+    tmpdir.mkdir("sub1").join("a2").write("aaa")
+    sub2 = tmpdir.mkdir("sub2")
+    sub2.join("b1").write("bbbb")
+    sub2.mkdir("deep").join("b2").write("bbbb")
+    tmpdir.join("c").write("ccccc")
+
+    age_dirs(str(tmpdir))
+
+
+def scan(tmpdir, snapshot):
+    """Scan tmpdir for duplicates, returning the sorted groups."""
+
+    dups, errors = finddups.find_duplicates_in_dirs(
+        [str(tmpdir.join("tree"))], snapshot=snapshot)
+    assert not errors
+
+    return sorted(sorted(os.path.relpath(f, str(tmpdir.join("tree")))
+                         for f in g) for g in dups)
+
+
+def test_get_put(tmpdir):
+    """Test storing and retrieving a listing."""
+
+    stamp = dir_stamp(os.stat(str(tmpdir)))
+    old_stamp = stamp[:2] + (0, 0, "")
+    subdirs = [("sub", (1, 2))]
+    files = [("f", 3, 4, None), ("g", 5, 6, (7, 8))]
+
+    with DirSnapshot(":memory:") as snapshot:
+        assert snapshot.get("/dir", old_stamp) is None
+        snapshot.put("/dir", old_stamp, subdirs, files)
+
+        assert snapshot.get("/dir", old_stamp) == (subdirs, files, (0, 0, 0))
+        assert snapshot.get("/dir", stamp) is None
+
+        assert snapshot.hits == 1
+        assert snapshot.misses == 2
+
+
+def test_racy_dir_not_stored(tmpdir):
+    """Test that directories modified very recently are not stored."""
+
+    tmpdir.join("f").write("foo")
+    stamp = dir_stamp(os.stat(str(tmpdir)))
+
+    with DirSnapshot(":memory:") as snapshot:
+        snapshot.put(str(tmpdir), stamp, [], [("f", 3, 1, None)])
+        assert len(snapshot) == 0
+
+
+def test_settings_change(tmpdir):
+    """Test that changing the crawl settings discards the listings."""
+
+    stamp = (1, 2, 0, 0, "")
+    path = str(tmpdir.join("snapshot.db"))
+
+    with DirSnapshot(path) as snapshot:
+        snapshot.use_settings([["tmp"], [], False])
+        snapshot.put("/dir", stamp, [], [])
+
+    with DirSnapshot(path) as snapshot:
+        snapshot.use_settings([["tmp"], [], False])
+        assert len(snapshot) == 1
+
+        snapshot.use_settings([["tmp"], [], True])
+        assert len(snapshot) == 0
+
+
+def test_evict_unused(tmpdir):
+    """Test evicting listings that weren't used in the current session."""
+
+    path = str(tmpdir.join("snapshot.db"))
+
+    with DirSnapshot(path) as snapshot:
+        snapshot.put("/dir1", (1, 2, 0, 0, ""), [], [])
+        snapshot.put("/dir2", (1, 3, 0, 0, ""), [], [])
+
+    with DirSnapshot(path) as snapshot:
+        assert snapshot.get("/dir1", (1, 2, 0, 0, "")) is not None
+
+        assert snapshot.evict_unused() == 1
+        assert len(snapshot) == 1
+
+
+def test_unchanged_rescan(tmpdir):
+    """Test that a rescan of an unchanged tree lists no directories."""
+
+    setup_tree(tmpdir.mkdir("tree"))
+    path = str(tmpdir.join("snapshot.db"))
+    expected = [["a1", "sub1/a2"], ["sub2/b1", "sub2/deep/b2"]]
+
+    with DirSnapshot(path) as snapshot:
+        assert scan(tmpdir, snapshot) == expected
+        assert snapshot.hits == 0
+        assert len(snapshot) == 4
+
+    with DirSnapshot(path) as snapshot:
+        assert scan(tmpdir, snapshot) == expected
+        assert snapshot.hits == 4
+        assert snapshot.misses == 0
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="needs os.fsencode")
+def test_undecodable_dir_name(tmpdir):
+    """Test storing a directory whose name isn't valid UTF-8."""
+
+    root = tmpdir.mkdir("tree")
+    setup_tree(root)
+
+    bad_dir = os.path.join(os.fsencode(str(root)), b"bad\xff")
+    try:
+        os.mkdir(bad_dir)
+    except OSError:
+        pytest.skip("filesystem doesn't allow undecodable names")
+    with open(os.path.join(bad_dir, b"c2"), "w") as f:
+        f.write("ccccc")
+    age_dirs(str(root))
+
+    path = str(tmpdir.join("snapshot.db"))
+    bad_name = os.fsdecode(b"bad\xff")
+    expected = [["a1", "sub1/a2"], [bad_name + "/c2", "c"],
+                ["sub2/b1", "sub2/deep/b2"]]
+
+    with DirSnapshot(path) as snapshot:
+        assert scan(tmpdir, snapshot) == expected
+        assert len(snapshot) == 5
+
+    with DirSnapshot(path) as snapshot:
+        assert scan(tmpdir, snapshot) == expected
+        assert snapshot.hits == 5
+        assert snapshot.misses == 0
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="needs os.fsencode")
+def test_bytes_root(tmpdir):
+    """Test rescanning a bytes root, with an undecodable file name."""
+
+    root = tmpdir.mkdir("tree")
+    setup_tree(root)
+    broot = os.fsencode(str(root))
+
+    try:
+        with open(os.path.join(broot, b"sub1", b"bad\xff"), "w") as f:
+            f.write("aaa")
+    except (OSError, IOError):
+        pytest.skip("filesystem doesn't allow undecodable names")
+    age_dirs(str(root))
+
+    expected = [[b"a1", b"sub1/a2", b"sub1/bad\xff"],
+                [b"sub2/b1", b"sub2/deep/b2"]]
+
+    with DirSnapshot(":memory:") as snapshot:
+        for hits in (0, 4):
+            dups, errors = finddups.find_duplicates_in_dirs(
+                [broot], snapshot=snapshot)
+            assert not errors
+            assert sorted(sorted(os.path.relpath(f, broot) for f in g)
+                          for g in dups) == expected
+            assert snapshot.hits == hits
+
+
+def test_changed_dir(tmpdir):
+    """Test that a changed directory is listed again."""
+
+    setup_tree(tmpdir.mkdir("tree"))
+
+    with DirSnapshot(":memory:") as snapshot:
+        scan(tmpdir, snapshot)
+
+        tmpdir.join("tree", "sub2", "deep", "c2").write("ccccc")
+        os.remove(str(tmpdir.join("tree", "sub1", "a2")))
+
+        assert scan(tmpdir, snapshot) == [["c", "sub2/deep/c2"],
+                                          ["sub2/b1", "sub2/deep/b2"]]
+
+
+def test_file_modified_in_place(tmpdir):
+    """Test that files changed in unchanged directories are regrouped."""
+
+    setup_tree(tmpdir.mkdir("tree"))
+
+    with DirSnapshot(":memory:") as snapshot:
+        scan(tmpdir, snapshot)
+
+        # neither changes the time of the directory; both files now have
+        # the same contents, and were in different size groups before
+        with open(str(tmpdir.join("tree", "sub1", "a2")), "a") as f:
+            f.write("a")
+        with open(str(tmpdir.join("tree", "sub2", "b1")), "w") as f:
+            f.write("aaaa")
+
+        assert scan(tmpdir, snapshot) == [["sub1/a2", "sub2/b1"]]
+        assert snapshot.misses == 4
+
+
+def test_file_filter(tmpdir):
+    """Test that a snapshot can't be combined with a file filter."""
+
+    with DirSnapshot(":memory:") as snapshot:
+        with pytest.raises(ValueError):
+            finddups.find_duplicates_in_dirs([str(tmpdir)], snapshot=snapshot,
+                                             file_filter=lambda p, s: True)
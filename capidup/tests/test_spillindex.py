@@ -0,0 +1,150 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Spilling file index testing."""
+
+import os
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup import spillindex
+from capidup.spillindex import SpillingFileIndex
+from capidup.tests.conftest import check_same_results
+
+
+def test_spill_and_merge(tmpdir):
+    """Test that spilled runs are merged back by size, in order added."""
+
+    spill_dir = tmpdir.mkdir("spill")
+
+    with SpillingFileIndex(1, str(spill_dir)) as index:
+        for i in range(20):
+            index.add_file(i % 5, "/d", "f%02d" % i)
+
+        # every record goes over the limit
+        assert index.num_runs() == 20
+        assert len(spill_dir.listdir()) == 1
+
+        items = list(index.items())
+
+        assert not index
+        with pytest.raises(KeyError):
+            index.popitem()
+        with pytest.raises(ValueError):
+            index.add_file(1, "/d", "late")
+
+    assert [size for size, _ in items] == [0, 1, 2, 3, 4]
+    assert items[1][1] == [os.path.join("/d", "f%02d" % i)
+                           for i in (1, 6, 11, 16)]
+
+    # the run files are removed on close
+    assert not spill_dir.listdir()
+
+
+def test_multi_pass_merge(tmpdir, monkeypatch):
+    """Test merging more runs than can be open at once."""
+
+    monkeypatch.setattr(spillindex, "MAX_MERGE_RUNS", 4)
+
+    spill_dir = tmpdir.mkdir("spill")
+
+    with SpillingFileIndex(1, str(spill_dir)) as index:
+        for i in range(50):
+            index.add_file(i % 7, "/d", "f%02d" % i)
+
+        assert index.num_runs() == 50
+
+        items = list(index.items())
+        assert index.num_runs() <= 4
+
+    assert [size for size, _ in items] == list(range(7))
+    assert items[3][1] == [os.path.join("/d", "f%02d" % i)
+                           for i in range(3, 50, 7)]
+
+
+def test_open_files_limit(tmpdir):
+    """Test merging many runs with a low limit of open files."""
+
+    resource = pytest.importorskip("resource")
+    if not os.path.isdir("/proc/self/fd"):
+        pytest.skip("can't count the open files")
+
+    num_runs = 3 * spillindex.MAX_MERGE_RUNS
+
+    with SpillingFileIndex(1, str(tmpdir)) as index:
+        for i in range(num_runs):
+            index.add_file(i % 10, "/d", "f%03d" % i)
+        assert index.num_runs() == num_runs
+
+        # room for MAX_MERGE_RUNS runs, the new merged run and a few more,
+        # but not for all the runs at once
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        limit = (len(os.listdir("/proc/self/fd"))
+                 + spillindex.MAX_MERGE_RUNS + 8)
+        assert limit < num_runs
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        try:
+            items = list(index.items())
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    assert [size for size, _ in items] == list(range(10))
+    assert sum(len(paths) for _, paths in items) == num_runs
+
+
+def test_no_spill():
+    """Test an index that fits in memory."""
+
+    with SpillingFileIndex(1024 * 1024) as index:
+        assert not index
+
+        index.add_file(2, "/d", "b")
+        index.add_file(1, "/d", u"caf\xe9")
+        assert index
+        assert index.num_runs() == 0
+
+        assert index.popitem() == (1, [os.path.join("/d", u"caf\xe9")])
+        assert index.popitem() == (2, [os.path.join("/d", "b")])
+        assert not index
+
+
+def test_invalid_limit():
+    """Test that the memory limit must be positive."""
+
+    with pytest.raises(ValueError):
+        SpillingFileIndex(0)
+
+    with pytest.raises(ValueError):
+        finddups.find_duplicates_in_dirs(["/nonexistent"], memory_limit=1,
+                                         compact_index=True)
+
+
+@pytest.mark.parametrize("memory_limit", [1, 1000])
+def test_same_results(dup_tree, tmpdir, memory_limit):
+    """Test that spilling the index gives the same duplicates."""
+
+    spill_dir = tmpdir.mkdir("spill")
+
+    check_same_results(*dup_tree, memory_limit=memory_limit,
+                       spill_dir=str(spill_dir))
+
+    assert not spill_dir.listdir()
@@ -0,0 +1,106 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Generator API testing."""
+
+import os
+
+import capidup.finddups as finddups
+from capidup.tests.conftest import check_same_results
+
+
+def setup_groups(tmpdir, count):
+    """Create count groups of duplicates, each group of a different size."""
+
+    for i in range(count):
+        for j in range(2):
+            tmpdir.join("g%d_%d" % (i, j)).write("a" * (i + 1))
+
+
+def test_same_results(dup_tree):
+    """Test that the generator finds the same duplicates."""
+
+    check_same_results(*dup_tree)
+
+
+def test_lazy(tmpdir, monkeypatch):
+    """Test that groups are yielded before all files have been hashed."""
+
+    setup_groups(tmpdir, 10)
+
+    hashed = []
+    real_calculate_digest = finddups.calculate_digest
+
+    def counting_digest(filename, length, algorithm, *args):
+        """calculate_digest() that keeps track of the hashed files."""
+        hashed.append(filename)
+        return real_calculate_digest(filename, length, algorithm, *args)
+
+    monkeypatch.setattr(finddups, "calculate_digest", counting_digest)
+    # resolve size groups one at a time
+    monkeypatch.setattr(finddups, "MAX_PENDING_JOBS", 1)
+
+    dups = finddups.iter_duplicates_in_dirs([str(tmpdir)])
+
+    first = next(dups)
+    assert len(first) == 2
+    assert len(hashed) == 2
+
+    rest = list(dups)
+    assert len(rest) == 9
+    assert len(hashed) == 20
+
+
+def test_errors_in_place(tmpdir):
+    """Test that errors are appended to the list passed by the caller."""
+
+    setup_groups(tmpdir, 1)
+    noread = tmpdir.mkdir("noread")
+    os.chmod(str(noread), 0)
+
+    errors = []
+    try:
+        dups = list(finddups.iter_duplicates_in_dirs([str(tmpdir)],
+                                                     errors=errors))
+    finally:
+        os.chmod(str(noread), 0o700)
+
+    assert len(dups) == 1
+    assert len(errors) == 1
+    assert "noread" in errors[0]
+
+
+def test_iter_duplicates(tmpdir):
+    """Test the generator version of find_duplicates."""
+
+    names = []
+    for content in ["a", "a", "b", "c", "c"]:
+        f = tmpdir.join("f%d" % len(names))
+        f.write(content)
+        names.append(str(f))
+    names.append(str(tmpdir.join("missing")))
+
+    errors = []
+    dups = list(finddups.iter_duplicates(names, 1, errors=errors))
+
+    assert dups == [names[0:2], names[3:5]]
+    assert len(errors) == 1
+    assert (dups, errors) == finddups.find_duplicates(names, 1)
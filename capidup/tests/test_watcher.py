@@ -0,0 +1,241 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Live duplicate watcher testing."""
+
+import os
+import sys
+import time
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.watcher import DuplicateWatcher
+
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"),
+                                reason="inotify is only available on Linux")
+
+
+def settle(watcher):
+    """Process events until there are no more."""
+
+    while watcher.process_events(0.2):
+        pass
+
+
+def groups(watcher, root):
+    """Get the current duplicate groups, as sorted relative paths."""
+
+    return sorted(sorted(os.path.relpath(f, str(root)) for f in g)
+                  for g in watcher.duplicates())
+
+
+def test_initial_scan(tmpdir):
+    """Test that existing duplicates are found on creation."""
+
+    tmpdir.join("a1").write("aaa")
+    tmpdir.mkdir("sub").join("a2").write("aaa")
+    tmpdir.join("b").write("bbb")
+
+    with DuplicateWatcher([str(tmpdir)]) as watcher:
+        assert groups(watcher, tmpdir) == [["a1", "sub/a2"]]
+        assert not watcher.errors
+
+
+def test_file_changes(tmpdir):
+    """Test creating, modifying, renaming and deleting files."""
+
+    tmpdir.join("a1").write("aaa")
+
+    with DuplicateWatcher([str(tmpdir)]) as watcher:
+        assert groups(watcher, tmpdir) == []
+
+        tmpdir.join("a2").write("aaa")
+        settle(watcher)
+        assert groups(watcher, tmpdir) == [["a1", "a2"]]
+
+        # same size, different contents
+        tmpdir.join("a2").write("aab")
+        settle(watcher)
+        assert groups(watcher, tmpdir) == []
+
+        tmpdir.join("a2").write("aaa")
+        tmpdir.join("a2").rename(tmpdir.join("a3"))
+        settle(watcher)
+        assert groups(watcher, tmpdir) == [["a1", "a3"]]
+
+        tmpdir.join("a1").remove()
+        settle(watcher)
+        assert groups(watcher, tmpdir) == []
+
+
+def test_dir_changes(tmpdir):
+    """Test creating, renaming and deleting directories."""
+
+    tmpdir.join("a1").write("aaa")
+
+    with DuplicateWatcher([str(tmpdir)], exclude_dirs=["tmp"]) as watcher:
+        sub = tmpdir.mkdir("sub")
+        settle(watcher)
+        sub.join("a2").write("aaa")
+        settle(watcher)
+        assert groups(watcher, tmpdir) == [["a1", "sub/a2"]]
+
+        # a tree moved in from outside the watched directory
+        outside = tmpdir.dirpath().mkdir(tmpdir.basename + "-outside")
+        outside.mkdir("deep").join("a3").write("aaa")
+        outside.rename(sub.join("moved"))
+        settle(watcher)
+        assert groups(watcher, tmpdir) == [["a1", "sub/a2",
+                                            "sub/moved/deep/a3"]]
+
+        sub.rename(tmpdir.join("renamed"))
+        settle(watcher)
+        assert groups(watcher, tmpdir) == [["a1", "renamed/a2",
+                                            "renamed/moved/deep/a3"]]
+
+        tmpdir.join("renamed", "moved").remove()
+        settle(watcher)
+        assert groups(watcher, tmpdir) == [["a1", "renamed/a2"]]
+
+        tmpdir.mkdir("tmp").join("a4").write("aaa")
+        settle(watcher)
+        assert groups(watcher, tmpdir) == [["a1", "renamed/a2"]]
+
+
+def test_only_changes_read(tmpdir, monkeypatch):
+    """Test that only files written to are read again."""
+
+    reads = []
+    digest_or_error = finddups.digest_or_error
+
+    def counting_digest_or_error(filename, *args, **kwargs):
+        """digest_or_error() that records which files it read."""
+        reads.append(os.path.basename(filename))
+        return digest_or_error(filename, *args, **kwargs)
+
+    monkeypatch.setattr(finddups, "digest_or_error",
+                        counting_digest_or_error)
+
+    for name in ("a1", "a2", "b"):
+        tmpdir.join(name).write("aaa")
+
+    with DuplicateWatcher([str(tmpdir)]) as watcher:
+        assert groups(watcher, tmpdir) == [["a1", "a2", "b"]]
+        assert sorted(reads) == ["a1", "a2", "b"]
+        del reads[:]
+
+        tmpdir.join("b").write("bbb")
+        settle(watcher)
+        assert groups(watcher, tmpdir) == [["a1", "a2"]]
+        assert reads == ["b"]
+        del reads[:]
+
+        tmpdir.join("a2").rename(tmpdir.mkdir("sub").join("a3"))
+        settle(watcher)
+        assert groups(watcher, tmpdir) == [["a1", "sub/a3"]]
+        assert reads == []
+
+
+def test_root_removed(tmpdir):
+    """Test that a watched directory being deleted or moved is noticed."""
+
+    first = tmpdir.mkdir("first")
+    second = tmpdir.mkdir("second")
+    for d, content in [(first, "aaa"), (second, "bbb")]:
+        d.join("a1").write(content)
+        d.join("a2").write(content)
+
+    with DuplicateWatcher([str(first), str(second)]) as watcher:
+        assert len(watcher.duplicates()) == 2
+
+        second.move(tmpdir.join("moved"))
+        settle(watcher)
+        assert groups(watcher, first) == [["a1", "a2"]]
+
+        first.remove()
+        settle(watcher)
+        assert watcher.duplicates() == []
+        assert watcher.errors == [
+            "error watching '%s': directory was moved or deleted" % d
+            for d in (second, first)]
+
+
+def test_watch_ignored(tmpdir):
+    """Test that files of a directory no longer watched are forgotten."""
+
+    tmpdir.join("a1").write("aaa")
+    tmpdir.mkdir("sub").join("a2").write("aaa")
+
+    with DuplicateWatcher([str(tmpdir)]) as watcher:
+        assert groups(watcher, tmpdir) == [["a1", "sub/a2"]]
+
+        # like when its filesystem is unmounted
+        watcher._inotify.rm_watch(watcher._dir_wds[str(tmpdir.join("sub"))])
+        settle(watcher)
+        assert groups(watcher, tmpdir) == []
+
+
+def test_background_thread(tmpdir):
+    """Test that changes are picked up by the background thread."""
+
+    tmpdir.join("a1").write("aaa")
+
+    with DuplicateWatcher([str(tmpdir)]) as watcher:
+        watcher.start()
+        tmpdir.join("a2").write("aaa")
+
+        deadline = time.time() + 10
+        while not watcher.duplicates() and time.time() < deadline:
+            time.sleep(0.05)
+
+        assert groups(watcher, tmpdir) == [["a1", "a2"]]
+
+        watcher.stop()
+
+
+def test_thread_error(tmpdir, monkeypatch):
+    """Test that an error in the background thread is raised by stop()."""
+
+    with DuplicateWatcher([str(tmpdir)]) as watcher:
+        def failing_process_events(timeout=0):
+            """process_events() that fails, like on a bug."""
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(watcher, "process_events",
+                            failing_process_events)
+
+        watcher.start()
+
+        deadline = time.time() + 10
+        while watcher.is_running() and time.time() < deadline:
+            time.sleep(0.05)
+
+        assert not watcher.is_running()
+        assert isinstance(watcher.thread_error, RuntimeError)
+        assert watcher.errors == ["error in watcher thread: boom"]
+
+        with pytest.raises(RuntimeError):
+            watcher.stop()
+
+        # the error is only raised once
+        watcher.stop()
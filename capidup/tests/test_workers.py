@@ -0,0 +1,102 @@
+# capidup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of capidup.
+#
+# capidup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# capidup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with capidup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+"""Concurrent hashing testing."""
+
+import os
+
+import pytest
+
+import capidup.finddups as finddups
+from capidup.tests.conftest import check_same_results
+
+futures = pytest.importorskip("concurrent.futures")
+
+
+def setup_tree(tmpdir):
+    """Create a tree with many small groups of duplicates.
+
+    Returns the list of filenames, in creation order.
+
+    """
+    names = []
+    big = finddups.PARTIAL_MD5_THRESHOLD * 2
+    for i in range(20):
+        for j in range(3):
+            # same size for every group, differing at the end, so that
+            # files from all groups survive the partial stage together
+            f = tmpdir.join("f%02d_%d" % (i, j))
+            f.write("x" * (big - 2) + "%02d" % (i if j < 2 else 99 - i))
+            names.append(str(f))
+
+    return names
+
+
+@pytest.mark.parametrize("workers", [2, 8])
+def test_same_results(dup_tree, workers):
+    """Test that using workers doesn't change the results, or their order."""
+
+    check_same_results(*dup_tree, ordered=True, workers=workers)
+
+
+def test_many_groups(tmpdir):
+    """Test hashing the files of many size groups together, in order."""
+
+    setup_tree(tmpdir)
+
+    expected = finddups.find_duplicates_in_dirs([str(tmpdir)])
+    result = finddups.find_duplicates_in_dirs([str(tmpdir)], workers=8)
+
+    assert result == expected
+    assert len(result[0]) == 20
+
+
+def test_executor(tmpdir):
+    """Test find_duplicates with a caller-supplied executor."""
+
+    names = setup_tree(tmpdir)
+
+    expected = finddups.find_duplicates(names, os.path.getsize(names[0]))
+
+    with futures.ThreadPoolExecutor(max_workers=4) as executor:
+        result = finddups.find_duplicates(names, os.path.getsize(names[0]),
+                                          executor=executor)
+
+    assert result == expected
+
+
+def test_errors_in_order(tmpdir, monkeypatch):
+    """Test that errors are reported in the order of the files."""
+
+    names = setup_tree(tmpdir)
+
+    def failing_digest(filename, length, algorithm, *args):
+        """Fake calculate_digest() that always fails."""
+        raise IOError(13, "Permission denied", filename)
+
+    monkeypatch.setattr(finddups, "calculate_digest", failing_digest)
+
+    dups, errors = finddups.find_duplicates(names, 10, workers=4)
+
+    assert not dups
+    assert len(errors) == len(names)
+    for name, error in zip(names, errors):
+        assert name in error
@@ -0,0 +1,722 @@
+# CapiDup - quickly find duplicate files in directories
+# Copyright (C) 2010,2014,2016 Israel G. Lugo
+#
+# This file is part of CapiDup.
+#
+# CapiDup is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# CapiDup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with CapiDup. If not, see <http://www.gnu.org/licenses/>.
+#
+# For suggestions, feedback or bug reports: israel.lugo@lugosys.com
+
+
+
+"""Live index of duplicate files, kept up to date with inotify.
+
+Public classes:
+
+    DuplicateWatcher -- watch directories, keeping their duplicates known
+
+A DuplicateWatcher does one full scan of its directories, and then
+follows the changes to them through inotify: files being created,
+modified, renamed or deleted, and directories being created, renamed or
+deleted. Only the size groups touched by a change are compared again, so
+the current groups of duplicates can be asked for at any time, at no
+cost. The digests of each file are kept, keyed by its device, inode,
+size and modification time, so that only files that changed (not merely
+renamed) are read again.
+
+This is only available on Linux. inotify is used directly, through
+ctypes; no other packages are needed.
+
+Each watched directory takes up one inotify watch. The number of watches
+is limited per user by ``/proc/sys/fs/inotify/max_user_watches``, which
+may need to be raised for very large trees. Should the kernel's event
+queue overflow, every directory is scanned again. A watched directory
+that is itself moved or deleted is no longer followed; this is reported
+as an error.
+
+"""
+
+import collections
+import ctypes
+import errno
+import os
+import select
+import stat
+import struct
+import sys
+import threading
+
+from capidup import py3compat
+from capidup import finddups
+from capidup.matcher import compile_excludes
+from capidup.hashers import DEFAULT_PARTIAL_HASH, DEFAULT_FULL_HASH
+
+
+__all__ = [ "DuplicateWatcher" ]
+
+
+POLL_INTERVAL = 0.5
+"""Seconds between checks for stop requests, in the background thread."""
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+               | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+               | IN_ONLYDIR)
+
+# struct inotify_event, followed by len bytes of NUL-padded name
+_EVENT_FORMAT = "=iIII"
+_EVENT_SIZE = struct.calcsize(_EVENT_FORMAT)
+
+_READ_SIZE = 64 * 1024
+
+
+def _encode_path(path):
+    """Get a path as bytes, for passing to the C library."""
+
+    if isinstance(path, bytes):
+        return path
+
+    fsencode = getattr(os, "fsencode", None)
+    if fsencode is not None:
+        return fsencode(path)
+
+    return path.encode(sys.getfilesystemencoding())    # pragma: no cover
+
+
+def _decode_name(name, like):
+    """Decode a name from an event, to the same type as the path like."""
+
+    if isinstance(like, bytes):
+        return name
+
+    fsdecode = getattr(os, "fsdecode", None)
+    if fsdecode is not None:
+        return fsdecode(name)
+
+    return name.decode(sys.getfilesystemencoding())     # pragma: no cover
+
+
+def _file_key(file_info):
+    """Get the key of a file's digests, from its stat result.
+
+    Returns a tuple (st_dev, st_ino, size, mtime). Renaming a file keeps
+    its key; writing to it changes the modification time.
+
+    """
+    return (file_info.st_dev, file_info.st_ino, file_info.st_size,
+            getattr(file_info, "st_mtime_ns", file_info.st_mtime))
+
+
+def _os_error(filename=None):
+    """Make an OSError from the current errno, after a C library call."""
+
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err), filename)
+
+
+class Inotify(object):
+    """Minimal wrapper around a Linux inotify instance.
+
+    Raises OSError if inotify is not available.
+
+    """
+
+    def __init__(self):
+        try:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            init = self._libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            raise _os_error()
+
+    def add_watch(self, path, mask):
+        """Watch a path for the events in mask.
+
+        Returns the watch descriptor. Raises OSError on failure.
+
+        """
+        wd = self._libc.inotify_add_watch(self.fd, _encode_path(path),
+                                          ctypes.c_uint32(mask))
+        if wd < 0:
+            raise _os_error(path)
+
+        return wd
+
+    def rm_watch(self, wd):
+        """Stop watching a watch descriptor, ignoring any errors."""
+
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """Read the pending events, waiting up to timeout seconds for any.
+
+        Returns a (possibly empty) list of ``(wd, mask, cookie, name)``
+        tuples, where name is bytes.
+
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, _READ_SIZE)
+
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = struct.unpack_from(_EVENT_FORMAT,
+                                                          data, pos)
+            pos += _EVENT_SIZE
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+
+            events.append((wd, mask, cookie, name))
+
+        return events
+
+    def close(self):
+        """Close the inotify instance, removing all watches."""
+
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class DuplicateWatcher(object):
+    """Watch a list of directories, keeping their duplicate files known.
+
+    directories, exclude_dirs, exclude_files, follow_dirlinks,
+    digest_cache, partial_hash and full_hash are as in
+    capidup.finddups.find_duplicates_in_dirs(). Hard links are reported
+    like with its default ``hardlinks="include"``, but are read once per
+    inode.
+
+    The directories are scanned when the watcher is created. After that,
+    changes are only picked up when process_events() is called, or
+    continuously in a background thread between start() and stop().
+    duplicates() can be called at any time, from any thread, and returns
+    at once.
+
+    Error messages are printed to stderr and appended to the `errors`
+    attribute, as they occur. If the background thread dies of an
+    exception, it is kept in the `thread_error` attribute, and raised
+    again by stop().
+
+    A DuplicateWatcher may be used as a context manager, in which case it
+    is closed on exit.
+
+    Raises OSError if inotify is not available.
+
+    """
+
+    def __init__(self, directories, exclude_dirs=None, exclude_files=None,
+            follow_dirlinks=False, digest_cache=None,
+            partial_hash=DEFAULT_PARTIAL_HASH, full_hash=DEFAULT_FULL_HASH):
+        self.directories = list(directories)
+        self.errors = []
+        self.thread_error = None
+
+        self._exclude_dirs = compile_excludes(exclude_dirs)
+        self._exclude_files = compile_excludes(exclude_files)
+        self._follow_dirlinks = follow_dirlinks
+        self._digest_cache = digest_cache
+        self._partial_hash = partial_hash
+        self._full_hash = full_hash
+
+        # the duplicate groups of each size; only replaced while holding
+        # the lock, so duplicates() can be called from another thread
+        self._groups = {}
+        self._lock = threading.Lock()
+
+        self._thread = None
+        self._stopping = threading.Event()
+
+        self._inotify = Inotify()
+        self._reset()
+        try:
+            self._scan_all()
+        except:
+            self._inotify.close()
+            raise
+
+    def _reset(self):
+        """Forget all watched directories and indexed files."""
+
+        # path -> (directory, size), size -> paths, and directory -> paths
+        self._files = {}
+        self._files_by_size = {}
+        self._files_by_dir = {}
+        # watch descriptor -> directory, and back
+        self._wd_dirs = {}
+        self._dir_wds = {}
+        # directory -> (root, (st_dev, st_ino))
+        self._dir_info = {}
+        self._visited = set()
+        # size -> {file key -> [partial digest, full digest]}, for the
+        # files compared so far
+        self._digests = {}
+        # sizes whose groups must be compared again, and files written
+        # to since they were last compared
+        self._dirty_sizes = set()
+        self._modified = set()
+
+    def _error(self, msg):
+        """Print an error message to stderr, and record it."""
+
+        sys.stderr.write("%s\n" % msg)
+        self.errors.append(msg)
+
+    def _scan_all(self):
+        """Scan all directories from scratch."""
+
+        for wd in self._wd_dirs:
+            self._inotify.rm_watch(wd)
+
+        self._reset()
+        for directory in self.directories:
+            try:
+                if self._follow_dirlinks:
+                    file_info = os.stat(directory)
+                else:
+                    file_info = os.lstat(directory)
+            except OSError as e:
+                self._error("error listing '%s': %s"
+                            % (e.filename, e.strerror))
+                continue
+
+            self._add_tree(directory, directory,
+                           (file_info.st_dev, file_info.st_ino))
+
+        self._update_groups(replace=True)
+
+    def _add_tree(self, root, path, dev_inode):
+        """Watch and index a directory and everything under it.
+
+        root is the watched directory path is under, for matching path
+        patterns. dev_inode is the (st_dev, st_ino) of path.
+
+        """
+        to_scan = collections.deque([(path, dev_inode)])
+
+        while to_scan:
+            curr_dir, dev_inode = to_scan.popleft()
+
+            if dev_inode in self._visited:
+                self._error("error listing '%s': directory loop detected"
+                            % curr_dir)
+                continue
+
+            # watch before listing, so no changes are missed in between
+            try:
+                wd = self._inotify.add_watch(curr_dir, _WATCH_MASK)
+            except OSError as e:
+                self._error("error watching '%s': %s" % (curr_dir, e.strerror))
+                continue
+
+            self._wd_dirs[wd] = curr_dir
+            self._dir_wds[curr_dir] = wd
+            self._dir_info[curr_dir] = (root, dev_inode)
+            self._visited.add(dev_inode)
+
+            subdirs, files, errors, _ = finddups.scan_dir(
+                curr_dir, self._exclude_dirs, self._exclude_files,
+                self._follow_dirlinks, finddups.relative_dir(root, curr_dir))
+
+            for e in errors:
+                self._error("error listing '%s': %s" % (e.filename,
+                                                        e.strerror))
+
+            for name, sub_dev_inode in subdirs:
+                to_scan.append((os.path.join(curr_dir, name), sub_dev_inode))
+
+            for name, size, _, _ in files:
+                self._add_file(curr_dir, os.path.join(curr_dir, name), size)
+
+    def _remove_tree(self, path):
+        """Stop watching a directory, and forget everything under it."""
+
+        prefix = os.path.join(path, "")
+
+        for curr_dir in [d for d in self._dir_wds
+                         if d == path or d.startswith(prefix)]:
+            wd = self._dir_wds.pop(curr_dir)
+            del self._wd_dirs[wd]
+            self._visited.discard(self._dir_info.pop(curr_dir)[1])
+            self._inotify.rm_watch(wd)
+
+        # only go through the directories, not every indexed file
+        for curr_dir in [d for d in self._files_by_dir
+                         if d == path or d.startswith(prefix)]:
+            for filename in list(self._files_by_dir[curr_dir]):
+                self._remove_file(filename)
+
+    def _add_file(self, dirpath, filename, size):
+        """Add a file in directory dirpath to the index."""
+
+        self._files[filename] = (dirpath, size)
+        self._files_by_size.setdefault(size, []).append(filename)
+        self._files_by_dir.setdefault(dirpath, set()).add(filename)
+        self._dirty_sizes.add(size)
+
+    def _remove_file(self, filename):
+        """Remove a file from the index, if it is there."""
+
+        entry = self._files.pop(filename, None)
+        if entry is None:
+            return
+        dirpath, size = entry
+
+        filenames = self._files_by_size[size]
+        filenames.remove(filename)
+        if not filenames:
+            del self._files_by_size[size]
+
+        filenames = self._files_by_dir[dirpath]
+        filenames.discard(filename)
+        if not filenames:
+            del self._files_by_dir[dirpath]
+
+        self._dirty_sizes.add(size)
+
+    def _refresh_path(self, path):
+        """Bring the index up to date with a name that changed.
+
+        path may have been created, modified, replaced or removed.
+
+        """
+        self._remove_file(path)
+
+        parent, name = os.path.split(path)
+        info = self._dir_info.get(parent)
+        if info is None:
+            # its directory was removed since
+            return
+        root = info[0]
+
+        rel_dir = finddups.relative_dir(root, parent)
+
+        try:
+            file_info = os.lstat(path)
+
+            if self._follow_dirlinks and stat.S_ISLNK(file_info.st_mode):
+                # directories have events of their own, but symlinks to
+                # them don't
+                file_info = os.stat(path)
+                if (stat.S_ISDIR(file_info.st_mode)
+                        and path not in self._dir_wds
+                        and not self._exclude_dirs.match(name, rel_dir)):
+                    self._add_tree(root, path,
+                                   (file_info.st_dev, file_info.st_ino))
+                return
+        except OSError:
+            # gone already
+            return
+
+        if (stat.S_ISREG(file_info.st_mode)
+                and not self._exclude_files.match(name, rel_dir)):
+            self._add_file(parent, path, file_info.st_size)
+
+    def _handle_dir_event(self, path, mask):
+        """Handle an event on a subdirectory."""
+
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self._remove_tree(path)
+
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            self._remove_tree(path)
+
+            parent, name = os.path.split(path)
+            root = self._dir_info[parent][0]
+            if self._exclude_dirs.match(name,
+                                        finddups.relative_dir(root, parent)):
+                return
+
+            try:
+                file_info = os.stat(path)
+            except OSError:
+                return
+
+            self._add_tree(root, path, (file_info.st_dev, file_info.st_ino))
+
+    def _split_by_digest(self, groups, stage, regions, algorithm, keys,
+            digests):
+        """Split groups of files of the same size by the digest of regions.
+
+        stage is the index of the digest in the digests of each file: 0 for
+        partial, 1 for full. Digests are only calculated for files that
+        don't have them yet; the new ones are stored in digests.
+
+        Files that can't be read are left out, with an error. Returns the
+        new groups with at least two files.
+
+        """
+        new_groups = []
+        for filenames in groups:
+            by_digest = {}
+            for filename in filenames:
+                file_digests = digests[keys[filename]]
+                if file_digests[stage] is None:
+                    digest, error, _ = finddups.digest_or_error(
+                        filename, regions, algorithm, self._digest_cache)
+                    if error is not None:
+                        self._error(error)
+                        continue
+                    file_digests[stage] = digest
+
+                by_digest.setdefault(file_digests[stage], []).append(filename)
+
+            new_groups.extend(g for g in by_digest.values() if len(g) >= 2)
+
+        return new_groups
+
+    def _compare_size(self, size, filenames, old_digests):
+        """Find the duplicates among files of the same size.
+
+        old_digests are the stored digests of this size, by file key.
+        Files that were not renamed or written to since are not read
+        again.
+
+        Returns a 2-tuple ``(groups, digests)``, with the groups of
+        duplicates and the digests of the current files.
+
+        """
+        keys = {}
+        digests = {}
+        for filename in filenames:
+            try:
+                file_info = os.stat(filename)
+            except OSError:
+                # gone already; its events are still to come
+                continue
+            if file_info.st_size != size:
+                # same as above
+                continue
+
+            key = _file_key(file_info)
+            keys[filename] = key
+            if key not in digests:
+                if filename in self._modified:
+                    # it may have been written to within the same
+                    # timestamp tick as it was hashed
+                    digests[key] = [None, None]
+                else:
+                    digests[key] = old_digests.get(key, [None, None])
+
+        groups = [list(keys)]
+        if size == 0:
+            # empty files are all duplicates of each other
+            return [g for g in groups if len(g) >= 2], digests
+
+        if size >= finddups.PARTIAL_MD5_THRESHOLD:
+            groups = self._split_by_digest(
+                groups, 0, [(0, finddups.partial_md5_size(size))],
+                self._partial_hash, keys, digests)
+
+        groups = self._split_by_digest(groups, 1, [(0, size)],
+                                       self._full_hash, keys, digests)
+
+        return groups, digests
+
+    def _update_groups(self, replace=False):
+        """Compare the files of the sizes that changed, again.
+
+        If replace is True, all groups are replaced by the new ones.
+
+        """
+        new_groups = {}
+        new_digests = {}
+        for size in self._dirty_sizes:
+            filenames = list(self._files_by_size.get(size, ()))
+            old_digests = self._digests.get(size, {})
+            if len(filenames) < 2:
+                new_groups[size] = []
+                if filenames:
+                    # keep them for when another file of this size shows up
+                    new_digests[size] = old_digests
+                continue
+
+            new_groups[size], new_digests[size] = self._compare_size(
+                size, filenames, old_digests)
+
+        for size in self._dirty_sizes:
+            self._digests.pop(size, None)
+        self._digests.update(new_digests)
+
+        self._dirty_sizes = set()
+        self._modified = set()
+
+        with self._lock:
+            if replace:
+                self._groups = {}
+
+            for size, groups in py3compat.iteritems(new_groups):
+                if groups:
+                    self._groups[size] = groups
+                else:
+                    self._groups.pop(size, None)
+
+        if self._digest_cache is not None:
+            self._digest_cache.commit()
+
+    def process_events(self, timeout=0):
+        """Apply the pending changes to the watched directories.
+
+        Waits up to timeout seconds for any changes. The groups of
+        duplicates are brought up to date before returning.
+
+        Must not be called while the background thread is running.
+
+        Returns the number of events handled.
+
+        """
+        events = self._inotify.read_events(timeout)
+
+        changed_paths = set()
+        for wd, mask, _, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost; start over
+                self._scan_all()
+                return len(events)
+
+            curr_dir = self._wd_dirs.get(wd)
+            if curr_dir is None:
+                # e.g. IN_IGNORED for a directory we stopped watching
+                continue
+
+            if mask & IN_IGNORED:
+                # e.g. its filesystem was unmounted
+                self._remove_tree(curr_dir)
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # subdirectories are handled through their parent's
+                # events; a watched directory has no parent watch
+                if curr_dir in self.directories:
+                    self._error("error watching '%s': directory was moved "
+                                "or deleted" % curr_dir)
+                    self._remove_tree(curr_dir)
+                continue
+
+            if not name:
+                continue
+
+            path = os.path.join(curr_dir, _decode_name(name, curr_dir))
+            if mask & IN_ISDIR:
+                self._handle_dir_event(path, mask)
+            else:
+                # coalesce repeated events, e.g. IN_MODIFY while writing
+                changed_paths.add(path)
+                if mask & (IN_MODIFY | IN_CLOSE_WRITE):
+                    self._modified.add(path)
+
+        for path in changed_paths:
+            self._refresh_path(path)
+
+        if self._dirty_sizes:
+            self._update_groups()
+
+        return len(events)
+
+    def duplicates(self):
+        """Get the current groups of duplicate files.
+
+        Returns a (possibly empty) list of lists: the names of files that
+        have at least two copies, grouped together, as of the last changes
+        processed. No files are read.
+
+        """
+        with self._lock:
+            return [list(group)
+                    for groups in self._groups.values() for group in groups]
+
+    def _run(self):
+        """Process events until asked to stop, or until an error.
+
+        An exception ends the thread; it is recorded in thread_error,
+        for stop() to raise.
+
+        """
+        try:
+            while not self._stopping.is_set():
+                self.process_events(POLL_INTERVAL)
+        except Exception as e:
+            self._error("error in watcher thread: %s" % (e,))
+            self.thread_error = e
+
+    def is_running(self):
+        """Check whether the background thread is processing events."""
+
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start processing events continuously, in a background thread."""
+
+        if self._thread is not None:
+            raise RuntimeError("watcher already started")
+
+        self.thread_error = None
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, if running, and wait for it.
+
+        If the thread died of an exception, the exception is raised here.
+        The groups of duplicates are then no longer kept up to date.
+
+        """
+        if self._thread is None:
+            return
+
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+        if self.thread_error is not None:
+            raise self.thread_error
+
+    def close(self):
+        """Stop watching the directories."""
+
+        try:
+            self.stop()
+        finally:
+            self._inotify.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# vim: set expandtab smarttab shiftwidth=4 softtabstop=4 tw=75 :
@@ -1,7 +1,10 @@
 
 """Package information for capidup."""
 
+import sys
+
 from setuptools import setup
+from setuptools.command.build_py import build_py
 
 from capidup.version import __version__
 
@@ -11,6 +14,20 @@ def read_file(path):
     with open(path, 'r') as f:
         return f.read()
 
+class BuildPy(build_py):
+    """Leave out the modules that need a newer Python than the build's.
+
+    capidup.aio uses the async syntax of Python 3.5, and would fail to
+    byte-compile on older versions.
+
+    """
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 5):
+            modules = [m for m in modules if m[:2] != ("capidup", "aio")]
+        return modules
+
 setup(
     name='capidup',
     description='Quickly find duplicate files in directories',
@@ -19,6 +36,7 @@ setup(
     url='https://github.com/israel-lugo/capidup',
     version=__version__,
     packages=['capidup',],
+    cmdclass={'build_py': BuildPy},
     license='GPLv3+',
     classifiers=[
         'Development Status :: 5 - Production/Stable',